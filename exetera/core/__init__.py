@@ -1,3 +1,4 @@
 
-from . import data_schema, data_writer, dataset, exporter, fields, filtered_field, importer, load_schema,\
-    operations, persistence, readerwriter, regression, session, split, utils, validation
+from . import bitmap, data_schema, data_writer, dataset, exporter, fields, filtered_field, importer,\
+    indexes, join_map, load_schema, operations, persistence, query, readerwriter, regression,\
+    session, sketches, split, utils, validation
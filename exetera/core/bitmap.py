@@ -0,0 +1,382 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from exetera.core import fields
+
+
+# compressed bitmaps
+# ==================
+# Bitmaps are split into containers of 2^16 rows, in the manner of roaring bitmaps. Each
+# container that has any bits set is held either as a sorted uint16 array of the positions
+# of its set bits (when it has at most DENSE_THRESHOLD set bits) or as 1024 uint64 words.
+
+CONTAINER_BITS = 16
+CONTAINER_SIZE = 1 << CONTAINER_BITS
+CONTAINER_WORDS = CONTAINER_SIZE // 64
+DENSE_THRESHOLD = 4096
+
+
+def _is_dense(container):
+    return container.dtype == np.uint64
+
+
+def _to_words(container):
+    if _is_dense(container):
+        return container
+    bits = np.zeros(CONTAINER_SIZE, dtype=bool)
+    bits[container] = True
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+def _to_positions(container):
+    if _is_dense(container):
+        bits = np.unpackbits(container.view(np.uint8), bitorder='little')
+        return np.flatnonzero(bits).astype(np.uint16)
+    return container
+
+
+def _cardinality(container):
+    if _is_dense(container):
+        return int(np.unpackbits(container.view(np.uint8)).sum())
+    return len(container)
+
+
+def _compact(container):
+    # choose the smaller representation for a container, returning None if it is empty
+    count = _cardinality(container)
+    if count == 0:
+        return None
+    if count > DENSE_THRESHOLD:
+        return _to_words(container)
+    return _to_positions(container)
+
+
+class Bitmap:
+    """
+    A compressed bitmap over 'length' rows. Bitmaps can be combined with '&', '|', '-'
+    (and not) and '~' without decompressing containers that don't take part in the
+    operation, and can be used as a filter by 'Session.apply_filter'. For that reason,
+    len() of a bitmap is its length in rows, and indexing it with a slice produces the
+    boolean filter for those rows; the number of set bits is given by 'count'.
+    :param length: the number of rows that the bitmap covers
+    :param keys: a sorted int64 array of the numbers of the containers that are present
+    :param containers: a list of containers, one per key
+    """
+    def __init__(self, length, keys=None, containers=None):
+        self.length = length
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else keys
+        self.containers = list() if containers is None else containers
+
+    @staticmethod
+    def from_positions(positions, length):
+        """
+        Create a bitmap from a sorted array of the positions of its set bits.
+        """
+        builder = BitmapBuilder(length)
+        builder.add(positions)
+        return builder.complete()
+
+    @staticmethod
+    def from_filter(filter_):
+        """
+        Create a bitmap from a boolean array.
+        """
+        return Bitmap.from_positions(np.flatnonzero(filter_), len(filter_))
+
+    @staticmethod
+    def full(length):
+        """
+        Create a bitmap of 'length' rows with every bit set.
+        """
+        keys = np.arange((length + CONTAINER_SIZE - 1) >> CONTAINER_BITS, dtype=np.int64)
+        containers = list()
+        for k in keys:
+            rows = min(length - (k << CONTAINER_BITS), CONTAINER_SIZE)
+            bits = np.zeros(CONTAINER_SIZE, dtype=bool)
+            bits[:rows] = True
+            containers.append(_compact(np.packbits(bits, bitorder='little').view(np.uint64)))
+        return Bitmap(length, keys, containers)
+
+    def __len__(self):
+        return self.length
+
+    def count(self):
+        """
+        The number of set bits.
+        """
+        return sum(_cardinality(c) for c in self.containers)
+
+    def _check(self, other):
+        if not isinstance(other, Bitmap):
+            raise ValueError("bitmaps can only be combined with other bitmaps")
+        if other.length != self.length:
+            raise ValueError("bitmaps must be the same length to be combined but are {} and "
+                             "{}".format(self.length, other.length))
+
+    def __and__(self, other):
+        self._check(other)
+        _, i_self, i_other = np.intersect1d(self.keys, other.keys, assume_unique=True,
+                                            return_indices=True)
+        keys, containers = list(), list()
+        for i, j in zip(i_self, i_other):
+            a, b = self.containers[i], other.containers[j]
+            if not _is_dense(a) and not _is_dense(b):
+                c = _compact(np.intersect1d(a, b, assume_unique=True))
+            else:
+                c = _compact(_to_words(a) & _to_words(b))
+            if c is not None:
+                keys.append(self.keys[i])
+                containers.append(c)
+        return Bitmap(self.length, np.asarray(keys, dtype=np.int64), containers)
+
+    def __or__(self, other):
+        self._check(other)
+        keys = np.union1d(self.keys, other.keys)
+        containers = list()
+        for k in keys:
+            i = np.searchsorted(self.keys, k)
+            j = np.searchsorted(other.keys, k)
+            a = self.containers[i] if i < len(self.keys) and self.keys[i] == k else None
+            b = other.containers[j] if j < len(other.keys) and other.keys[j] == k else None
+            if a is None or b is None:
+                containers.append(a if b is None else b)
+            elif not _is_dense(a) and not _is_dense(b):
+                containers.append(_compact(np.union1d(a, b)))
+            else:
+                containers.append(_compact(_to_words(a) | _to_words(b)))
+        return Bitmap(self.length, keys.astype(np.int64), containers)
+
+    def __sub__(self, other):
+        self._check(other)
+        keys, containers = list(), list()
+        for i, k in enumerate(self.keys):
+            a = self.containers[i]
+            j = np.searchsorted(other.keys, k)
+            if j < len(other.keys) and other.keys[j] == k:
+                b = other.containers[j]
+                if not _is_dense(a) and not _is_dense(b):
+                    a = _compact(np.setdiff1d(a, b, assume_unique=True))
+                else:
+                    a = _compact(_to_words(a) & ~_to_words(b))
+            if a is not None:
+                keys.append(k)
+                containers.append(a)
+        return Bitmap(self.length, np.asarray(keys, dtype=np.int64), containers)
+
+    def __invert__(self):
+        return Bitmap.full(self.length) - self
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise ValueError("bitmaps can only be indexed with contiguous slices")
+        start, stop, _ = item.indices(self.length)
+        return self.to_filter(start, stop)
+
+    def to_filter(self, start=0, end=None):
+        """
+        Decompress rows 'start' to 'end' of the bitmap into a boolean array.
+        """
+        end = self.length if end is None else end
+        result = np.zeros(max(end - start, 0), dtype=bool)
+        first = np.searchsorted(self.keys, start >> CONTAINER_BITS)
+        last = np.searchsorted(self.keys, (max(end, 1) - 1) >> CONTAINER_BITS, side='right')
+        for i in range(first, last):
+            positions = (self.keys[i] << CONTAINER_BITS) + \
+                _to_positions(self.containers[i]).astype(np.int64)
+            positions = positions[(positions >= start) & (positions < end)]
+            result[positions - start] = True
+        return result
+
+    def to_indices(self):
+        """
+        The positions of the set bits as a sorted int64 array.
+        """
+        if len(self.keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([(k << CONTAINER_BITS) + _to_positions(c).astype(np.int64)
+                               for k, c in zip(self.keys, self.containers)])
+
+    def write(self, group, name):
+        """
+        Write the bitmap to a new subgroup 'name' of 'group'.
+        """
+        bg = group.create_group(name)
+        bg.attrs['length'] = self.length
+        payloads = [c.view(np.uint16) for c in self.containers]
+        offsets = np.zeros(len(payloads) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in payloads], out=offsets[1:])
+        bg.create_dataset('keys', data=self.keys)
+        bg.create_dataset('dense', data=np.asarray([_is_dense(c) for c in self.containers],
+                                                   dtype=bool))
+        bg.create_dataset('offsets', data=offsets)
+        bg.create_dataset('payload', data=np.concatenate(payloads) if len(payloads) > 0
+                          else np.zeros(0, dtype=np.uint16))
+
+    @staticmethod
+    def read(group):
+        """
+        Read a bitmap written by 'write'.
+        """
+        keys, dense = group['keys'][:], group['dense'][:]
+        offsets, payload = group['offsets'][:], group['payload'][:]
+        containers = list()
+        for i in range(len(keys)):
+            c = payload[offsets[i]:offsets[i + 1]]
+            containers.append(c.view(np.uint64).copy() if dense[i] else c.copy())
+        return Bitmap(int(group.attrs['length']), keys.astype(np.int64), containers)
+
+
+class BitmapBuilder:
+    """
+    Build a bitmap from sorted positions that are added a chunk at a time. Only the
+    positions of the container currently being filled are held uncompressed.
+    """
+    def __init__(self, length):
+        self.length = length
+        self.keys = list()
+        self.containers = list()
+        self._current = None
+        self._pending = list()
+
+    def _flush(self):
+        if self._current is not None and len(self._pending) > 0:
+            self.keys.append(self._current)
+            self.containers.append(_compact(np.concatenate(self._pending)))
+        self._pending = list()
+
+    def add(self, positions):
+        """
+        Add set bits; 'positions' must be sorted and follow any positions already added.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return
+        highs = positions >> CONTAINER_BITS
+        boundaries = np.flatnonzero(np.diff(highs)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(positions)]))
+        for s, e in zip(starts, ends):
+            if highs[s] != self._current:
+                self._flush()
+                self._current = highs[s]
+            self._pending.append((positions[s:e] & (CONTAINER_SIZE - 1)).astype(np.uint16))
+
+    def complete(self):
+        self._flush()
+        return Bitmap(self.length, np.asarray(self.keys, dtype=np.int64), self.containers)
+
+
+# bitmap indices
+# ==============
+
+BITMAP_INDEX_NAME = 'bitmap_index'
+
+
+def _key_name(name):
+    return name.decode() if isinstance(name, bytes) else name
+
+
+class BitmapIndex:
+    """
+    A bitmap per value of a categorical field, from which filters for predicates on the
+    field can be calculated without reading the field itself.
+    :param bitmaps: a dictionary of category values to Bitmaps
+    :param keys: a dictionary of category values to category names
+    :param version: the version of the field when the index was built
+    """
+    def __init__(self, bitmaps, keys, version):
+        self.bitmaps = bitmaps
+        self.keys = {v: _key_name(k) for v, k in keys.items()}
+        self.version = version
+        self.length = next(iter(bitmaps.values())).length if len(bitmaps) > 0 else 0
+
+    def _value(self, key):
+        if isinstance(key, (str, bytes)):
+            name = _key_name(key)
+            for v, k in self.keys.items():
+                if k == name:
+                    return v
+            raise ValueError("'{}' is not one of the categories {}".format(
+                name, list(self.keys.values())))
+        return key
+
+    def eq(self, key):
+        """
+        The bitmap of rows whose value is 'key', which is a category name or value.
+        """
+        value = self._value(key)
+        bitmap = self.bitmaps.get(value)
+        return Bitmap(self.length) if bitmap is None else bitmap
+
+    def isin(self, keys):
+        """
+        The bitmap of rows whose value is any of 'keys'.
+        """
+        result = Bitmap(self.length)
+        for k in keys:
+            result = result | self.eq(k)
+        return result
+
+    def write(self, field_group):
+        """
+        Write the index to 'field_group', replacing any existing index.
+        """
+        if BITMAP_INDEX_NAME in field_group.keys():
+            del field_group[BITMAP_INDEX_NAME]
+        ig = field_group.create_group(BITMAP_INDEX_NAME)
+        ig.attrs['version'] = self.version
+        ig.attrs['length'] = self.length
+        for v, bitmap in self.bitmaps.items():
+            bitmap.write(ig, str(v))
+
+
+def _field_keys(field_group):
+    return {int(v): k for v, k in zip(field_group['key_values'][:], field_group['key_names'][:])}
+
+
+def build_bitmap_index(field_group, chunksize=1 << 20):
+    """
+    Build a bitmap index for a categorical field, reading its values a chunk at a time.
+    :param field_group: the hdf5 group of the categorical field
+    :return: a BitmapIndex
+    """
+    if not field_group.attrs['fieldtype'].startswith('categorical'):
+        raise ValueError("bitmap indices can only be built for categorical fields")
+    values = field_group['values']
+    length = len(values)
+    keys = _field_keys(field_group)
+    builders = {v: BitmapBuilder(length) for v in keys.keys()}
+    for start in range(0, length, chunksize):
+        chunk = values[start:start + chunksize]
+        for v in np.unique(chunk).tolist():
+            if v not in builders:
+                builders[v] = BitmapBuilder(length)
+            builders[v].add(np.flatnonzero(chunk == v) + start)
+    bitmaps = {v: b.complete() for v, b in builders.items()}
+    return BitmapIndex(bitmaps, keys, fields.field_version(field_group))
+
+
+def read_bitmap_index(field_group):
+    """
+    Read the bitmap index of a categorical field, returning None if it has no index or
+    the index is out of date, because the field has been rewritten since it was built.
+    """
+    if BITMAP_INDEX_NAME not in field_group.keys():
+        return None
+    ig = field_group[BITMAP_INDEX_NAME]
+    if ig.attrs['version'] != fields.field_version(field_group) or \
+            ig.attrs['length'] != len(field_group['values']):
+        return None
+    keys = _field_keys(field_group)
+    bitmaps = {int(v): Bitmap.read(ig[v]) for v in ig.keys()}
+    return BitmapIndex(bitmaps, keys, ig.attrs['version'])
@@ -1,7 +1,17 @@
 from threading import Thread
+import uuid
+
+# every write to a field gives its group a new version, so that data derived from the
+# field's contents (such as its indices) can tell whether the field has changed since
+VERSION_ATTR = 'version'
+
 
 class DataWriter:
 
+    @staticmethod
+    def new_version(group):
+        group.attrs[VERSION_ATTR] = uuid.uuid4().hex
+
     @staticmethod
     def clear_dataset(parent_group, name):
         t = Thread(target=DataWriter._clear_dataset,
@@ -12,6 +22,7 @@ class DataWriter:
     @staticmethod
     def _clear_dataset(field, name):
         del field[name]
+        DataWriter.new_version(field)
 
     @staticmethod
     def _create_group(parent_group, name, attrs):
@@ -37,6 +48,7 @@ class DataWriter:
             DataWriter._write_first(group, name, field, count, dtype)
         else:
             DataWriter._write_additional(group, name, field, count)
+        DataWriter.new_version(group)
 
     @staticmethod
     def _write_first(group, name, field, count, dtype=None):
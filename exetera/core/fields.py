@@ -4,7 +4,7 @@ import numpy as np
 import numba
 import h5py
 
-from exetera.core.data_writer import DataWriter
+from exetera.core.data_writer import DataWriter, VERSION_ATTR
 from exetera.core import utils
 
 
@@ -97,6 +97,37 @@ class ReadOnlyFieldArray:
                               "for a writeable copy of the field")
 
 
+DESCRIBE_ATTR = 'describe'
+
+
+def field_version(field):
+    """
+    Get the version of a field's hdf5 group, which changes whenever the field is written,
+    cleared or edited. Fields written before versions were recorded fall back to their
+    timestamp.
+    """
+    if VERSION_ATTR in field.attrs:
+        return field.attrs[VERSION_ATTR]
+    return field.attrs['timestamp']
+
+
+def _clear_indices(field):
+    # indices (such as bitmap, key or sorted indices) are stored as subgroups of the field's
+    # group; they describe the data being cleared or edited, so they are removed with it
+    for k in list(field.keys()):
+        if isinstance(field[k], h5py.Group):
+            del field[k]
+    # cached summary statistics are removed in the same way, both from the field and, for
+    # a '_valid' companion field, from the field whose values it filters
+    if DESCRIBE_ATTR in field.attrs:
+        del field.attrs[DESCRIBE_ATTR]
+    name = field.name.split('/')[-1]
+    if name.endswith('_valid') and name[:-len('_valid')] in field.parent:
+        filtered = field.parent[name[:-len('_valid')]]
+        if isinstance(filtered, h5py.Group) and DESCRIBE_ATTR in filtered.attrs:
+            del filtered.attrs[DESCRIBE_ATTR]
+
+
 class WriteableFieldArray:
     def __init__(self, field, dataset_name):
         self._field = field
@@ -115,9 +146,12 @@ class WriteableFieldArray:
 
     def __setitem__(self, key, value):
         self._dataset[key] = value
+        DataWriter.new_version(self._field)
+        _clear_indices(self._field)
 
     def clear(self):
         DataWriter._clear_dataset(self._field, self._name)
+        _clear_indices(self._field)
 
     def write_part(self, part):
         DataWriter.write(self._field, self._name, part, len(part), dtype=self._dataset.dtype)
@@ -153,7 +187,7 @@ class ReadOnlyIndexedFieldArray:
                 index = self._index_dataset[start:stop+1]
                 bytestr = self._values_dataset[index[0]:index[-1]]
                 results = [None] * (len(index)-1)
-                startindex = start
+                startindex = index[0]
                 for ir in range(len(results)):
                     results[ir] =\
                         bytestr[index[ir]-np.int64(startindex):
@@ -219,7 +253,7 @@ class WriteableIndexedFieldArray:
                 index = self._index_dataset[start:stop + 1]
                 bytestr = self._values_dataset[index[0]:index[-1]]
                 results = [None] * (len(index) - 1)
-                startindex = start
+                startindex = index[0]
                 rmax = min(len(results), stop - start)
                 for ir in range(rmax):
                     rbytes = bytestr[index[ir] - np.int64(startindex):
@@ -252,6 +286,7 @@ class WriteableIndexedFieldArray:
         self._index_dataset = self._field[self._index_name]
         self._values_dataset = self._field[self._values_name]
         self._accumulated = 0
+        _clear_indices(self._field)
 
 
     def write_part(self, part):
@@ -299,7 +334,8 @@ def base_field_contructor(session, group, name, timestamp=None, chunksize=None):
 
     field = group.create_group(name)
     field.attrs['chunksize'] = session.chunksize if chunksize is None else chunksize
-    field.attrs['timestamp'] = session.chunksize if chunksize is None else chunksize
+    timestamp = session.timestamp if timestamp is None else timestamp
+    field.attrs['timestamp'] = str(timestamp) if isinstance(timestamp, datetime) else timestamp
     return field
 
 
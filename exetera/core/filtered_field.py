@@ -11,6 +11,9 @@
 
 import numpy as np
 
+from exetera.core import fields
+from exetera.core import operations as ops
+
 def filtered_field(field, filter):
     for f in filter:
         yield field[f]
@@ -28,3 +31,159 @@ class FilteredField:
     def __len__(self):
         return len(self.filter)
 
+
+
+def _selection_array(selection):
+    # filters and indices may be fields, views or ndarrays
+    if isinstance(selection, FieldView):
+        return selection.data[:]
+    if isinstance(selection, fields.Field):
+        return selection.data[:]
+    return np.asarray(selection)
+
+
+class FieldViewArray:
+    """
+    Read-only array access to a FieldView, reading the rows selected by the view from its
+    base field a chunk at a time.
+    """
+    def __init__(self, view):
+        self._view = view
+
+    def __len__(self):
+        return len(self._view)
+
+    @property
+    def dtype(self):
+        base = self._view.base
+        if isinstance(base, fields.IndexedStringField):
+            return base.values.dtype
+        return base.dtype if isinstance(base, np.ndarray) else base.data.dtype
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            positions = self._view.positions()[item]
+        elif isinstance(item, (int, np.integer)):
+            item = item + len(self) if item < 0 else item
+            if item < 0 or item >= len(self):
+                raise ValueError("index is out of range")
+            return self[item:item + 1][0]
+        else:
+            raise ValueError("views can only be read with integers or slices but got "
+                             "{}".format(type(item)))
+        base = self._view.base
+        if isinstance(base, fields.IndexedStringField):
+            indices, values = ops.gather(base, positions, self._view.chunksize)
+            return [values[indices[i]:indices[i + 1]].tobytes().decode()
+                    for i in range(len(indices) - 1)]
+        if isinstance(base, np.ndarray):
+            return base[positions]
+        return ops.gather(base, positions, self._view.chunksize)
+
+
+class FieldView:
+    """
+    A lazy view of a field through a filter or an index. No data is read or written when
+    the view is created; stacking a filter or index on a view composes it with the view's
+    existing selection, so a chain of views is realised with a single gather from the
+    base field, when it is read through 'data' or written with 'realise'.
+    Views that are only filtered keep a boolean mask over the base field and so read it
+    in order; views that are indexed keep the int64 positions of the selected rows.
+    :param base: the field (or ndarray) being viewed, or another view
+    :param filter: optional - a boolean filter over the rows of 'base'
+    :param index: optional - an index of rows of 'base'
+    :param chunksize: optional - the number of rows read at a time; defaults to
+    DEFAULT_CHUNKSIZE
+    """
+    def __init__(self, base, filter=None, index=None, chunksize=None):
+        if filter is not None and index is not None:
+            raise ValueError("Only one of 'filter' and 'index' may be set")
+        if isinstance(base, FieldView):
+            self.base = base.base
+            self._mask, self._index = base._mask, base._index
+            self.chunksize = base.chunksize if chunksize is None else chunksize
+        else:
+            self.base = base
+            self._mask, self._index = None, None
+            self.chunksize = ops.DEFAULT_CHUNKSIZE if chunksize is None else chunksize
+        self._positions = None
+
+        if filter is not None:
+            filter_ = _selection_array(filter).astype(bool)
+            if len(filter_) != len(self):
+                msg = "'filter' must be the same length as the view ({}) but is {}"
+                raise ValueError(msg.format(len(self), len(filter_)))
+            if self._index is not None:
+                self._index = self._index[filter_]
+            elif self._mask is not None:
+                mask = self._mask.copy()
+                mask[mask] = filter_
+                self._mask = mask
+            else:
+                self._mask = filter_
+        elif index is not None:
+            index_ = _selection_array(index).astype(np.int64)
+            if len(index_) > 0 and (index_.min() < 0 or index_.max() >= len(self)):
+                raise ValueError("'index' contains indices outside of the view, which has "
+                                 "length {}".format(len(self)))
+            if self._index is not None:
+                self._index = self._index[index_]
+            elif self._mask is not None:
+                self._index = np.flatnonzero(self._mask)[index_]
+                self._mask = None
+            else:
+                self._index = index_
+
+    def __len__(self):
+        if self._index is not None:
+            return len(self._index)
+        if self._mask is not None:
+            return int(np.count_nonzero(self._mask))
+        return ops._key_length(self.base)
+
+    def filter(self, filter):
+        """
+        Create a view of this view through 'filter'.
+        """
+        return FieldView(self, filter=filter)
+
+    def apply_index(self, index):
+        """
+        Create a view of this view through 'index'.
+        """
+        return FieldView(self, index=index)
+
+    def positions(self):
+        """
+        The positions in the base field of the rows selected by the view.
+        """
+        if self._positions is None:
+            if self._index is not None:
+                self._positions = self._index
+            elif self._mask is not None:
+                self._positions = np.flatnonzero(self._mask)
+            else:
+                self._positions = np.arange(len(self), dtype=np.int64)
+        return self._positions
+
+    @property
+    def data(self):
+        return FieldViewArray(self)
+
+    def realise(self, dest=None):
+        """
+        Materialise the view. If 'dest' is set, the selected rows are streamed from the
+        base field into it and 'dest' is returned; otherwise the selected rows are returned
+        as an ndarray or, for indexed strings, as a tuple of indices and values.
+        """
+        if dest is None:
+            if isinstance(self.base, np.ndarray):
+                return self.base[self.positions()]
+            return ops.gather(self.base, self.positions(), self.chunksize)
+        if isinstance(self.base, np.ndarray):
+            dest.data.write(self.base[self.positions()])
+        elif self._index is None and self._mask is not None:
+            ops.apply_filter_streamed(self._mask, self.base, dest, self.chunksize)
+        else:
+            ops.apply_index_streamed(self.positions(), self.base, dest, self.chunksize)
+        return dest
@@ -18,12 +18,15 @@ import h5py
 
 from exetera.core import dataset as dataset
 from exetera.core import persistence as per
+from exetera.core import bitmap as bm
+from exetera.core import indexes as idx
 from exetera.core import utils
 from exetera.core import operations as ops
 from exetera.core.load_schema import load_schema
 
 
-def import_with_schema(timestamp, dest_file_name, schema_file, files, overwrite):
+def import_with_schema(timestamp, dest_file_name, schema_file, files, overwrite,
+                       bitmap_indexes=False):
     print(timestamp)
     print(schema_file)
     print(files)
@@ -81,7 +84,7 @@ def import_with_schema(timestamp, dest_file_name, schema_file, files, overwrite)
 
             DatasetImporter(datastore, files[sk], hf, sk, schema[sk], timestamp,
                             stop_after=stop_after.get(sk, None),
-                            show_progress_every=show_every)
+                            show_progress_every=show_every, bitmap_indexes=bitmap_indexes)
 
             print(sk, hf.keys())
             table = hf[sk]
@@ -94,6 +97,16 @@ def import_with_schema(timestamp, dest_file_name, schema_file, files, overwrite)
             valid_tos = np.full(len(ids), ops.MAX_DATETIME.timestamp())
             jvt.write(valid_tos)
 
+        # match each declared foreign key with the primary key it references once, at import
+        for sk in schema.keys():
+            if sk not in files:
+                continue
+            for fk, reference in schema[sk].foreign_keys.items():
+                space, key = reference['space'], reference['key']
+                if fk in hf[sk].keys() and space in hf.keys() and key in hf[space].keys():
+                    idx.build_foreign_key_index(hf[sk][fk], hf[space][key]).write(
+                        hf[sk][fk], hf[space][key])
+
         print(hf.keys())
 
 
@@ -101,7 +114,7 @@ class DatasetImporter:
     def __init__(self, datastore, source, hf, space, schema, timestamp,
                  keys=None,
                  stop_after=None, show_progress_every=None, filter_fn=None,
-                 early_filter=None):
+                 early_filter=None, bitmap_indexes=False):
         # self.names_ = list()
         self.index_ = None
 
@@ -206,5 +219,17 @@ class DatasetImporter:
             for i_df in range(len(index_map)):
                 new_field_list[i_df].flush()
 
+            if bitmap_indexes:
+                for field_name in fields_to_use:
+                    field_group = group[field_name]
+                    if field_group.attrs['fieldtype'].startswith('categorical'):
+                        bm.build_bitmap_index(field_group).write(field_group)
+
+            primary_keys = [k for k in schema.primary_keys if k in fields_to_use]
+            if len(primary_keys) > 0:
+                group.attrs['primary_keys'] = primary_keys
+                for k in primary_keys:
+                    idx.build_key_index(group[k]).write(group[k])
+
             print(f"{i_r} rows parsed in {time.time() - time0}s")
 
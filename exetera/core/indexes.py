@@ -0,0 +1,453 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from exetera.core import fields
+from exetera.core import operations as ops
+
+
+# Indices are stored as subgroups of the hdf5 group of the field that they index. Each
+# records the version and length of the field when it was built, and is ignored once
+# the field no longer matches.
+
+KEY_INDEX_NAME = 'key_index'
+
+
+def _is_indexed_string(field_group):
+    return field_group.attrs['fieldtype'] == 'indexedstring'
+
+
+def field_length(field_group):
+    if _is_indexed_string(field_group):
+        return max(len(field_group['index']) - 1, 0)
+    return len(field_group['values'])
+
+
+def index_is_current(field_group, index_group):
+    """
+    Determine whether an index stored with a field was built from the field's current
+    contents.
+    """
+    return index_group.attrs['version'] == fields.field_version(field_group) and \
+        index_group.attrs['length'] == field_length(field_group)
+
+
+# key indices
+# ===========
+
+KEY_INDEX_PROBE_WINDOW = 16
+
+
+def _hash_rows(field_group, start, end):
+    hashes = np.zeros(end - start, dtype=np.uint64)
+    if _is_indexed_string(field_group):
+        indices = field_group['index'][start:end + 1]
+        values = field_group['values'][indices[0]:indices[-1]]
+        return ops.hash_indexed_strings(indices - indices[0], values, hashes)
+    return ops.hash_key_rows(ops.key_rows(field_group['values'][start:end]), hashes)
+
+
+def _hash_keys(field_group, keys):
+    # convert the keys to the representation of the field and hash them in the same way
+    # as the field's rows; keys that can't be represented by the field are marked invalid
+    if _is_indexed_string(field_group):
+        keys = [k.encode() if isinstance(k, str) else bytes(k) for k in keys]
+        indices, values = ops.encode_strings(keys)
+        hashes = ops.hash_indexed_strings(indices, values, np.zeros(len(keys), dtype=np.uint64))
+        return hashes, keys, np.ones(len(keys), dtype=bool)
+    dtype = field_group['values'].dtype
+    if dtype.kind == 'S':
+        keys = [k.encode() if isinstance(k, str) else bytes(k) for k in keys]
+        valid = np.asarray([len(k) <= dtype.itemsize for k in keys], dtype=bool)
+        converted = np.asarray(keys, dtype=dtype)
+    else:
+        keys = np.asarray(keys)
+        converted = keys.astype(dtype)
+        valid = converted == keys
+    hashes = ops.hash_key_rows(ops.key_rows(converted),
+                               np.zeros(len(converted), dtype=np.uint64))
+    return hashes, converted, valid
+
+
+def _key_at(field_group, row):
+    if _is_indexed_string(field_group):
+        start, end = field_group['index'][row:row + 2]
+        return field_group['values'][start:end].tobytes()
+    return field_group['values'][row]
+
+
+class KeyIndex:
+    """
+    A hash index from the values of a key field to the rows that hold them. The index is
+    an open-addressing table of rows, ordered by the hash of the key at each row, along
+    with the hash and, for fixed-width keys, the key held in each slot, so that a lookup
+    reads only a few slots of the table rather than the field. Where a key occurs more
+    than once, the first row holding it is found.
+    :param slots: the table of rows, with -1 marking empty slots. This is an ndarray or
+    an hdf5 dataset
+    :param slot_hashes: the hash of the key of the row in each slot
+    :param slot_keys: the key of the row in each slot, or None for indexed strings, whose
+    candidate rows are read from the field
+    :param version: the version of the field when the index was built
+    :param length: the length of the field when the index was built
+    """
+    def __init__(self, slots, slot_hashes, slot_keys, version, length):
+        self.slots = slots
+        self.slot_hashes = slot_hashes
+        self.slot_keys = slot_keys
+        self.version = version
+        self.length = length
+
+    def lookup(self, field_group, keys):
+        """
+        Find the rows of the field that hold each of 'keys'.
+        :param field_group: the hdf5 group of the indexed field
+        :param keys: a sequence of keys
+        :return: an int64 array of rows, with INVALID_INDEX for keys that aren't present
+        """
+        hashes, keys, valid = _hash_keys(field_group, keys)
+        rows = np.full(len(keys), ops.INVALID_INDEX, dtype=np.int64)
+        size = len(self.slots)
+        for i in np.flatnonzero(valid):
+            pos = int(hashes[i] & np.uint64(size - 1))
+            searching = True
+            while searching:
+                end = min(pos + KEY_INDEX_PROBE_WINDOW, size)
+                window, window_hashes = self.slots[pos:end], self.slot_hashes[pos:end]
+                window_keys = None if self.slot_keys is None else self.slot_keys[pos:end]
+                for j, row in enumerate(window):
+                    if row == -1:
+                        searching = False
+                        break
+                    if window_hashes[j] != hashes[i]:
+                        continue
+                    candidate = _key_at(field_group, row) if window_keys is None \
+                        else window_keys[j]
+                    if candidate == keys[i]:
+                        rows[i] = row
+                        searching = False
+                        break
+                pos = end % size
+        return rows
+
+    def write(self, field_group):
+        """
+        Write the index to 'field_group', replacing any existing key index.
+        """
+        if KEY_INDEX_NAME in field_group.keys():
+            del field_group[KEY_INDEX_NAME]
+        ig = field_group.create_group(KEY_INDEX_NAME)
+        ig.attrs['version'] = self.version
+        ig.attrs['length'] = self.length
+        ig.create_dataset('slots', data=self.slots)
+        ig.create_dataset('slot_hashes', data=self.slot_hashes)
+        if self.slot_keys is not None:
+            ig.create_dataset('slot_keys', data=self.slot_keys)
+
+
+def build_key_index(field_group, chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Build a key index for a field, hashing its keys a chunk at a time.
+    :param field_group: the hdf5 group of the field to be indexed
+    :return: a KeyIndex
+    """
+    length = field_length(field_group)
+    hashes = np.zeros(length, dtype=np.uint64)
+    for c in ops.chunks(length, chunksize):
+        hashes[c[0]:c[1]] = _hash_rows(field_group, c[0], c[1])
+    size = 16
+    while size < length * 2:
+        size *= 2
+    slots = np.full(size, -1, dtype=np.int64)
+    ops._hash_table_rehash(slots, hashes, length)
+    slot_hashes = np.zeros(size, dtype=np.uint64)
+    occupied = slots != -1
+    slot_hashes[occupied] = hashes[slots[occupied]]
+    slot_keys = None
+    if not _is_indexed_string(field_group):
+        values = field_group['values']
+        slot_keys = np.zeros(size, dtype=values.dtype)
+        slot_of_row = np.zeros(length, dtype=np.int64)
+        slot_of_row[slots[occupied]] = np.flatnonzero(occupied)
+        for c in ops.chunks(length, chunksize):
+            slot_keys[slot_of_row[c[0]:c[1]]] = values[c[0]:c[1]]
+    return KeyIndex(slots, slot_hashes, slot_keys, fields.field_version(field_group), length)
+
+
+def read_key_index(field_group):
+    """
+    Open the key index stored with a field, returning None if the field has no key index
+    or the index is out of date. The index is read from the file as it is probed.
+    """
+    if KEY_INDEX_NAME not in field_group.keys():
+        return None
+    ig = field_group[KEY_INDEX_NAME]
+    if not index_is_current(field_group, ig):
+        return None
+    slot_keys = ig['slot_keys'] if 'slot_keys' in ig.keys() else None
+    return KeyIndex(ig['slots'], ig['slot_hashes'], slot_keys,
+                    ig.attrs['version'], ig.attrs['length'])
+
+
+# sorted indices
+# ==============
+
+SORTED_INDEX_NAME = 'sorted_index'
+SORTED_INDEX_BLOCK = 1 << 12
+
+
+def _is_orderable(field_group):
+    fieldtype = field_group.attrs['fieldtype'].split(',')[0]
+    return fieldtype in ('numeric', 'timestamp', 'datetime', 'date')
+
+
+class SortedIndex:
+    """
+    A secondary index over a numeric or timestamp field, made up of the field's values in
+    sorted order, the permutation that sorts them and the first value of each block of
+    SORTED_INDEX_BLOCK sorted values. A range query searches the block fences, then reads
+    one block to find each bound and the slice of the permutation between the bounds.
+    :param sorted_values: the sorted values of the field; an ndarray or hdf5 dataset
+    :param order: the rows of the field in the order of their values
+    :param fences: the first value of each block of sorted values
+    :param version: the version of the field when the index was built
+    """
+    def __init__(self, sorted_values, order, fences, version):
+        self.sorted_values = sorted_values
+        self.order = order
+        self.fences = fences
+        self.version = version
+
+    def __len__(self):
+        return len(self.order)
+
+    def _bound(self, value, side):
+        block = np.searchsorted(self.fences[:], value, side=side)
+        if block == 0:
+            return 0
+        start = (block - 1) * SORTED_INDEX_BLOCK
+        values = self.sorted_values[start:start + SORTED_INDEX_BLOCK]
+        return start + int(np.searchsorted(values, value, side=side))
+
+    def range(self, low=None, high=None, include_low=True, include_high=False,
+              as_mask=False):
+        """
+        Find the rows of the field whose values lie between 'low' and 'high'.
+        :param low: optional - the lower bound; unbounded if not set
+        :param high: optional - the upper bound; unbounded if not set
+        :param include_low: optional - whether rows equal to 'low' match. Defaults to True
+        :param include_high: optional - whether rows equal to 'high' match. Defaults to
+        False
+        :param as_mask: optional - if set, return a boolean filter over the field rather
+        than the rows
+        :return: the matching rows in ascending order, or a filter if 'as_mask' is set
+        """
+        start = 0 if low is None else self._bound(low, 'left' if include_low else 'right')
+        end = len(self) if high is None else self._bound(high, 'right' if include_high else 'left')
+        rows = np.sort(self.order[start:end]) if end > start else np.zeros(0, dtype=np.int64)
+        if not as_mask:
+            return rows
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def write(self, field_group):
+        """
+        Write the index to 'field_group', replacing any existing sorted index.
+        """
+        if SORTED_INDEX_NAME in field_group.keys():
+            del field_group[SORTED_INDEX_NAME]
+        ig = field_group.create_group(SORTED_INDEX_NAME)
+        ig.attrs['version'] = self.version
+        ig.attrs['length'] = len(self)
+        ig.create_dataset('sorted_values', data=self.sorted_values)
+        ig.create_dataset('order', data=self.order)
+        ig.create_dataset('fences', data=self.fences)
+
+
+def build_sorted_index(field_group):
+    """
+    Build a sorted index for a numeric or timestamp field.
+    :param field_group: the hdf5 group of the field to be indexed
+    :return: a SortedIndex
+    """
+    if not _is_orderable(field_group):
+        raise ValueError("sorted indices can only be built for numeric or timestamp fields, "
+                         "but {} is {}".format(field_group.name, field_group.attrs['fieldtype']))
+    values = field_group['values'][:]
+    order = np.argsort(values, kind='stable').astype(np.int64)
+    sorted_values = values[order]
+    return SortedIndex(sorted_values, order, sorted_values[::SORTED_INDEX_BLOCK],
+                       fields.field_version(field_group))
+
+
+def read_sorted_index(field_group):
+    """
+    Open the sorted index stored with a field, returning None if the field has no sorted
+    index or the index is out of date.
+    """
+    if SORTED_INDEX_NAME not in field_group.keys():
+        return None
+    ig = field_group[SORTED_INDEX_NAME]
+    if not index_is_current(field_group, ig):
+        return None
+    return SortedIndex(ig['sorted_values'], ig['order'], ig['fences'], ig.attrs['version'])
+
+
+# foreign key indices
+# ===================
+
+FOREIGN_KEY_INDEX_NAME = 'foreign_key_index'
+
+
+def _read_keys(field_group, start, end):
+    if _is_indexed_string(field_group):
+        indices = field_group['index'][start:end + 1]
+        values = field_group['values'][indices[0]:indices[-1]]
+        return ops.fixed_width_keys(
+            ops.decode_strings(indices - indices[0], values, as_bytes=True))
+    return field_group['values'][start:end]
+
+
+def _key_dtype(field_group, chunksize=ops.DEFAULT_CHUNKSIZE):
+    # the keys of indexed strings are read as bytes as wide as the longest key, which is
+    # found from the index a chunk at a time
+    if not _is_indexed_string(field_group):
+        return field_group['values'].dtype
+    width = 1
+    for c in ops.chunks(field_length(field_group), chunksize):
+        lengths = np.diff(field_group['index'][c[0]:c[1] + 1])
+        width = max(width, int(lengths.max()) if len(lengths) > 0 else 0)
+    return np.dtype('S{}'.format(width))
+
+
+class ForeignKeyIndex:
+    """
+    The relationship between a foreign key and the primary key that it references. For
+    each row of the foreign key, 'parent_rows' holds the row of the primary key with the
+    same value, or INVALID_INDEX if there is none; for each row of the primary key, the
+    rows of the foreign key that reference it are child_order[spans[i]:spans[i+1]].
+    :param parent_rows: the primary key row of each foreign key row
+    :param child_order: the foreign key rows, ordered by the primary key row that they
+    reference. Unmatched rows come last
+    :param spans: the spans of 'child_order' for each primary key row
+    :param parent: the name of the primary key field
+    """
+    def __init__(self, parent_rows, child_order, spans, parent):
+        self.parent_rows = parent_rows
+        self.child_order = child_order
+        self.spans = spans
+        self.parent = parent
+
+    def orphan_count(self):
+        return len(self.parent_rows) - int(self.spans[-1])
+
+    def join_maps(self, how, child_is_left):
+        """
+        Generate the maps of a join of the foreign key and primary key, with the same
+        row order as the corresponding hash join.
+        :param how: 'left', 'right' or 'inner'
+        :param child_is_left: whether the foreign key is the left key of the join
+        :return: a tuple of (left_map, right_map)
+        """
+        parent_rows = self.parent_rows[:]
+        spans = self.spans[:]
+        if how == 'inner':
+            if child_is_left:
+                children = np.flatnonzero(parent_rows != ops.INVALID_INDEX)
+                parents = parent_rows[children]
+            else:
+                parents = np.repeat(np.arange(len(spans) - 1, dtype=np.int64), np.diff(spans))
+                children = self.child_order[:spans[-1]]
+        elif (how == 'left') == child_is_left:
+            children = np.arange(len(parent_rows), dtype=np.int64)
+            parents = parent_rows
+        else:
+            # every primary key row appears, with one row for each row that references it
+            counts = np.diff(spans)
+            out_counts = np.maximum(counts, 1)
+            out_starts = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(out_counts, out=out_starts[1:])
+            parents = np.repeat(np.arange(len(counts), dtype=np.int64), out_counts)
+            children = np.full(out_starts[-1], ops.INVALID_INDEX, dtype=np.int64)
+            positions = np.arange(spans[-1], dtype=np.int64) + \
+                np.repeat(out_starts[:-1] - spans[:-1], counts)
+            children[positions] = self.child_order[:spans[-1]]
+        return (children, parents) if child_is_left else (parents, children)
+
+    def write(self, fk_group, pk_group):
+        """
+        Write the index to the foreign key's group, replacing any existing foreign key
+        index.
+        """
+        if FOREIGN_KEY_INDEX_NAME in fk_group.keys():
+            del fk_group[FOREIGN_KEY_INDEX_NAME]
+        ig = fk_group.create_group(FOREIGN_KEY_INDEX_NAME)
+        ig.attrs['version'] = fields.field_version(fk_group)
+        ig.attrs['length'] = len(self.parent_rows)
+        ig.attrs['parent'] = pk_group.name
+        ig.attrs['parent_version'] = fields.field_version(pk_group)
+        ig.attrs['parent_length'] = field_length(pk_group)
+        ig.create_dataset('parent_rows', data=self.parent_rows)
+        ig.create_dataset('child_order', data=self.child_order)
+        ig.create_dataset('spans', data=self.spans)
+
+
+def build_foreign_key_index(fk_group, pk_group, chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Build the index of a foreign key on the primary key that it references, matching the
+    keys once with a hash table of the primary key that the foreign key is streamed
+    through.
+    :param fk_group: the hdf5 group of the foreign key field
+    :param pk_group: the hdf5 group of the primary key field
+    :return: a ForeignKeyIndex
+    """
+    parent_length = field_length(pk_group)
+    pk = _read_keys(pk_group, 0, parent_length)
+    fk_length = field_length(fk_group)
+    dtype = ops.common_key_dtype(pk.dtype, _key_dtype(fk_group, chunksize))
+    join_index = ops.HashJoinIndex(pk, dtype)
+    if len(join_index.table) != parent_length:
+        raise ValueError("'{}' has duplicate values so can't be used as a primary "
+                         "key".format(pk_group.name))
+    parent_rows = np.full(fk_length, ops.INVALID_INDEX, dtype=np.int64)
+    for c in ops.chunks(fk_length, chunksize):
+        probe_map, build_map, _ = join_index.probe(_read_keys(fk_group, c[0], c[1]), 'left')
+        parent_rows[c[0] + probe_map] = build_map
+    child_order = np.argsort(parent_rows, kind='stable').astype(np.int64)
+    counts = np.bincount(parent_rows[parent_rows != ops.INVALID_INDEX],
+                         minlength=parent_length)
+    spans = np.zeros(parent_length + 1, dtype=np.int64)
+    np.cumsum(counts, out=spans[1:])
+    return ForeignKeyIndex(parent_rows, child_order, spans, pk_group.name)
+
+
+def read_foreign_key_index(fk_group, pk_group=None):
+    """
+    Read the foreign key index stored with a foreign key, returning None if there is no
+    index, it references a different primary key to 'pk_group', or either key has
+    changed since it was built.
+    """
+    if FOREIGN_KEY_INDEX_NAME not in fk_group.keys():
+        return None
+    ig = fk_group[FOREIGN_KEY_INDEX_NAME]
+    if pk_group is None:
+        if ig.attrs['parent'] not in fk_group.file:
+            return None
+        pk_group = fk_group.file[ig.attrs['parent']]
+    if ig.attrs['parent'] != pk_group.name or not index_is_current(fk_group, ig):
+        return None
+    if ig.attrs['parent_version'] != fields.field_version(pk_group) or \
+            ig.attrs['parent_length'] != field_length(pk_group):
+        return None
+    return ForeignKeyIndex(ig['parent_rows'][:], ig['child_order'][:], ig['spans'][:],
+                           ig.attrs['parent'])
@@ -0,0 +1,169 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+
+import numpy as np
+
+from exetera.core import fields
+from exetera.core import operations as ops
+
+
+JOIN_TYPES = ('left', 'right', 'inner', 'outer')
+
+
+def key_checksum(key, chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Calculate a checksum of the contents of a key, reading it a chunk at a time.
+    :param key: a field or ndarray of keys
+    :return: the checksum as a hex string
+    """
+    checksum = hashlib.blake2b(digest_size=16)
+    length = len(key.data) if isinstance(key, fields.Field) else len(key)
+    for c in ops.chunks(length, chunksize):
+        chunk = key.data[c[0]:c[1]] if isinstance(key, fields.Field) else key[c[0]:c[1]]
+        checksum.update(np.ascontiguousarray(ops.fixed_width_keys(chunk)).tobytes())
+    return checksum.hexdigest()
+
+
+def key_version(key, chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Get a value that changes whenever the contents of a key change. This is the version
+    of a field, which is read without reading the field itself, or a checksum of the
+    contents of an ndarray.
+    :param key: a field or ndarray of keys
+    :return: the version as a string
+    """
+    if isinstance(key, fields.Field):
+        return fields.field_version(key._field)
+    return key_checksum(key, chunksize)
+
+
+def key_identity(key, chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Generate the identity of a key: its name (if it is a field), its length and its
+    version, as generated by 'key_version'.
+    :param key: a field or ndarray of keys
+    :return: a tuple of (name, length, version)
+    """
+    name = key.name if isinstance(key, fields.Field) else ''
+    length = len(key.data) if isinstance(key, fields.Field) else len(key)
+    return name, length, key_version(key, chunksize)
+
+
+class JoinMap:
+    """
+    The maps generated by matching the keys of a join, so that they can be applied to any
+    number of fields in separate merge calls without repeating the key matching.
+    Each row of the join result has an entry in 'left_map' and 'right_map'; rows that have
+    no corresponding left or right key have INVALID_INDEX in that map.
+    A join map records the identity of the keys that it was generated from, and is only
+    accepted by merge calls whose keys have the same identity.
+    :param how: the type of join; one of 'left', 'right', 'inner' or 'outer'
+    :param left_map: a field or ndarray mapping the join result to the left key
+    :param right_map: a field or ndarray mapping the join result to the right key
+    :param left_identity: the identity of the left key, as generated by 'key_identity'
+    :param right_identity: the identity of the right key, as generated by 'key_identity'
+    """
+    def __init__(self, how, left_map, right_map, left_identity, right_identity):
+        if how not in JOIN_TYPES:
+            raise ValueError("'how' must be one of {} but is {}".format(JOIN_TYPES, how))
+        self.how = how
+        self.left_map = left_map
+        self.right_map = right_map
+        self.left_identity = tuple(left_identity)
+        self.right_identity = tuple(right_identity)
+
+    def __len__(self):
+        return len(self.left_map.data) if isinstance(self.left_map, fields.Field) \
+            else len(self.left_map)
+
+    def is_persisted(self):
+        return isinstance(self.left_map, fields.Field)
+
+    def maps(self, start, end):
+        """
+        Get the left and right maps for rows 'start' to 'end' of the join result.
+        """
+        if self.is_persisted():
+            return self.left_map.data[start:end], self.right_map.data[start:end]
+        return self.left_map[start:end], self.right_map[start:end]
+
+    def matches(self, left_on, right_on, chunksize=ops.DEFAULT_CHUNKSIZE):
+        """
+        Determine whether the join map was generated from keys with the same identity as
+        'left_on' and 'right_on'. Keys that are fields are compared by name, length and
+        field version, so they are not read; keys that are ndarrays only have their length
+        and checksum compared.
+        """
+        for identity, key in ((self.left_identity, left_on), (self.right_identity, right_on)):
+            name, length, version = key_identity(key, chunksize)
+            if name != '' and identity[0] != '' and name != identity[0]:
+                return False
+            if length != identity[1] or version != identity[2]:
+                return False
+        return True
+
+    def validate(self, how, left_on, right_on, chunksize=ops.DEFAULT_CHUNKSIZE):
+        """
+        Raise a ValueError if the join map can't be used for a join of type 'how' on the
+        keys 'left_on' and 'right_on'.
+        """
+        if how != self.how:
+            msg = "the join map is for a '{}' join but a '{}' join was requested"
+            raise ValueError(msg.format(self.how, how))
+        if not self.matches(left_on, right_on, chunksize):
+            raise ValueError("the join map was generated from different keys, or the keys "
+                             "have changed since it was generated")
+
+    def write(self, session, group):
+        """
+        Write the join map to 'group', returning a join map that is backed by the fields
+        written to the group.
+        :param session: the session used to create the map fields
+        :param group: the group to which the join map is written
+        :return: the persisted JoinMap
+        """
+        left_map = session.create_numeric(group, 'left_map', 'int64')
+        right_map = session.create_numeric(group, 'right_map', 'int64')
+        for src, dest in ((self.left_map, left_map), (self.right_map, right_map)):
+            if isinstance(src, fields.Field):
+                for c in ops.chunks(len(src.data), session.chunksize):
+                    dest.data.write_part(src.data[c[0]:c[1]])
+                dest.data.complete()
+            else:
+                dest.data.write(src)
+        write_join_map_attrs(group, self.how, self.left_identity, self.right_identity)
+        return JoinMap(self.how, left_map, right_map, self.left_identity, self.right_identity)
+
+
+def write_join_map_attrs(group, how, left_identity, right_identity):
+    group.attrs['joinmap'] = how
+    for side, identity in (('left', left_identity), ('right', right_identity)):
+        group.attrs['{}_key_name'.format(side)] = identity[0]
+        group.attrs['{}_key_length'.format(side)] = identity[1]
+        group.attrs['{}_key_version'.format(side)] = identity[2]
+
+
+def read_join_map(session, group):
+    """
+    Read a join map that has been written to 'group'.
+    """
+    if 'joinmap' not in group.attrs.keys():
+        raise ValueError("'{}' does not contain a join map".format(group.name))
+    identities = list()
+    for side in ('left', 'right'):
+        identities.append((group.attrs['{}_key_name'.format(side)],
+                           int(group.attrs['{}_key_length'.format(side)]),
+                           group.attrs['{}_key_version'.format(side)]))
+    return JoinMap(group.attrs['joinmap'],
+                   session.get(group['left_map']), session.get(group['right_map']),
+                   identities[0], identities[1])
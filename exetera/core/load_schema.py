@@ -12,7 +12,9 @@ class NewDataSchema:
         if verbosity > 1:
             print(name)
         primary_keys = schema_dict.get('primary_keys', None)
+        self.primary_keys_ = list() if primary_keys is None else list(primary_keys)
         foreign_keys = schema_dict.get('foreign_keys', None)
+        self.foreign_keys_ = dict() if foreign_keys is None else dict(foreign_keys)
         fields = schema_dict.get('fields', None)
         self.permitted_numeric_types = ('float32', 'float64', 'bool', 'int8', 'uint8', 'int16', 'uint16', 'int32',
                                         'uint32', 'int64')
@@ -25,6 +27,14 @@ class NewDataSchema:
     def name(self):
         return self.name_
 
+    @property
+    def primary_keys(self):
+        return self.primary_keys_
+
+    @property
+    def foreign_keys(self):
+        return self.foreign_keys_
+
     @property
     def fields(self):
         return copy.deepcopy(self._field_entries)
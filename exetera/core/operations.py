@@ -1,6 +1,6 @@
 from datetime import datetime
 import numpy as np
-from numba import jit, njit
+from numba import jit, njit, prange
 import numba
 from numba.typed import List
 
@@ -687,6 +687,38 @@ def ordered_outer_map_result_size_both_unique(left, right):
     return result_size
 
 
+@njit
+def ordered_outer_map_both_unique(left, right, left_to_outer, right_to_outer):
+    i = 0
+    j = 0
+    cur_m = 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            left_to_outer[cur_m] = i
+            right_to_outer[cur_m] = INVALID_INDEX
+            i += 1
+        elif left[i] > right[j]:
+            left_to_outer[cur_m] = INVALID_INDEX
+            right_to_outer[cur_m] = j
+            j += 1
+        else:
+            left_to_outer[cur_m] = i
+            right_to_outer[cur_m] = j
+            i += 1
+            j += 1
+        cur_m += 1
+    while i < len(left):
+        left_to_outer[cur_m] = i
+        right_to_outer[cur_m] = INVALID_INDEX
+        i += 1
+        cur_m += 1
+    while j < len(right):
+        left_to_outer[cur_m] = INVALID_INDEX
+        right_to_outer[cur_m] = j
+        j += 1
+        cur_m += 1
+
+
 @njit
 def ordered_inner_map_both_unique(left, right, left_to_inner, right_to_inner):
     i = 0
@@ -1155,3 +1187,2526 @@ def is_ordered(field):
     else:
         fn = np.char.greater
     return not np.any(fn(field[:-1], field[1:]))
+
+
+# hashing of fixed-width keys
+# ===========================
+
+FNV_OFFSET_BASIS = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+def key_rows(keys, dtype=None):
+    """
+    View an array of fixed-width keys (integers, floats, fixed-width strings) as a two
+    dimensional array of bytes, one row per key, so that keys of any fixed-width type can
+    be hashed and compared by compiled code.
+    :param keys: the ndarray of keys
+    :param dtype: optional - the dtype to convert the keys to before they are viewed
+    :return: a uint8 array of shape (len(keys), itemsize)
+    """
+    keys = np.ascontiguousarray(keys if dtype is None else as_key_dtype(keys, dtype))
+    return keys.view(np.uint8).reshape(len(keys), keys.dtype.itemsize)
+
+
+def fixed_width_keys(keys):
+    """
+    Convert keys held in a list or object array (such as the strings of an indexed string
+    field, or variable-length byte strings read from hdf5) to a fixed-width array so that
+    they can be viewed with 'key_rows'. Strings are encoded as utf-8 bytes, so that they
+    compare equal to the same keys held in fixed-length string fields.
+    """
+    if isinstance(keys, np.ndarray):
+        if keys.dtype.kind == 'U':
+            return np.char.encode(keys, 'utf-8')
+        if not keys.dtype.hasobject:
+            return keys
+        keys = keys.tolist()
+    keys = [k.encode() if isinstance(k, str) else k for k in keys]
+    if len(keys) == 0:
+        return np.zeros(0, dtype='S1')
+    return np.asarray(keys)
+
+
+# signed and uint64 keys have no common integer type, and promoting them to float would
+# make large keys collide. They are instead compared as 9 bytes: a flag that is zero for
+# negative keys, so that they can't match an unsigned key, followed by the big-endian
+# 64-bit value. Byte order of the encoding follows the numeric order of the keys
+MIXED_SIGN_KEY_DTYPE = np.dtype('S9')
+
+
+def common_key_dtype(*dtypes):
+    """
+    Get the dtype that keys of the given dtypes should be converted to so that they can
+    be compared byte for byte. Keys should be converted to it with 'as_key_dtype'.
+    """
+    dtypes = [np.dtype(d) for d in dtypes]
+    dtype = np.result_type(*dtypes)
+    if dtype.kind == 'f' and {d.kind for d in dtypes} == {'i', 'u'}:
+        return MIXED_SIGN_KEY_DTYPE
+    return dtype
+
+
+def as_key_dtype(keys, dtype):
+    """
+    Convert keys to a dtype returned by 'common_key_dtype'.
+    :param keys: the ndarray of keys
+    :param dtype: the dtype to convert the keys to
+    :return: an ndarray of the converted keys
+    """
+    dtype = np.dtype(dtype)
+    if dtype == MIXED_SIGN_KEY_DTYPE and keys.dtype.kind in 'iu':
+        rows = np.zeros((len(keys), dtype.itemsize), dtype=np.uint8)
+        rows[:, 0] = keys >= 0
+        rows[:, 1:] = keys.astype('>u8').view(np.uint8).reshape(len(keys), 8)
+        return rows.view(dtype).reshape(len(keys))
+    return keys.astype(dtype, copy=False)
+
+
+@njit
+def hash_key_rows(rows, hashes):
+    # FNV-1a over the bytes of each key followed by a murmur-style finalizer
+    for i in range(rows.shape[0]):
+        h = FNV_OFFSET_BASIS
+        for b in range(rows.shape[1]):
+            h ^= np.uint64(rows[i, b])
+            h *= FNV_PRIME
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xff51afd7ed558ccd)
+        h ^= h >> np.uint64(33)
+        hashes[i] = h
+    return hashes
+
+
+@njit
+def _key_rows_equal(first, second):
+    for b in range(len(first)):
+        if first[b] != second[b]:
+            return False
+    return True
+
+
+@njit
+def _hash_table_find(slots, key_store, entry_hashes, row, h):
+    mask = len(slots) - 1
+    pos = np.int64(h & np.uint64(mask))
+    while True:
+        e = slots[pos]
+        if e == -1:
+            return e, pos
+        if entry_hashes[e] == h and _key_rows_equal(key_store[e], row):
+            return e, pos
+        pos = (pos + 1) & mask
+
+
+@njit
+def _hash_table_rehash(slots, entry_hashes, count):
+    mask = len(slots) - 1
+    for e in range(count):
+        pos = np.int64(entry_hashes[e] & np.uint64(mask))
+        while slots[pos] != -1:
+            pos = (pos + 1) & mask
+        slots[pos] = e
+
+
+@njit
+def _hash_table_insert(slots, key_store, entry_hashes, entry_values, count,
+                       rows, hashes, values):
+    for i in range(len(rows)):
+        e, pos = _hash_table_find(slots, key_store, entry_hashes, rows[i], hashes[i])
+        if e == -1:
+            key_store[count] = rows[i]
+            entry_hashes[count] = hashes[i]
+            entry_values[count] = values[i]
+            slots[pos] = count
+            count += 1
+        else:
+            entry_values[e] = values[i]
+    return count
+
+
+@njit
+def _hash_table_get_or_insert(slots, key_store, entry_hashes, entry_values, count,
+                              rows, hashes, value_offset, entries):
+    for i in range(len(rows)):
+        e, pos = _hash_table_find(slots, key_store, entry_hashes, rows[i], hashes[i])
+        if e == -1:
+            e = count
+            key_store[e] = rows[i]
+            entry_hashes[e] = hashes[i]
+            entry_values[e] = e + value_offset
+            slots[pos] = e
+            count += 1
+        entries[i] = e
+    return count
+
+
+@njit
+def _hash_table_lookup(slots, key_store, entry_hashes, rows, hashes, entries):
+    for i in range(len(rows)):
+        e, pos = _hash_table_find(slots, key_store, entry_hashes, rows[i], hashes[i])
+        entries[i] = e
+    return entries
+
+
+class HashTable:
+    """
+    An open-addressing hash table over fixed-width keys, implemented with compiled kernels.
+    Each distinct key is stored once as an 'entry'; entries are numbered in the order in
+    which their keys were first inserted and carry an int64 value.
+    :param dtype: the dtype of the keys that the table holds. Keys passed to the table
+    are converted to this dtype
+    :param capacity: optional - the number of entries to reserve space for
+    """
+    def __init__(self, dtype, capacity=16):
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        capacity = max(capacity, 16)
+        self._keys = np.zeros((capacity, self.dtype.itemsize), dtype=np.uint8)
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._values = np.zeros(capacity, dtype=np.int64)
+        self._slots = np.full(self._slot_count(capacity), -1, dtype=np.int64)
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _slot_count(entry_count):
+        # keep the load factor at or below 0.5
+        slot_count = 16
+        while slot_count < entry_count * 2:
+            slot_count <<= 1
+        return slot_count
+
+    def _reserve(self, extra):
+        required = self.count + extra
+        if required > len(self._hashes):
+            capacity = max(required, len(self._hashes) * 2)
+            keys = np.zeros((capacity, self._keys.shape[1]), dtype=np.uint8)
+            keys[:self.count] = self._keys[:self.count]
+            hashes = np.zeros(capacity, dtype=np.uint64)
+            hashes[:self.count] = self._hashes[:self.count]
+            values = np.zeros(capacity, dtype=np.int64)
+            values[:self.count] = self._values[:self.count]
+            self._keys, self._hashes, self._values = keys, hashes, values
+        if required * 2 > len(self._slots):
+            self._slots = np.full(self._slot_count(len(self._hashes)), -1, dtype=np.int64)
+            _hash_table_rehash(self._slots, self._hashes, self.count)
+
+    def _rows_and_hashes(self, keys):
+        rows = key_rows(np.asarray(keys), self.dtype)
+        return rows, hash_key_rows(rows, np.zeros(len(rows), dtype=np.uint64))
+
+    def insert(self, keys, values):
+        """
+        Insert keys with their corresponding values. If a key is already present, its
+        value is overwritten, so the last value inserted for a given key is retained.
+        """
+        rows, hashes = self._rows_and_hashes(keys)
+        self._reserve(len(rows))
+        self.count = _hash_table_insert(self._slots, self._keys, self._hashes, self._values,
+                                        self.count, rows, hashes,
+                                        np.asarray(values, dtype=np.int64))
+
+    def get_or_insert(self, keys, value_offset=0):
+        """
+        Get the entry number for each key, inserting keys that are not yet present. Newly
+        inserted entries are given the value 'entry number + value_offset'.
+        :return: an int64 array of entry numbers, one per key
+        """
+        rows, hashes = self._rows_and_hashes(keys)
+        self._reserve(len(rows))
+        entries = np.zeros(len(rows), dtype=np.int64)
+        self.count = _hash_table_get_or_insert(self._slots, self._keys, self._hashes,
+                                               self._values, self.count, rows, hashes,
+                                               value_offset, entries)
+        return entries
+
+    def lookup(self, keys):
+        """
+        Get the entry number for each key, or -1 for keys that are not present.
+        """
+        rows, hashes = self._rows_and_hashes(keys)
+        entries = np.zeros(len(rows), dtype=np.int64)
+        return _hash_table_lookup(self._slots, self._keys, self._hashes, rows, hashes, entries)
+
+    @property
+    def keys(self):
+        """The distinct keys held by the table, in entry order"""
+        return self._keys[:self.count].copy().view(self.dtype).reshape(self.count)
+
+    @property
+    def values(self):
+        """The values held by the table, in entry order"""
+        return self._values[:self.count]
+
+
+@njit
+def _hash_bytes(values, start, end):
+    h = FNV_OFFSET_BASIS
+    for i in range(start, end):
+        h ^= np.uint64(values[i])
+        h *= FNV_PRIME
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    return h
+
+
+@njit
+def _string_table_find(slots, hashes, offsets, key_bytes, values, start, end, h):
+    # returns the entry for the string, or -(slot + 1) for the empty slot it belongs in
+    mask = np.uint64(len(slots) - 1)
+    slot = h & mask
+    length = end - start
+    while True:
+        entry = slots[slot]
+        if entry == -1:
+            return -np.int64(slot) - 1
+        if hashes[entry] == h and offsets[entry + 1] - offsets[entry] == length:
+            equal = True
+            o = offsets[entry]
+            for b in range(length):
+                if key_bytes[o + b] != values[start + b]:
+                    equal = False
+                    break
+            if equal:
+                return entry
+        slot = (slot + np.uint64(1)) & mask
+
+
+@njit
+def _string_table_get_or_insert(slots, hashes, offsets, key_bytes, count, indices, values,
+                                entries):
+    for i in range(len(indices) - 1):
+        start, end = indices[i], indices[i + 1]
+        h = _hash_bytes(values, start, end)
+        entry = _string_table_find(slots, hashes, offsets, key_bytes, values, start, end, h)
+        if entry < 0:
+            slots[-entry - 1] = count
+            hashes[count] = h
+            o = offsets[count]
+            for b in range(end - start):
+                key_bytes[o + b] = values[start + b]
+            offsets[count + 1] = o + end - start
+            entry = count
+            count += 1
+        entries[i] = entry
+    return count
+
+
+@njit
+def _string_table_lookup(slots, hashes, offsets, key_bytes, indices, values, entries):
+    for i in range(len(indices) - 1):
+        start, end = indices[i], indices[i + 1]
+        h = _hash_bytes(values, start, end)
+        entry = _string_table_find(slots, hashes, offsets, key_bytes, values, start, end, h)
+        entries[i] = entry if entry >= 0 else -1
+    return entries
+
+
+@njit
+def hash_indexed_strings(indices, values, hashes):
+    # hash each string of an indexed string chunk with the same function as StringTable
+    for i in range(len(indices) - 1):
+        hashes[i] = _hash_bytes(values, indices[i], indices[i + 1])
+    return hashes
+
+
+def encode_strings(strings):
+    """
+    Encode a sequence of strings (or bytes) as the index and value arrays of an indexed
+    string.
+    """
+    encoded = [s.encode() if isinstance(s, str) else bytes(s) for s in strings]
+    indices = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=indices[1:])
+    return indices, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def decode_strings(indices, values, as_bytes=False):
+    """
+    Decode the index and value arrays of an indexed string into an object array of str
+    (or of bytes, if 'as_bytes' is set).
+    """
+    values = np.asarray(values).view(np.uint8)
+    results = np.empty(len(indices) - 1, dtype=object)
+    for i in range(len(indices) - 1):
+        value = values[indices[i]:indices[i + 1]].tobytes()
+        results[i] = value if as_bytes else value.decode()
+    return results
+
+
+class StringTable:
+    """
+    An open-addressing hash table over variable-length strings, held as the index and
+    value buffers of indexed strings. Each distinct string is stored once as an 'entry';
+    entries are numbered in the order in which they were first inserted.
+    """
+    def __init__(self, capacity=16):
+        self.count = 0
+        capacity = max(capacity, 16)
+        self._hashes = np.zeros(capacity, dtype=np.uint64)
+        self._offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._bytes = np.zeros(capacity * 8, dtype=np.uint8)
+        self._slots = np.full(HashTable._slot_count(capacity), -1, dtype=np.int64)
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, extra_entries, extra_bytes):
+        required = self.count + extra_entries
+        if required > len(self._hashes):
+            capacity = max(required, len(self._hashes) * 2)
+            hashes = np.zeros(capacity, dtype=np.uint64)
+            hashes[:self.count] = self._hashes[:self.count]
+            offsets = np.zeros(capacity + 1, dtype=np.int64)
+            offsets[:self.count + 1] = self._offsets[:self.count + 1]
+            self._hashes, self._offsets = hashes, offsets
+        required_bytes = self._offsets[self.count] + extra_bytes
+        if required_bytes > len(self._bytes):
+            key_bytes = np.zeros(max(required_bytes, len(self._bytes) * 2), dtype=np.uint8)
+            key_bytes[:self._offsets[self.count]] = self._bytes[:self._offsets[self.count]]
+            self._bytes = key_bytes
+        if required * 2 > len(self._slots):
+            self._slots = np.full(HashTable._slot_count(len(self._hashes)), -1, dtype=np.int64)
+            _hash_table_rehash(self._slots, self._hashes, self.count)
+
+    @staticmethod
+    def _buffers(indices, values):
+        indices = np.asarray(indices, dtype=np.int64)
+        return indices - indices[0], np.asarray(values).view(np.uint8)
+
+    def get_or_insert(self, indices, values):
+        """
+        Get the entry number for each string, inserting strings that are not yet present.
+        :param indices: the index array of the strings
+        :param values: the value array of the strings
+        :return: an int64 array of entry numbers, one per string
+        """
+        indices, values = self._buffers(indices, values)
+        self._reserve(len(indices) - 1, indices[-1])
+        entries = np.zeros(len(indices) - 1, dtype=np.int64)
+        self.count = _string_table_get_or_insert(self._slots, self._hashes, self._offsets,
+                                                 self._bytes, self.count, indices, values,
+                                                 entries)
+        return entries
+
+    def lookup(self, indices, values):
+        """
+        Get the entry number for each string, or -1 for strings that are not present.
+        """
+        indices, values = self._buffers(indices, values)
+        entries = np.zeros(len(indices) - 1, dtype=np.int64)
+        return _string_table_lookup(self._slots, self._hashes, self._offsets, self._bytes,
+                                    indices, values, entries)
+
+    def strings(self, entries=None):
+        """
+        Get the strings of the given entries (or of all entries, in entry order) as the
+        index and value arrays of an indexed string.
+        """
+        offsets = self._offsets[:self.count + 1]
+        key_bytes = self._bytes[:offsets[-1]]
+        if entries is None:
+            return offsets.copy(), key_bytes.copy()
+        return apply_indices_to_index_values(np.asarray(entries, dtype=np.int64),
+                                             offsets, key_bytes)
+
+
+# foreign key indices
+# ===================
+
+def _get_index_table(target, dtype, chunksize=DEFAULT_CHUNKSIZE):
+    table = HashTable(dtype, _key_length(target))
+    for c in chunks(_key_length(target), chunksize):
+        table.insert(fixed_width_keys(_key_chunk(target, c[0], c[1])),
+                     np.arange(c[0], c[1], dtype=np.int64))
+    return table
+
+
+@njit
+def _get_index_assign(entries, entry_values, target_count, missing_count, indices):
+    # the invalid counter advances on every unmatched key, including repeats, while each
+    # missing key keeps the invalid index it was given when it was first seen
+    for i in range(len(entries)):
+        e = entries[i]
+        if e >= target_count:
+            if entry_values[e] < INVALID_INDEX:
+                entry_values[e] = INVALID_INDEX + missing_count
+            missing_count += 1
+        indices[i] = entry_values[e]
+    return missing_count
+
+
+def _get_index_partial(table, target_count, missing_count, foreign_key):
+    entries = table.get_or_insert(foreign_key)
+    indices = np.zeros(len(entries), dtype=np.int64)
+    missing_count = _get_index_assign(entries, table.values, target_count, missing_count,
+                                      indices)
+    return indices, missing_count
+
+
+def get_index(target, foreign_key):
+    """
+    Map each element of 'foreign_key' to the index of the element of 'target' with the
+    same value. If 'target' has duplicate values, the last index for that value is used.
+    Foreign key values that are not present in 'target' are given distinct invalid
+    indices, starting at INVALID_INDEX and incrementing for each missing foreign key
+    value, including repeated ones. A repeated missing value keeps the invalid index it
+    was first given.
+    :param target: an ndarray of keys to map to
+    :param foreign_key: an ndarray of keys to be mapped
+    :return: an int64 ndarray of indices into 'target'
+    """
+    target = fixed_width_keys(target)
+    foreign_key = fixed_width_keys(foreign_key)
+    dtype = common_key_dtype(target.dtype, foreign_key.dtype)
+    table = _get_index_table(target, dtype)
+    return _get_index_partial(table, table.count, 0, foreign_key)[0]
+
+
+def get_index_streamed(target, foreign_key, destination, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Perform 'get_index', reading the foreign key field in chunks and writing the resulting
+    indices to the 'destination' field as they are generated. Only the hash table for the
+    target keys and one chunk of the foreign key are held in memory at any time.
+    :param target: a field or ndarray of keys to map to
+    :param foreign_key: a field of keys to be mapped
+    :param destination: a field to which the int64 indices are written
+    """
+    dtype = common_key_dtype(key_dtype(target, chunksize), key_dtype(foreign_key, chunksize))
+    table = _get_index_table(target, dtype, chunksize)
+    target_count = table.count
+    missing_count = 0
+    for c in chunks(len(foreign_key.data), chunksize):
+        indices, missing_count = _get_index_partial(
+            table, target_count, missing_count,
+            fixed_width_keys(foreign_key.data[c[0]:c[1]]))
+        destination.data.write_part(indices)
+    destination.data.complete()
+
+
+# shared indices
+# ==============
+
+def _key_chunk(key, start, end):
+    return key.data[start:end] if isinstance(key, fields.Field) else key[start:end]
+
+
+def _key_length(key):
+    return len(key.data) if isinstance(key, fields.Field) else len(key)
+
+
+def key_dtype(key, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Get the fixed-width dtype of a field or ndarray of keys. The keys of an indexed string
+    field are given a bytes dtype that is wide enough for its longest key, which is found
+    by reading the field's index a chunk at a time.
+    """
+    if isinstance(key, fields.IndexedStringField):
+        width = 1
+        for c in chunks(len(key.data), chunksize):
+            lengths = np.diff(key.indices[c[0]:c[1] + 1])
+            width = max(width, int(lengths.max()) if len(lengths) > 0 else 0)
+        return np.dtype('S{}'.format(width))
+    if isinstance(key, fields.Field):
+        return key.data.dtype
+    return fixed_width_keys(np.asarray(key)).dtype
+
+
+def is_sorted_streamed(key, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Determine whether a field or ndarray of keys is sorted in ascending order, reading it
+    one chunk at a time.
+    """
+    last = None
+    for c in chunks(_key_length(key), chunksize):
+        chunk = _key_chunk(key, c[0], c[1])
+        if len(chunk) == 0:
+            continue
+        if last is not None and chunk[0] < last:
+            return False
+        if np.any(chunk[1:] < chunk[:-1]):
+            return False
+        last = chunk[-1]
+    return True
+
+
+def _get_shared_index_sorted(keys, destinations, chunksize):
+    """
+    Build the shared index of a set of sorted keys by merging them a chunk at a time. Each
+    key has a buffer of pending values; on each step every value below the smallest of the
+    buffer maxima is known to be complete, so the sorted union of those values is appended
+    to the union and the corresponding indices are written out.
+    """
+    key_count = len(keys)
+    lengths = [_key_length(k) for k in keys]
+    positions = [0] * key_count
+    buffers = [_key_chunk(k, 0, 0) for k in keys]
+    offset = 0
+    while True:
+        # refill buffers that are empty or consist of a single repeated value
+        for i in range(key_count):
+            b = buffers[i]
+            if positions[i] < lengths[i] and (len(b) == 0 or b[0] == b[-1]):
+                end = min(positions[i] + chunksize, lengths[i])
+                buffers[i] = np.concatenate((b, _key_chunk(keys[i], positions[i], end)))
+                positions[i] = end
+
+        pending = [i for i in range(key_count) if positions[i] < lengths[i]]
+        if len(pending) == 0:
+            bound = None
+        else:
+            bound = min(buffers[i][-1] for i in pending)
+
+        parts = list()
+        for i in range(key_count):
+            b = buffers[i]
+            count = len(b) if bound is None else np.searchsorted(b, bound, side='left')
+            parts.append(b[:count])
+            buffers[i] = b[count:]
+
+        union = np.unique(np.concatenate(parts))
+        for i in range(key_count):
+            if len(parts[i]) > 0:
+                destinations[i].data.write_part(offset + np.searchsorted(union, parts[i]))
+        offset += len(union)
+
+        if bound is None:
+            break
+
+    for d in destinations:
+        d.data.complete()
+    return offset
+
+
+def get_shared_index_streamed(keys, destinations, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Map each of a sequence of keys to its index in the sorted union of all of the keys,
+    writing the index of each key to the corresponding destination field.
+    If every key is sorted, the keys are merged one chunk at a time so that no key is ever
+    held in memory in its entirety. Otherwise, the sorted union is built from the distinct
+    values of each key and the keys are then mapped to it a chunk at a time.
+    :param keys: a sequence of fields or ndarrays containing keys
+    :param destinations: a sequence of fields, one per key, to which the indices are written
+    :return: the number of distinct keys in the union
+    """
+    if len(keys) != len(destinations):
+        raise ValueError("'keys' and 'destinations' must be of the same length")
+    if all(is_sorted_streamed(k, chunksize) for k in keys):
+        return _get_shared_index_sorted(keys, destinations, chunksize)
+
+    union = None
+    for k in keys:
+        distinct = np.unique(k.data[:] if isinstance(k, fields.Field) else k)
+        union = distinct if union is None else np.union1d(union, distinct)
+    for k, d in zip(keys, destinations):
+        for c in chunks(_key_length(k), chunksize):
+            d.data.write_part(np.searchsorted(union, _key_chunk(k, c[0], c[1])))
+        d.data.complete()
+    return len(union)
+
+
+# hash joins
+# ==========
+
+@njit
+def _group_rows(row_groups, group_count):
+    """
+    Stable counting sort of rows by group, returning the offsets of each group and the
+    rows of each group in their original order. Rows with a negative group are dropped.
+    """
+    offsets = np.zeros(group_count + 1, dtype=np.int64)
+    for i in range(len(row_groups)):
+        if row_groups[i] >= 0:
+            offsets[row_groups[i] + 1] += 1
+    for g in range(group_count):
+        offsets[g + 1] += offsets[g]
+    cursors = offsets[:-1].copy()
+    order = np.zeros(offsets[-1], dtype=np.int64)
+    for i in range(len(row_groups)):
+        g = row_groups[i]
+        if g >= 0:
+            order[cursors[g]] = i
+            cursors[g] += 1
+    return offsets, order
+
+
+@njit
+def _hash_join_maps(left_groups, offsets, order, left_outer):
+    count = 0
+    for i in range(len(left_groups)):
+        g = left_groups[i]
+        matches = 0 if g < 0 else offsets[g + 1] - offsets[g]
+        if matches > 0:
+            count += matches
+        elif left_outer:
+            count += 1
+
+    left_map = np.zeros(count, dtype=np.int64)
+    right_map = np.zeros(count, dtype=np.int64)
+    right_filter = np.zeros(count, dtype=np.bool_)
+    cur = 0
+    for i in range(len(left_groups)):
+        g = left_groups[i]
+        matches = 0 if g < 0 else offsets[g + 1] - offsets[g]
+        if matches > 0:
+            for j in range(offsets[g], offsets[g + 1]):
+                left_map[cur] = i
+                right_map[cur] = order[j]
+                right_filter[cur] = True
+                cur += 1
+        elif left_outer:
+            left_map[cur] = i
+            right_map[cur] = INVALID_INDEX
+            cur += 1
+    return left_map, right_map, right_filter
+
+
+def _hash_join_in_memory(left_keys, right_keys, dtype, left_outer, build):
+    build_keys = left_keys if build == 'left' else right_keys
+    table = HashTable(dtype, capacity=max(len(build_keys), 16))
+    if build == 'left':
+        left_groups = table.get_or_insert(left_keys)
+        right_groups = table.lookup(right_keys)
+    else:
+        right_groups = table.get_or_insert(right_keys)
+        left_groups = table.lookup(left_keys)
+    offsets, order = _group_rows(right_groups, len(table))
+    return _hash_join_maps(left_groups, offsets, order, left_outer)
+
+
+class HashJoinIndex:
+    """
+    The build side of a hash join, which can be probed by any number of chunks of probe
+    keys, such as the chunks of a streamed left key.
+    :param build_keys: the keys of the build side
+    :param dtype: optional - the dtype that keys are compared as; defaults to the dtype
+    of 'build_keys'
+    """
+    def __init__(self, build_keys, dtype=None):
+        build_keys = fixed_width_keys(build_keys)
+        self.dtype = build_keys.dtype if dtype is None else np.dtype(dtype)
+        self.table = HashTable(self.dtype, capacity=max(len(build_keys), 16))
+        groups = self.table.get_or_insert(as_key_dtype(build_keys, self.dtype))
+        self.offsets, self.order = _group_rows(groups, len(self.table))
+
+    def probe(self, keys, how='left'):
+        """
+        Join a chunk of probe keys against the build keys.
+        :param keys: the probe keys
+        :param how: 'left' or 'inner'
+        :return: a tuple of (probe_map, build_map, build_filter) with the same semantics
+        as the left map, right map and right filter of 'hash_join'
+        """
+        if how not in ('left', 'inner'):
+            raise ValueError("'how' must be one of 'left' or 'inner' but is {}".format(how))
+        keys = fixed_width_keys(keys)
+        groups = self.table.lookup(as_key_dtype(keys, self.dtype))
+        return _hash_join_maps(groups, self.offsets, self.order, how == 'left')
+
+
+class KeySet:
+    """
+    A set of keys, such as the keys of the selected rows of a primary key, that chunks of
+    other keys can be tested for membership of. Sorted keys are binary searched; other
+    keys are inserted into a HashTable.
+    :param keys: the keys of the set
+    :param dtype: optional - the dtype that keys are compared as; defaults to the dtype
+    of 'keys'
+    """
+    def __init__(self, keys, dtype=None):
+        keys = fixed_width_keys(np.asarray(keys))
+        self.dtype = keys.dtype if dtype is None else np.dtype(dtype)
+        keys = as_key_dtype(keys, self.dtype)
+        self.is_sorted = len(keys) < 2 or bool(np.all(keys[:-1] <= keys[1:]))
+        if self.is_sorted:
+            self.keys = keys
+        else:
+            self.table = HashTable(self.dtype, capacity=max(len(keys), 16))
+            self.table.get_or_insert(keys)
+
+    def contains(self, keys):
+        """
+        Determine whether each of 'keys' is in the set.
+        :return: a boolean ndarray with an entry for each key
+        """
+        keys = as_key_dtype(fixed_width_keys(np.asarray(keys)), self.dtype)
+        if not self.is_sorted:
+            return self.table.lookup(keys) != -1
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+
+@njit
+def _filter_by_parent_rows(parent_rows, parent_filter, child_filter):
+    for i in range(len(parent_rows)):
+        p = parent_rows[i]
+        child_filter[i] = p < len(parent_filter) and parent_filter[p]
+    return child_filter
+
+
+def filter_by_parent_rows(parent_rows, parent_filter):
+    """
+    Propagate a filter on parent rows to the child rows that reference them.
+    :param parent_rows: the parent row of each child row, with INVALID_INDEX for child
+    rows without a parent
+    :param parent_filter: a boolean filter over the parent rows
+    :return: a boolean filter over the child rows
+    """
+    return _filter_by_parent_rows(parent_rows, np.asarray(parent_filter, dtype=bool),
+                                  np.zeros(len(parent_rows), dtype=bool))
+
+
+def hash_join_partition_count(build_length, itemsize, memory_budget):
+    """
+    Estimate the number of partitions that a hash join must be split into so that the
+    build side hash table of each partition fits within 'memory_budget' bytes.
+    """
+    if memory_budget is None:
+        return 1
+    # key storage + hash + value + slots, plus grouping of the build rows
+    bytes_per_row = itemsize + 8 * 6
+    return max(1, int(np.ceil(build_length * bytes_per_row / memory_budget)))
+
+
+def hash_join(left_keys, right_keys, how='left', build=None, memory_budget=None):
+    """
+    Join two arrays of keys with a hash join, returning the maps from each row of the
+    result to the left and right keys. The rows of the result follow the order of the
+    left keys and, for each left key, the order of the matching right keys, which is the
+    same ordering that pandas.merge produces.
+    Keys can be of any fixed-width dtype, such as integers or fixed-length strings, or
+    lists of strings, such as the keys of indexed string fields.
+    :param left_keys: the left keys
+    :param right_keys: the right keys
+    :param how: 'left' or 'inner'. Right joins are performed by swapping the keys
+    :param build: 'left' or 'right'; the side whose keys are inserted into the hash table.
+    If not set, the side with fewer keys is used
+    :param memory_budget: optional - the number of bytes that the build side hash table
+    may use. If the estimated size exceeds this, both sides are partitioned on the hash
+    of their keys and each partition is joined separately
+    :return: a tuple of (left_map, right_map, left_filter, right_filter). Unmatched
+    entries in the maps are set to INVALID_INDEX and are False in the filters
+    """
+    if how not in ('left', 'inner'):
+        raise ValueError("'how' must be one of 'left' or 'inner' but is {}".format(how))
+    if build is None:
+        build = 'left' if len(left_keys) < len(right_keys) else 'right'
+    if build not in ('left', 'right'):
+        raise ValueError("'build' must be one of 'left' or 'right' but is {}".format(build))
+
+    left_keys = fixed_width_keys(left_keys)
+    right_keys = fixed_width_keys(right_keys)
+    dtype = common_key_dtype(left_keys.dtype, right_keys.dtype)
+    left_keys = as_key_dtype(left_keys, dtype)
+    right_keys = as_key_dtype(right_keys, dtype)
+    left_outer = how == 'left'
+
+    build_length = len(left_keys) if build == 'left' else len(right_keys)
+    partitions = hash_join_partition_count(build_length, dtype.itemsize, memory_budget)
+    if partitions == 1:
+        left_map, right_map, right_filter = \
+            _hash_join_in_memory(left_keys, right_keys, dtype, left_outer, build)
+    else:
+        left_parts = hash_key_rows(key_rows(left_keys),
+                                   np.zeros(len(left_keys), dtype=np.uint64))
+        right_parts = hash_key_rows(key_rows(right_keys),
+                                    np.zeros(len(right_keys), dtype=np.uint64))
+        left_parts = (left_parts >> np.uint64(32)) % np.uint64(partitions)
+        right_parts = (right_parts >> np.uint64(32)) % np.uint64(partitions)
+        left_maps, right_maps, right_filters = list(), list(), list()
+        for p in range(partitions):
+            l_rows = np.nonzero(left_parts == p)[0]
+            r_rows = np.nonzero(right_parts == p)[0]
+            p_left_map, p_right_map, p_right_filter = \
+                _hash_join_in_memory(left_keys[l_rows], right_keys[r_rows], dtype,
+                                     left_outer, build)
+            left_maps.append(l_rows[p_left_map])
+            p_right_map[p_right_filter] = r_rows[p_right_map[p_right_filter]]
+            right_maps.append(p_right_map)
+            right_filters.append(p_right_filter)
+        left_map = np.concatenate(left_maps)
+        # each left row is only present in a single partition, so a stable sort on the left
+        # map restores the unpartitioned order
+        order = np.argsort(left_map, kind='stable')
+        left_map = left_map[order]
+        right_map = np.concatenate(right_maps)[order]
+        right_filter = np.concatenate(right_filters)[order]
+
+    left_filter = np.ones(len(left_map), dtype=bool)
+    return left_map, right_map, left_filter, right_filter
+
+
+# streamed ordered merges
+# =======================
+
+@njit
+def _ordered_merge_partial_size(left, right, left_outer, right_outer):
+    i = 0
+    j = 0
+    count = 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            if left_outer:
+                count += 1
+            i += 1
+        elif left[i] > right[j]:
+            if right_outer:
+                count += 1
+            j += 1
+        else:
+            cur_i = i
+            while cur_i + 1 < len(left) and left[cur_i + 1] == left[cur_i]:
+                cur_i += 1
+            cur_j = j
+            while cur_j + 1 < len(right) and right[cur_j + 1] == right[cur_j]:
+                cur_j += 1
+            count += (cur_i + 1 - i) * (cur_j + 1 - j)
+            i = cur_i + 1
+            j = cur_j + 1
+    if left_outer:
+        count += len(left) - i
+    if right_outer:
+        count += len(right) - j
+    return count
+
+
+@njit
+def _ordered_merge_partial(d_i, d_j, left, right, left_outer, right_outer,
+                           left_map, right_map):
+    """
+    Merge two sorted arrays of keys that may both contain duplicates, writing the
+    positions of the left and right keys for each row of the result. Each run of equal
+    keys produces the product of its left and right rows, ordered by left row and then
+    right row. Rows that are only present on one side are written if the corresponding
+    'outer' flag is set, with INVALID_INDEX in the map of the other side.
+    'left' and 'right' must only contain complete runs of keys; 'd_i' and 'd_j' are the
+    offsets of the arrays in their respective fields.
+    """
+    i = 0
+    j = 0
+    m = 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            if left_outer:
+                left_map[m] = i + d_i
+                right_map[m] = INVALID_INDEX
+                m += 1
+            i += 1
+        elif left[i] > right[j]:
+            if right_outer:
+                left_map[m] = INVALID_INDEX
+                right_map[m] = j + d_j
+                m += 1
+            j += 1
+        else:
+            cur_i = i
+            while cur_i + 1 < len(left) and left[cur_i + 1] == left[cur_i]:
+                cur_i += 1
+            cur_j = j
+            while cur_j + 1 < len(right) and right[cur_j + 1] == right[cur_j]:
+                cur_j += 1
+            for ii in range(i, cur_i + 1):
+                for jj in range(j, cur_j + 1):
+                    left_map[m] = ii + d_i
+                    right_map[m] = jj + d_j
+                    m += 1
+            i = cur_i + 1
+            j = cur_j + 1
+    if left_outer:
+        while i < len(left):
+            left_map[m] = i + d_i
+            right_map[m] = INVALID_INDEX
+            m += 1
+            i += 1
+    if right_outer:
+        while j < len(right):
+            left_map[m] = INVALID_INDEX
+            right_map[m] = j + d_j
+            m += 1
+            j += 1
+    return m
+
+
+def ordered_merge_maps(left, right, left_outer=False, right_outer=False):
+    """
+    Generate the left and right maps of a merge of two sorted arrays of keys, either of
+    which may contain duplicates.
+    :param left: a sorted ndarray of left keys
+    :param right: a sorted ndarray of right keys
+    :param left_outer: whether left keys without a match are included in the result
+    :param right_outer: whether right keys without a match are included in the result
+    :return: a tuple of (left_map, right_map), with INVALID_INDEX for unmatched rows
+    """
+    size = _ordered_merge_partial_size(left, right, left_outer, right_outer)
+    left_map = np.zeros(size, dtype=np.int64)
+    right_map = np.zeros(size, dtype=np.int64)
+    _ordered_merge_partial(0, 0, left, right, left_outer, right_outer, left_map, right_map)
+    return left_map, right_map
+
+
+def ordered_merge_chunks(left, right, left_outer=False, right_outer=False,
+                         chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Merge two sorted fields of keys a chunk at a time, yielding the left and right maps
+    for each part of the result in order. Keys below the smallest of the last buffered
+    keys of each side are known to form complete runs, so they are merged and released
+    before more of either key is read.
+    :param left: a sorted field or ndarray of left keys
+    :param right: a sorted field or ndarray of right keys
+    :param left_outer: whether left keys without a match are included in the result
+    :param right_outer: whether right keys without a match are included in the result
+    :return: a generator of (left_map, right_map) tuples
+    """
+    keys = (left, right)
+    lengths = [_key_length(k) for k in keys]
+    positions = [0, 0]
+    offsets = [0, 0]
+    buffers = [_key_chunk(k, 0, 0) for k in keys]
+    while True:
+        for s in range(2):
+            b = buffers[s]
+            if positions[s] < lengths[s] and (len(b) == 0 or b[0] == b[-1]):
+                end = min(positions[s] + chunksize, lengths[s])
+                buffers[s] = np.concatenate((b, _key_chunk(keys[s], positions[s], end)))
+                positions[s] = end
+
+        pending = [s for s in range(2) if positions[s] < lengths[s]]
+        bound = None if len(pending) == 0 else min(buffers[s][-1] for s in pending)
+
+        parts = list()
+        for s in range(2):
+            b = buffers[s]
+            count = len(b) if bound is None else np.searchsorted(b, bound, side='left')
+            parts.append(b[:count])
+            buffers[s] = b[count:]
+
+        size = _ordered_merge_partial_size(parts[0], parts[1], left_outer, right_outer)
+        if size > 0:
+            left_map = np.zeros(size, dtype=np.int64)
+            right_map = np.zeros(size, dtype=np.int64)
+            _ordered_merge_partial(offsets[0], offsets[1], parts[0], parts[1],
+                                   left_outer, right_outer, left_map, right_map)
+            yield left_map, right_map
+        offsets[0] += len(parts[0])
+        offsets[1] += len(parts[1])
+
+        if bound is None:
+            break
+
+
+def map_valid_window(data_field, map_chunk, result_dtype=None):
+    """
+    Map a chunk of a map onto a field, reading only the range of the field that the
+    valid entries of the map refer to. Entries of INVALID_INDEX are given a value of 0.
+    :param data_field: a field or ndarray of values
+    :param map_chunk: an int64 ndarray of indices into 'data_field'
+    :return: the mapped values
+    """
+    data_dtype = data_field.data.dtype if isinstance(data_field, fields.Field) \
+        else data_field.dtype
+    result = np.zeros(len(map_chunk), dtype=data_dtype if result_dtype is None else result_dtype)
+    valid = map_chunk < INVALID_INDEX
+    if np.any(valid):
+        valid_map = map_chunk[valid]
+        start, end = valid_map.min(), valid_map.max() + 1
+        result[valid] = _key_chunk(data_field, start, end)[valid_map - start]
+    return result
+
+
+def map_valid_streamed(data_field, map_field, result_field, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Map 'data_field' through 'map_field' a chunk of the map at a time, writing the mapped
+    values to 'result_field'. Each chunk only reads the range of 'data_field' that it
+    refers to, so maps that are ordered or locally ordered (such as the maps of
+    many-to-many merges) only read each part of the field a small number of times.
+    """
+    for c in chunks(len(map_field.data), chunksize):
+        result_field.data.write_part(
+            map_valid_window(data_field, map_field.data[c[0]:c[1]], result_field.data.dtype))
+    result_field.data.complete()
+
+
+def merged_keys(left, right, left_map, right_map):
+    """
+    Generate the keys of a merge result from its maps, taking each key from the left keys
+    where the left map is valid and from the right keys otherwise.
+    :param left: a field or ndarray of left keys
+    :param right: a field or ndarray of right keys
+    :param left_map: a chunk of the map from the result to the left keys
+    :param right_map: the corresponding chunk of the map from the result to the right keys
+    :return: an ndarray of keys
+    """
+    left_dtype = left.data.dtype if isinstance(left, fields.Field) else left.dtype
+    right_dtype = right.data.dtype if isinstance(right, fields.Field) else right.dtype
+    dtype = np.result_type(left_dtype, right_dtype)
+    return np.where(left_map < INVALID_INDEX,
+                    map_valid_window(left, left_map, dtype),
+                    map_valid_window(right, right_map, dtype))
+
+
+# multi-aggregation of spans
+# ==========================
+
+SPAN_AGGREGATIONS = ('count', 'first', 'last', 'min', 'max', 'sum', 'mean', 'var',
+                     'count_valid', 'count_distinct')
+
+# aggregations that can only be calculated over numeric (or boolean) sources
+NUMERIC_SPAN_AGGREGATIONS = ('min', 'max', 'sum', 'mean', 'var')
+
+
+def _is_numeric_dtype(dtype):
+    return np.dtype(dtype).kind in 'biuf'
+
+
+def _check_aggregations(aggregations, src_dtype):
+    for a in aggregations:
+        if a not in SPAN_AGGREGATIONS:
+            msg = "'{}' is not a supported aggregation; it must be one of {}"
+            raise ValueError(msg.format(a, SPAN_AGGREGATIONS))
+        if a in NUMERIC_SPAN_AGGREGATIONS and not _is_numeric_dtype(src_dtype):
+            msg = "'{}' can't be calculated for a source of dtype {}"
+            raise ValueError(msg.format(a, src_dtype))
+
+
+@njit
+def _apply_spans_aggregations(spans, src, valid, flags,
+                              count, first, last, min_, max_, total, mean, var,
+                              count_valid, count_distinct):
+    do_count, do_first, do_last, do_min, do_max = flags[0], flags[1], flags[2], flags[3], flags[4]
+    do_sum, do_mean, do_var, do_count_valid, do_count_distinct = \
+        flags[5], flags[6], flags[7], flags[8], flags[9]
+    do_valid_pass = do_min or do_max or do_sum or do_mean or do_var or do_count_valid
+
+    for i in range(len(spans) - 1):
+        cur = spans[i]
+        next_ = spans[i + 1]
+        if do_count:
+            count[i] = next_ - cur
+        if do_first:
+            first[i] = src[cur]
+        if do_last:
+            last[i] = src[next_ - 1]
+
+        if do_valid_pass:
+            n = 0
+            m = 0.0
+            m2 = 0.0
+            if do_sum:
+                total[i] = 0
+            for j in range(cur, next_):
+                if not valid[j]:
+                    continue
+                v = src[j]
+                if do_min and (n == 0 or v < min_[i]):
+                    min_[i] = v
+                if do_max and (n == 0 or v > max_[i]):
+                    max_[i] = v
+                if do_sum:
+                    total[i] += v
+                n += 1
+                # Welford's online update of the mean and sum of squared deviations
+                delta = v - m
+                m += delta / n
+                m2 += delta * (v - m)
+            if do_count_valid:
+                count_valid[i] = n
+            if do_mean:
+                mean[i] = m if n > 0 else np.nan
+            if do_var:
+                var[i] = m2 / (n - 1) if n > 1 else np.nan
+
+        if do_count_distinct:
+            values = src[cur:next_][valid[cur:next_]]
+            count_distinct[i] = len(np.unique(values)) if len(values) > 0 else 0
+
+
+@njit
+def _apply_spans_aggregations_non_numeric(spans, src, valid, flags,
+                                          count, first, last, min_, max_, total, mean, var,
+                                          count_valid, count_distinct):
+    # the aggregations of _apply_spans_aggregations that don't need arithmetic on the
+    # values, so that sources such as fixed-length strings can be aggregated
+    do_count, do_first, do_last = flags[0], flags[1], flags[2]
+    do_count_valid, do_count_distinct = flags[8], flags[9]
+
+    for i in range(len(spans) - 1):
+        cur = spans[i]
+        next_ = spans[i + 1]
+        if do_count:
+            count[i] = next_ - cur
+        if do_first:
+            first[i] = src[cur]
+        if do_last:
+            last[i] = src[next_ - 1]
+        if do_count_valid:
+            n = 0
+            for j in range(cur, next_):
+                if valid[j]:
+                    n += 1
+            count_valid[i] = n
+        if do_count_distinct:
+            values = src[cur:next_][valid[cur:next_]]
+            count_distinct[i] = len(np.unique(values)) if len(values) > 0 else 0
+
+
+def span_aggregation_dtype(aggregation, src_dtype):
+    """
+    Get the dtype of the results of an aggregation of a source of dtype 'src_dtype'.
+    """
+    if aggregation in ('count', 'count_valid', 'count_distinct'):
+        return np.dtype(np.int64)
+    if aggregation in ('mean', 'var'):
+        return np.dtype(np.float64)
+    if aggregation == 'sum':
+        if np.issubdtype(src_dtype, np.floating):
+            return np.dtype(np.float64)
+        if np.issubdtype(src_dtype, np.unsignedinteger):
+            return np.dtype(np.uint64)
+        return np.dtype(np.int64)
+    return np.dtype(src_dtype)
+
+
+def apply_spans_aggregations(spans, src, aggregations, valid=None):
+    """
+    Calculate several aggregations of 'src' over each span in a single pass.
+    :param spans: the spans over which to aggregate
+    :param src: an ndarray of values, of length spans[-1]
+    :param aggregations: a sequence of names from SPAN_AGGREGATIONS
+    :param valid: optional - a boolean ndarray indicating which values of 'src' are valid.
+    If not set, all values are valid except NaNs in floating point sources. 'count',
+    'first' and 'last' are calculated over all values, and the remaining aggregations
+    over the valid values only. 'var' is the sample variance. Spans without valid values
+    have a 'mean', 'var', and (for floating point sources) 'min' and 'max' of NaN; the
+    'min' and 'max' of other sources are 0 for such spans, which 'count_valid'
+    distinguishes. 'min', 'max', 'sum', 'mean' and 'var' require a numeric source
+    :return: a dictionary of aggregation name to ndarray of results
+    """
+    _check_aggregations(aggregations, src.dtype)
+    if len(src) != spans[-1]:
+        error_msg = "'src' (length {}) must be the length of the spans ({})"
+        raise ValueError(error_msg.format(len(src), spans[-1]))
+    if valid is None:
+        if np.issubdtype(src.dtype, np.floating):
+            valid = np.logical_not(np.isnan(src))
+        else:
+            valid = np.ones(len(src), dtype=bool)
+
+    span_count = len(spans) - 1
+    flags = np.zeros(len(SPAN_AGGREGATIONS), dtype=bool)
+    results = list()
+    for i, a in enumerate(SPAN_AGGREGATIONS):
+        flags[i] = a in aggregations
+        # unused results are given a single element so that the kernel can be compiled
+        dtype = span_aggregation_dtype(a, src.dtype)
+        result = np.zeros(span_count if flags[i] else 1, dtype=dtype)
+        if a in ('min', 'max') and np.issubdtype(dtype, np.floating):
+            # the kernel leaves the results of spans without valid values untouched
+            result[:] = np.nan
+        results.append(result)
+    if _is_numeric_dtype(src.dtype):
+        _apply_spans_aggregations(spans, src, valid, flags, *results)
+    else:
+        _apply_spans_aggregations_non_numeric(spans, src, valid, flags, *results)
+    return {a: results[i] for i, a in enumerate(SPAN_AGGREGATIONS) if flags[i]}
+
+
+# hash aggregation of unsorted keys
+# =================================
+
+@njit
+def _hash_aggregate_partial(groups, src, valid, flags,
+                            count, first, last, min_, max_, total, mean, m2, n_valid,
+                            has_first):
+    do_count, do_first, do_last, do_min, do_max = flags[0], flags[1], flags[2], flags[3], flags[4]
+    do_sum = flags[5]
+    do_valid_pass = flags[3] or flags[4] or flags[5] or flags[6] or flags[7] or flags[8]
+    for k in range(len(groups)):
+        g = groups[k]
+        v = src[k]
+        if do_count:
+            count[g] += 1
+        if do_first and not has_first[g]:
+            first[g] = v
+            has_first[g] = True
+        if do_last:
+            last[g] = v
+        if do_valid_pass and valid[k]:
+            n = n_valid[g]
+            if do_min and (n == 0 or v < min_[g]):
+                min_[g] = v
+            if do_max and (n == 0 or v > max_[g]):
+                max_[g] = v
+            if do_sum:
+                total[g] += v
+            n += 1
+            delta = v - mean[g]
+            mean[g] += delta / n
+            m2[g] += delta * (v - mean[g])
+            n_valid[g] = n
+
+
+@njit
+def _hash_aggregate_partial_non_numeric(groups, src, valid, flags,
+                                        count, first, last, min_, max_, total, mean, m2,
+                                        n_valid, has_first):
+    # the aggregations of _hash_aggregate_partial that don't need arithmetic on the values
+    do_count, do_first, do_last, do_count_valid = flags[0], flags[1], flags[2], flags[8]
+    for k in range(len(groups)):
+        g = groups[k]
+        if do_count:
+            count[g] += 1
+        if do_first and not has_first[g]:
+            first[g] = src[k]
+            has_first[g] = True
+        if do_last:
+            last[g] = src[k]
+        if do_count_valid and valid[k]:
+            n_valid[g] += 1
+
+
+class _HashAggregation:
+    """
+    Per-group accumulators for the aggregations of one source, indexed by the group
+    numbers of a HashTable of keys and grown as new groups are added.
+    """
+    def __init__(self, src_dtype, aggregations):
+        self.flags = np.zeros(len(SPAN_AGGREGATIONS), dtype=bool)
+        for i, a in enumerate(SPAN_AGGREGATIONS):
+            self.flags[i] = a in aggregations
+        self.src_dtype = src_dtype
+        self.capacity = 0
+        self.accumulators = None
+        self.distinct = None
+        self.distinct_counts = None
+        if 'count_distinct' in aggregations:
+            self.distinct = HashTable(np.dtype([('g', np.int64), ('v', src_dtype)]))
+        self._reserve(16)
+
+    def _reserve(self, count):
+        if count <= self.capacity:
+            return
+        capacity = max(count, self.capacity * 2)
+        dtypes = [np.int64, self.src_dtype, self.src_dtype, self.src_dtype, self.src_dtype,
+                  span_aggregation_dtype('sum', self.src_dtype),
+                  np.float64, np.float64, np.int64, np.bool_, np.int64]
+        accumulators = [np.zeros(capacity, dtype=d) for d in dtypes]
+        if self.accumulators is not None:
+            for a, b in zip(accumulators, self.accumulators):
+                a[:self.capacity] = b
+        self.accumulators = accumulators
+        self.capacity = capacity
+
+    def add(self, groups, group_count, src, valid):
+        self._reserve(group_count)
+        if _is_numeric_dtype(self.src_dtype):
+            _hash_aggregate_partial(groups, src, valid, self.flags, *self.accumulators[:-1])
+        else:
+            _hash_aggregate_partial_non_numeric(groups, src, valid, self.flags,
+                                                *self.accumulators[:-1])
+        if self.distinct is not None:
+            pairs = np.zeros(int(np.count_nonzero(valid)), dtype=self.distinct.dtype)
+            pairs['g'] = groups[valid]
+            pairs['v'] = src[valid]
+            existing = len(self.distinct)
+            entries = self.distinct.get_or_insert(pairs)
+            new_groups = pairs['g'][entries >= existing]
+            # each new (group, value) pair is only returned as new on its first occurrence
+            _, first_occurrence = np.unique(entries[entries >= existing], return_index=True)
+            np.add.at(self.accumulators[-1], new_groups[first_occurrence], 1)
+
+    def results(self, group_count):
+        count, first, last, min_, max_, total, mean, m2, n_valid, _, distinct = \
+            [a[:group_count] for a in self.accumulators]
+        if np.issubdtype(self.src_dtype, np.floating):
+            min_ = np.where(n_valid > 0, min_, np.nan)
+            max_ = np.where(n_valid > 0, max_, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            all_results = {
+                'count': count, 'first': first, 'last': last, 'min': min_, 'max': max_,
+                'sum': total,
+                'mean': np.where(n_valid > 0, mean, np.nan),
+                'var': np.where(n_valid > 1, m2 / (n_valid - 1), np.nan),
+                'count_valid': n_valid,
+                'count_distinct': distinct
+            }
+        return {a: all_results[a].copy() for i, a in enumerate(SPAN_AGGREGATIONS)
+                if self.flags[i]}
+
+
+class HashGroupBy:
+    """
+    An incremental hash group-by: chunks of keys and of their sources are added one at a
+    time, and the aggregations of all the chunks added so far can then be generated.
+    :param key_dtype: the dtype of the keys
+    :param sources: a sequence of (source dtype, aggregations) tuples, where aggregations
+    is a sequence of names from SPAN_AGGREGATIONS
+    """
+    def __init__(self, key_dtype, sources):
+        self.table = HashTable(key_dtype)
+        self.aggregators = list()
+        for src_dtype, aggregations in sources:
+            _check_aggregations(aggregations, src_dtype)
+            self.aggregators.append(_HashAggregation(np.dtype(src_dtype), aggregations))
+
+    def add(self, keys, sources):
+        """
+        Add a chunk of keys and the corresponding chunks of each source.
+        :param keys: an ndarray of keys
+        :param sources: a sequence of (source, valid) tuples, one per source, where valid
+        is an optional ndarray of booleans (None if all non-NaN values are valid)
+        """
+        groups = self.table.get_or_insert(keys)
+        for (src_chunk, valid_chunk), aggregator in zip(sources, self.aggregators):
+            if valid_chunk is not None:
+                valid_chunk = valid_chunk.astype(bool, copy=False)
+            elif np.issubdtype(src_chunk.dtype, np.floating):
+                valid_chunk = np.logical_not(np.isnan(src_chunk))
+            else:
+                valid_chunk = np.ones(len(src_chunk), dtype=bool)
+            aggregator.add(groups, len(self.table), src_chunk, valid_chunk)
+
+    def results(self):
+        """
+        :return: a tuple of (group keys, list of dictionaries of aggregation name to
+        results, one per source). Groups are in the order in which their keys first appear
+        """
+        count = len(self.table)
+        return self.table.keys, [a.results(count) for a in self.aggregators]
+
+
+def hash_group_by(keys, sources, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Aggregate sources by the values of a key that need not be sorted. The key and sources
+    are read a chunk at a time; each key is assigned a group number by a hash table of
+    keys, and each source's per-group accumulators are updated by a compiled kernel.
+    :param keys: a field or ndarray of keys of a fixed-width dtype, such as integers,
+    categorical values or fixed-length strings
+    :param sources: a sequence of (source, aggregations, valid) tuples, where source is a
+    field or ndarray of the same length as 'keys', aggregations is a sequence of names
+    from SPAN_AGGREGATIONS, and valid is an optional field or ndarray of booleans
+    indicating which values of the source are valid (None if all non-NaN values are
+    valid). Groups without valid values are given the results described for
+    'apply_spans_aggregations'
+    :return: a tuple of (group keys, list of dictionaries of aggregation name to results,
+    one per source). Groups are in the order in which their keys first appear
+    """
+    key_dtype = keys.data.dtype if isinstance(keys, fields.Field) else keys.dtype
+    for src, _, _ in sources:
+        if _key_length(src) != _key_length(keys):
+            raise ValueError("sources must be the same length as 'keys'")
+    group_by = HashGroupBy(key_dtype,
+                           [(src.data.dtype if isinstance(src, fields.Field) else src.dtype,
+                             aggregations) for src, aggregations, _ in sources])
+
+    for c in chunks(_key_length(keys), chunksize):
+        group_by.add(_key_chunk(keys, c[0], c[1]),
+                     [(_key_chunk(src, c[0], c[1]),
+                       None if valid is None else _key_chunk(valid, c[0], c[1]))
+                      for src, _, valid in sources])
+    return group_by.results()
+
+
+# parallel span kernels
+# =====================
+
+# spans covering fewer elements than this are processed by the sequential kernels
+PARALLEL_SPANS_MIN_LENGTH = 1 << 16
+
+
+def span_blocks(spans, block_count):
+    """
+    Split a set of spans into at most 'block_count' contiguous blocks of spans, each of
+    which covers roughly the same number of elements.
+    :return: an int64 array of span indices delimiting the blocks
+    """
+    span_count = len(spans) - 1
+    targets = np.linspace(spans[0], spans[-1], block_count + 1)
+    blocks = np.searchsorted(spans, targets, side='left').astype(np.int64)
+    blocks = np.clip(blocks, 0, span_count)
+    blocks[0] = 0
+    blocks[-1] = span_count
+    return np.unique(blocks)
+
+
+def _parallel_spans_kernel(kernel, kind):
+    # each block is processed by the sequential kernel on a slice of the spans and of the
+    # per-span outputs; spans contain absolute positions, so source arrays are not sliced
+    if kind == 'no_src':
+        @njit(parallel=True)
+        def _inner(blocks, spans, dest_array):
+            for b in prange(len(blocks) - 1):
+                s, e = blocks[b], blocks[b + 1]
+                kernel(spans[s:e + 1], dest_array[s:e])
+    elif kind == 'src':
+        @njit(parallel=True)
+        def _inner(blocks, spans, src_array, dest_array):
+            for b in prange(len(blocks) - 1):
+                s, e = blocks[b], blocks[b + 1]
+                kernel(spans[s:e + 1], src_array, dest_array[s:e])
+    elif kind == 'filter':
+        @njit(parallel=True)
+        def _inner(blocks, spans, dest_array, filter_array):
+            for b in prange(len(blocks) - 1):
+                s, e = blocks[b], blocks[b + 1]
+                kernel(spans[s:e + 1], dest_array[s:e], filter_array[s:e])
+    else:
+        @njit(parallel=True)
+        def _inner(blocks, spans, src_array, dest_array, filter_array):
+            for b in prange(len(blocks) - 1):
+                s, e = blocks[b], blocks[b + 1]
+                kernel(spans[s:e + 1], src_array, dest_array[s:e], filter_array[s:e])
+    return _inner
+
+
+_PARALLEL_SPANS_KERNEL_KINDS = {
+    apply_spans_count: 'no_src',
+    apply_spans_index_of_first: 'no_src',
+    apply_spans_index_of_last: 'no_src',
+    apply_spans_first: 'src',
+    apply_spans_last: 'src',
+    apply_spans_min: 'src',
+    apply_spans_max: 'src',
+    apply_spans_index_of_min: 'src',
+    apply_spans_index_of_max: 'src',
+    apply_spans_index_of_first_filter: 'filter',
+    apply_spans_index_of_last_filter: 'filter',
+    apply_spans_index_of_min_filter: 'src_filter',
+    apply_spans_index_of_max_filter: 'src_filter',
+}
+_PARALLEL_SPANS_KERNELS = dict()
+
+
+def apply_spans_parallel(kernel, spans, *arrays, threads=None,
+                         min_length=PARALLEL_SPANS_MIN_LENGTH):
+    """
+    Run one of the apply_spans kernels over blocks of spans in parallel. The spans are
+    split into blocks that cover roughly equal numbers of elements, and the blocks are
+    processed by the sequential kernel on separate threads.
+    The sequential kernel is called directly if the spans cover fewer than 'min_length'
+    elements, if only one thread is requested, or if the kernel has no parallel version.
+    :param kernel: the sequential kernel, such as 'apply_spans_min'
+    :param spans: the spans
+    :param arrays: the remaining arguments of the kernel
+    :param threads: optional - the number of threads to use; defaults to numba's thread
+    count
+    :param min_length: the minimum number of elements for which the kernel runs in parallel
+    """
+    kind = _PARALLEL_SPANS_KERNEL_KINDS.get(kernel)
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    threads = max_threads if threads is None else max(1, min(threads, max_threads))
+    if kind is None or threads == 1 or len(spans) < 2 or spans[-1] < min_length:
+        return kernel(spans, *arrays)
+
+    parallel_kernel = _PARALLEL_SPANS_KERNELS.get(kernel)
+    if parallel_kernel is None:
+        parallel_kernel = _parallel_spans_kernel(kernel, kind)
+        _PARALLEL_SPANS_KERNELS[kernel] = parallel_kernel
+
+    # several blocks per thread so that uneven blocks are balanced by the scheduler
+    blocks = span_blocks(spans, threads * 4)
+    previous_threads = numba.get_num_threads()
+    numba.set_num_threads(threads)
+    try:
+        parallel_kernel(blocks, spans, *arrays)
+    finally:
+        numba.set_num_threads(previous_threads)
+    return arrays[-1] if kind in ('no_src', 'src') else arrays[-2:]
+
+
+# span aggregations of indexed strings
+# ====================================
+
+@njit
+def _compare_indexed_values(values, s1, e1, s2, e2):
+    """
+    Lexicographically compare two byte strings held in 'values', returning -1, 0 or 1.
+    """
+    l1 = e1 - s1
+    l2 = e2 - s2
+    for k in range(min(l1, l2)):
+        a = values[s1 + k]
+        b = values[s2 + k]
+        if a < b:
+            return -1
+        if a > b:
+            return 1
+    if l1 < l2:
+        return -1
+    if l1 > l2:
+        return 1
+    return 0
+
+
+@njit
+def apply_spans_index_of_min_indexed(spans, indices, values, dest_array):
+    for i in range(len(spans) - 1):
+        best = spans[i]
+        for j in range(spans[i] + 1, spans[i + 1]):
+            if _compare_indexed_values(values, indices[j], indices[j + 1],
+                                       indices[best], indices[best + 1]) < 0:
+                best = j
+        dest_array[i] = best
+    return dest_array
+
+
+@njit
+def apply_spans_index_of_max_indexed(spans, indices, values, dest_array):
+    for i in range(len(spans) - 1):
+        best = spans[i]
+        for j in range(spans[i] + 1, spans[i + 1]):
+            if _compare_indexed_values(values, indices[j], indices[j + 1],
+                                       indices[best], indices[best + 1]) > 0:
+                best = j
+        dest_array[i] = best
+    return dest_array
+
+
+@njit
+def apply_spans_index_of_longest_indexed(spans, indices, dest_array):
+    for i in range(len(spans) - 1):
+        best = spans[i]
+        for j in range(spans[i] + 1, spans[i + 1]):
+            if indices[j + 1] - indices[j] > indices[best + 1] - indices[best]:
+                best = j
+        dest_array[i] = best
+    return dest_array
+
+
+INDEXED_SPAN_AGGREGATIONS = ('first', 'last', 'min', 'max', 'longest')
+
+
+def apply_spans_indexed(aggregation, spans, indices, values):
+    """
+    Aggregate an indexed string over each span, working directly on its index and value
+    buffers. 'min' and 'max' are lexicographic on the encoded bytes; 'longest' selects the
+    first of the longest strings in each span.
+    :param aggregation: one of 'first', 'last', 'min', 'max' and 'longest'
+    :param spans: the spans over which to aggregate
+    :param indices: the index array of the indexed string
+    :param values: the values array of the indexed string
+    :return: a tuple of the index and values arrays of the result
+    """
+    selected = np.zeros(len(spans) - 1, dtype=np.int64)
+    if aggregation == 'first':
+        apply_spans_index_of_first(spans, selected)
+    elif aggregation == 'last':
+        apply_spans_index_of_last(spans, selected)
+    elif aggregation == 'min':
+        apply_spans_index_of_min_indexed(spans, indices, values, selected)
+    elif aggregation == 'max':
+        apply_spans_index_of_max_indexed(spans, indices, values, selected)
+    elif aggregation == 'longest':
+        apply_spans_index_of_longest_indexed(spans, indices, selected)
+    else:
+        msg = "'{}' is not a supported aggregation; it must be one of {}"
+        raise ValueError(msg.format(aggregation, INDEXED_SPAN_AGGREGATIONS))
+    return apply_indices_to_index_values(selected, indices, values)
+
+
+def indexed_span_chunks(spans, indices, chunksize, value_chunksize=None):
+    """
+    Split spans over an indexed string into contiguous blocks of whole spans, so that the
+    block can be processed without reading the entire index and value arrays. Each block
+    covers at most 'chunksize' rows and, if 'value_chunksize' is set, at most that many
+    bytes of values; a single span that exceeds either limit forms a block on its own.
+    :param spans: the spans over the indexed string
+    :param indices: the index array (or field array) of the indexed string
+    :param chunksize: the maximum number of rows in a block
+    :param value_chunksize: the maximum number of bytes of values in a block
+    :return: a generator of tuples of the span range (start, end), the spans of the block
+    relative to its first row, the index of the block relative to its first value, and
+    the position of its first value
+    """
+    s_start = 0
+    span_count = len(spans) - 1
+    while s_start < span_count:
+        row_start = spans[s_start]
+        s_end = np.searchsorted(spans, row_start + chunksize, side='right') - 1
+        s_end = min(max(s_end, s_start + 1), span_count)
+        index = np.asarray(indices[row_start:spans[s_end] + 1], dtype=np.int64)
+        if value_chunksize is not None:
+            value_ends = index[spans[s_start + 1:s_end + 1] - row_start] - index[0]
+            s_end = s_start + max(np.searchsorted(value_ends, value_chunksize, side='right'), 1)
+            index = index[:spans[s_end] - row_start + 1]
+        value_start = index[0]
+        yield (s_start, s_end), spans[s_start:s_end + 1] - row_start, index - value_start, \
+            value_start
+        s_start = s_end
+
+
+# streamed filters and indices
+# ============================
+
+def _write_indexed_part(dest, indices, values, value_offset):
+    # 'indices' includes its leading zero, which has already been written for the field
+    if len(indices) > 1:
+        dest.indices.write_part(indices[1:] + value_offset)
+    if len(values) > 0:
+        dest.values.write_part(values)
+    return value_offset + len(values)
+
+
+def apply_filter_streamed(filter_to_apply, src, dest, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Apply a filter to 'src', reading the filter and the source a chunk at a time and
+    writing each filtered chunk to 'dest', so that memory use is bounded by 'chunksize'
+    rather than the length of the field.
+    :param filter_to_apply: a field or ndarray of booleans, the same length as 'src'
+    :param src: the field to be filtered
+    :param dest: the field to which the filtered values are written
+    """
+    length = len(src.data)
+    if _key_length(filter_to_apply) != length:
+        msg = "'filter_to_apply' must be the same length as 'src' ({}) but is {}"
+        raise ValueError(msg.format(length, _key_length(filter_to_apply)))
+    indexed = isinstance(src, fields.IndexedStringField)
+    value_offset = 0
+    if indexed:
+        dest.indices.write_part(np.zeros(1, dtype=np.int64))
+    for c in chunks(length, chunksize):
+        filter_chunk = np.asarray(_key_chunk(filter_to_apply, c[0], c[1]), dtype=bool)
+        if indexed:
+            index = np.asarray(src.indices[c[0]:c[1] + 1], dtype=np.int64)
+            values = src.values[index[0]:index[-1]]
+            d_indices, d_values = apply_filter_to_index_values(filter_chunk, index - index[0],
+                                                               values)
+            value_offset = _write_indexed_part(dest, d_indices, d_values, value_offset)
+        else:
+            result = src.data[c[0]:c[1]][filter_chunk]
+            if len(result) > 0:
+                dest.data.write_part(result)
+    if indexed:
+        dest.indices.complete()
+        dest.values.complete()
+    else:
+        dest.data.complete()
+
+
+def gather_windows(positions, window):
+    """
+    Split sorted positions into runs that each fall within 'window' consecutive rows, so
+    that each run can be gathered from a single bounded read.
+    :return: a generator of (start, end) ranges of 'positions'
+    """
+    start = 0
+    while start < len(positions):
+        end = np.searchsorted(positions, positions[start] + window, side='left')
+        yield start, end
+        start = end
+
+
+def gather(src, index, window=DEFAULT_CHUNKSIZE):
+    """
+    Gather the rows of 'src' at the positions in 'index', through reads of at most
+    'window' consecutive rows. Sorted indices are gathered directly from sequential
+    reads; other indices are sorted first and the gathered values restored to the order
+    of the index.
+    :param src: the field (or ndarray) from which to gather
+    :param index: an ndarray of row positions into 'src'
+    :param window: the maximum number of consecutive rows read at a time
+    :return: an ndarray of values or, for indexed strings, a tuple of indices and values
+    """
+    indexed = isinstance(src, fields.IndexedStringField)
+    index = np.asarray(index, dtype=np.int64)
+    src_length = _key_length(src)
+    if len(index) > 0 and (index.min() < 0 or index.max() >= src_length):
+        raise ValueError("'index' contains indices outside of 'src', which has "
+                         "length {}".format(src_length))
+    if len(index) == 0:
+        if indexed:
+            return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=src.values.dtype)
+        return _key_chunk(src, 0, 0)
+
+    order = None if not np.any(index[1:] < index[:-1]) else np.argsort(index, kind='stable')
+    positions = index if order is None else index[order]
+
+    parts = list()
+    for w in gather_windows(positions, window):
+        start, end = positions[w[0]], positions[w[1] - 1] + 1
+        if indexed:
+            w_index = np.asarray(src.indices[start:end + 1], dtype=np.int64)
+            w_values = src.values[w_index[0]:w_index[-1]]
+            parts.append(apply_indices_to_index_values(positions[w[0]:w[1]] - start,
+                                                       w_index - w_index[0], w_values))
+        else:
+            parts.append(_key_chunk(src, start, end)[positions[w[0]:w[1]] - start])
+
+    if indexed:
+        lengths = np.concatenate([np.diff(p[0]) for p in parts])
+        indices = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indices[1:])
+        values = np.concatenate([p[1] for p in parts])
+        if order is not None:
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            indices, values = apply_indices_to_index_values(inverse, indices, values)
+        return indices, values
+
+    result = np.concatenate(parts)
+    if order is not None:
+        unsorted = np.empty_like(result)
+        unsorted[order] = result
+        result = unsorted
+    return result
+
+
+def apply_index_streamed(index_to_apply, src, dest, chunksize=DEFAULT_CHUNKSIZE,
+                         memory_budget=None):
+    """
+    Apply an index to 'src', reading the index a chunk at a time and writing each chunk of
+    the result to 'dest'. Each chunk of the index is gathered from the source through
+    reads of at most 'memory_budget' bytes (of index entries, for indexed strings); see
+    'gather'.
+    :param index_to_apply: a field or ndarray of row indices into 'src'
+    :param src: the field to be indexed
+    :param dest: the field to which the indexed values are written
+    :param chunksize: the number of index entries processed at a time
+    :param memory_budget: the maximum number of bytes of the source read at a time; if
+    not set, reads are bounded by 'chunksize' rows
+    """
+    indexed = isinstance(src, fields.IndexedStringField)
+    itemsize = np.dtype(np.int64).itemsize if indexed else src.data.dtype.itemsize
+    window = chunksize if memory_budget is None else max(memory_budget // itemsize, 1)
+    value_offset = 0
+    if indexed:
+        dest.indices.write_part(np.zeros(1, dtype=np.int64))
+    for c in chunks(_key_length(index_to_apply), chunksize):
+        index = _key_chunk(index_to_apply, c[0], c[1])
+        if len(index) == 0:
+            continue
+        if indexed:
+            indices, values = gather(src, index, window)
+            value_offset = _write_indexed_part(dest, indices, values, value_offset)
+        else:
+            dest.data.write_part(gather(src, index, window))
+    if indexed:
+        dest.indices.complete()
+        dest.values.complete()
+    else:
+        dest.data.complete()
+
+
+# distinct
+# ========
+
+def _distinct_column_chunk(column, start, end, filter_chunk, string_table):
+    # returns the chunk of a column as a fixed-width array, and how it was interned (None,
+    # 'str' or 'bytes'); strings of variable length are interned in 'string_table' and
+    # represented by their entry numbers
+    if isinstance(column, fields.IndexedStringField):
+        indices = np.asarray(column.indices[start:end + 1], dtype=np.int64)
+        values = column.values[indices[0]:indices[-1]]
+        indices = indices - indices[0]
+        interned = 'str'
+    else:
+        chunk = _key_chunk(column, start, end)
+        if not isinstance(chunk, list) and not np.asarray(chunk).dtype.hasobject:
+            chunk = np.asarray(chunk)
+            if np.issubdtype(chunk.dtype, np.floating):
+                # -0.0 and 0.0 are the same value but have different bytes
+                chunk = chunk + chunk.dtype.type(0)
+            return (chunk if filter_chunk is None else chunk[filter_chunk]), None
+        interned = 'bytes' if len(chunk) > 0 and isinstance(chunk[0], bytes) else 'str'
+        indices, values = encode_strings(chunk)
+    if filter_chunk is not None:
+        indices, values = apply_filter_to_index_values(filter_chunk, indices, values)
+    return string_table.get_or_insert(indices, values), interned
+
+
+def _empty_distinct_column(column):
+    # the results of a column without rows, with the dtype its values would be given
+    if isinstance(column, fields.IndexedStringField):
+        return np.zeros(0, dtype=object)
+    chunk = _key_chunk(column, 0, 0)
+    if isinstance(chunk, list) or np.asarray(chunk).dtype.hasobject:
+        return np.zeros(0, dtype=object)
+    return np.zeros(0, dtype=np.asarray(chunk).dtype)
+
+
+def distinct(columns, filter=None, chunksize=DEFAULT_CHUNKSIZE, return_index=False,
+             return_counts=False):
+    """
+    Find the distinct tuples of values of one or more columns with a hash table, reading
+    the columns a chunk at a time, so that memory use scales with the number of distinct
+    tuples rather than the length of the columns. Columns may be of any type; strings of
+    variable length are interned in a StringTable.
+    :param columns: a sequence of fields, readers or ndarrays of the same length
+    :param filter: optional - a field or ndarray of booleans; only rows for which the
+    filter is True are considered
+    :param return_index: optional - also return the row of the first occurrence of each
+    distinct tuple
+    :param return_counts: optional - also return the number of occurrences of each
+    distinct tuple
+    :return: a list of arrays of the distinct values, one per column, sorted by the
+    distinct tuples. Strings are returned as object arrays of str. If 'return_index' or
+    'return_counts' are set, a tuple of the list followed by the requested arrays
+    """
+    length = _key_length(columns[0])
+    for c in columns[1:]:
+        if _key_length(c) != length:
+            raise ValueError("all columns must be the same length")
+    if filter is not None and _key_length(filter) != length:
+        raise ValueError("'filter' must be the same length as the columns")
+
+    string_tables = [StringTable() for _ in columns]
+    table = None
+    is_string = None
+    counts = np.zeros(16, dtype=np.int64)
+    first = np.zeros(16, dtype=np.int64)
+    for c in chunks(length, chunksize):
+        filter_chunk = None
+        rows = np.arange(c[0], c[1], dtype=np.int64)
+        if filter is not None:
+            filter_chunk = np.asarray(_key_chunk(filter, c[0], c[1])).astype(bool)
+            rows = rows[filter_chunk]
+        parts, interned = list(), list()
+        for column, st in zip(columns, string_tables):
+            part, is_interned = _distinct_column_chunk(column, c[0], c[1], filter_chunk, st)
+            parts.append(part)
+            interned.append(is_interned)
+        if table is None:
+            is_string = interned
+            table = HashTable(np.dtype([(str(i), p.dtype) for i, p in enumerate(parts)]))
+        keys = np.zeros(len(rows), dtype=table.dtype)
+        for i, p in enumerate(parts):
+            keys[str(i)] = p
+
+        existing = len(table)
+        entries = table.get_or_insert(keys)
+        if len(table) > len(counts):
+            capacity = max(len(table), len(counts) * 2)
+            counts = np.concatenate((counts, np.zeros(capacity - len(counts), np.int64)))
+            first = np.concatenate((first, np.zeros(capacity - len(first), np.int64)))
+        counts[:len(table)] += np.bincount(entries, minlength=len(table))
+        new_rows = np.flatnonzero(entries >= existing)
+        new_entries, positions = np.unique(entries[new_rows], return_index=True)
+        first[new_entries] = rows[new_rows[positions]]
+
+    if table is None:
+        results = [_empty_distinct_column(c) for c in columns]
+        counts, first = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    else:
+        keys = table.keys
+        results = list()
+        for i, st in enumerate(string_tables):
+            if is_string[i] is not None:
+                results.append(decode_strings(*st.strings(keys[str(i)]),
+                                              as_bytes=is_string[i] == 'bytes'))
+            else:
+                results.append(keys[str(i)])
+        counts, first = counts[:len(table)], first[:len(table)]
+        order = np.lexsort([np.unique(r, return_inverse=True)[1] for r in results[::-1]])
+        results = [r[order] for r in results]
+        counts, first = counts[order], first[order]
+
+    if not return_index and not return_counts:
+        return results
+    extras = ([first] if return_index else []) + ([counts] if return_counts else [])
+    return tuple([results] + extras)
+
+
+# value counts and histograms
+# ===========================
+
+def _integer_entries(chunk, table):
+    # map a chunk of integers to the entries of 'table', using bincount to find the values
+    # present so that the hash table sees each distinct value of the chunk only once. Chunks
+    # whose values are spread too widely for a bincount are inserted directly
+    if len(chunk) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = int(chunk.min())
+    span = int(chunk.max()) - lo + 1
+    if span > 4 * len(chunk) + 1024:
+        return table.get_or_insert(chunk)
+    # unsigned values may not fit in an int64, but their offsets from the minimum do
+    base = chunk.dtype.type(lo) if chunk.dtype.kind == 'u' else np.int64(lo)
+    relative = (chunk.astype(base.dtype, copy=False) - base).astype(np.int64, copy=False)
+    present = np.flatnonzero(np.bincount(relative, minlength=span))
+    entries = np.full(span, -1, dtype=np.int64)
+    entries[present] = table.get_or_insert(
+        (present.astype(base.dtype) + base).astype(chunk.dtype, copy=False))
+    return entries[relative]
+
+
+class _ColumnEntries:
+    # numbers the distinct values of a column as chunks of it are seen
+    def __init__(self, column):
+        self.column = column
+        self.string_table = StringTable()
+        self.table = None
+        self.interned = None
+
+    def entries(self, start, end, filter_chunk):
+        part, self.interned = _distinct_column_chunk(self.column, start, end, filter_chunk,
+                                                     self.string_table)
+        if self.interned is not None:
+            return part
+        if self.table is None:
+            self.table = HashTable(part.dtype)
+        if part.dtype.kind in 'iub':
+            return _integer_entries(part, self.table)
+        return self.table.get_or_insert(part)
+
+    def __len__(self):
+        if self.interned is not None:
+            return len(self.string_table)
+        return 0 if self.table is None else len(self.table)
+
+    def values(self):
+        if self.interned is not None:
+            return decode_strings(*self.string_table.strings(), as_bytes=self.interned == 'bytes')
+        return np.zeros(0, dtype=object) if self.table is None else self.table.keys
+
+
+def _accumulate_counts(counts, entries, by_entries, shape):
+    if counts.shape != shape:
+        counts = np.pad(counts, ((0, shape[0] - counts.shape[0]), (0, shape[1] - counts.shape[1])))
+    if len(entries) > 0:
+        combined = entries * shape[1] + (0 if by_entries is None else by_entries)
+        counts += np.bincount(combined, minlength=shape[0] * shape[1]).reshape(shape)
+    return counts
+
+
+def _check_lengths(length, filter, by):
+    if filter is not None and _key_length(filter) != length:
+        raise ValueError("'filter' (length {}) must be the same length as the source "
+                         "({})".format(_key_length(filter), length))
+    if by is not None and _key_length(by) != length:
+        raise ValueError("'by' (length {}) must be the same length as the source "
+                         "({})".format(_key_length(by), length))
+
+
+def value_counts(column, filter=None, by=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Count the occurrences of each distinct value of a column, reading it a chunk at a time.
+    Integer (including categorical) values are counted with bincount; other values,
+    including strings, are numbered with a hash table.
+    :param column: a field or ndarray
+    :param filter: optional - a field or ndarray of booleans; only rows for which it is
+    True are counted
+    :param by: optional - a field or ndarray, typically categorical; if set, the counts are
+    a crosstab of the values of 'column' against the values of 'by'
+    :return: a tuple of the sorted distinct values and their counts. If 'by' is set, a
+    tuple of the distinct values, the distinct values of 'by' and a two dimensional
+    array of counts
+    """
+    length = _key_length(column)
+    _check_lengths(length, filter, by)
+    columns = [_ColumnEntries(column)] + ([] if by is None else [_ColumnEntries(by)])
+    counts = np.zeros((0, 1 if by is None else 0), dtype=np.int64)
+    for c in chunks(length, chunksize):
+        filter_chunk = None
+        if filter is not None:
+            filter_chunk = np.asarray(_key_chunk(filter, c[0], c[1])).astype(bool)
+        entries = [col.entries(c[0], c[1], filter_chunk) for col in columns]
+        shape = (len(columns[0]), 1 if by is None else len(columns[1]))
+        counts = _accumulate_counts(counts, entries[0], None if by is None else entries[1],
+                                    shape)
+
+    values = columns[0].values()
+    order = np.argsort(values, kind='stable')
+    if by is None:
+        return values[order], counts[order, 0]
+    by_values = columns[1].values()
+    by_order = np.argsort(by_values, kind='stable')
+    return values[order], by_values[by_order], counts[order][:, by_order]
+
+
+def histogram(column, bins=10, value_range=None, filter=None, by=None,
+              chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Count the values of a numeric column that fall in each of a set of bins, reading it a
+    chunk at a time. NaNs and values outside the bins are not counted.
+    :param column: a numeric field or ndarray
+    :param bins: the number of equal-width bins, or a monotonically increasing array of
+    bin edges. As with numpy.histogram, every bin but the last is half-open
+    :param value_range: optional - the (lower, upper) range of the bins when 'bins' is a
+    number. If not set, the minimum and maximum of the column are found with an
+    additional pass
+    :param filter: optional - a field or ndarray of booleans; only rows for which it is
+    True are counted
+    :param by: optional - a field or ndarray, typically categorical; if set, the counts are
+    a crosstab of the bins against the values of 'by'
+    :return: a tuple of the counts and the bin edges. If 'by' is set, a tuple of the
+    two dimensional counts, the bin edges and the sorted distinct values of 'by'
+    """
+    length = _key_length(column)
+    _check_lengths(length, filter, by)
+
+    def filtered_chunk(c):
+        values = np.asarray(_key_chunk(column, c[0], c[1]))
+        keep = np.ones(len(values), dtype=bool) if filter is None else \
+            np.asarray(_key_chunk(filter, c[0], c[1])).astype(bool)
+        if np.issubdtype(values.dtype, np.floating):
+            keep &= np.logical_not(np.isnan(values))
+        return values, keep
+
+    if np.ndim(bins) == 0:
+        if value_range is None:
+            lo, hi = np.inf, -np.inf
+            for c in chunks(length, chunksize):
+                values, keep = filtered_chunk(c)
+                if keep.any():
+                    lo, hi = min(lo, values[keep].min()), max(hi, values[keep].max())
+            value_range = (0.0, 1.0) if lo > hi else (lo, hi)
+        lo, hi = float(value_range[0]), float(value_range[1])
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        edges = np.linspace(lo, hi, int(bins) + 1)
+    else:
+        edges = np.asarray(bins, dtype=np.float64)
+        if len(edges) < 2 or np.any(np.diff(edges) <= 0):
+            raise ValueError("'bins' must be a number or a monotonically increasing array of "
+                             "at least two edges")
+    bin_count = len(edges) - 1
+
+    by_column = None if by is None else _ColumnEntries(by)
+    counts = np.zeros((bin_count, 1 if by is None else 0), dtype=np.int64)
+    for c in chunks(length, chunksize):
+        values, keep = filtered_chunk(c)
+        by_entries = None if by is None else by_column.entries(c[0], c[1], keep)
+        values = values[keep]
+        positions = np.searchsorted(edges, values, side='right') - 1
+        positions[values == edges[-1]] = bin_count - 1
+        inside = (positions >= 0) & (positions < bin_count)
+        if by_entries is not None:
+            by_entries = by_entries[inside]
+        counts = _accumulate_counts(counts, positions[inside].astype(np.int64), by_entries,
+                                    (bin_count, 1 if by is None else len(by_column)))
+
+    if by is None:
+        return counts[:, 0], edges
+    by_values = by_column.values()
+    by_order = np.argsort(by_values, kind='stable')
+    return counts[:, by_order], edges, by_values[by_order]
+
+
+# summary statistics
+# ==================
+
+DESCRIBE_SAMPLE_SIZE = 1 << 16
+
+
+@njit(nogil=True)
+def _welford_update(values, state):
+    # state holds the count, mean, sum of squared deviations, minimum and maximum
+    n, m, m2, lo, hi = state[0], state[1], state[2], state[3], state[4]
+    for i in range(len(values)):
+        v = np.float64(values[i])
+        if n == 0 or v < lo:
+            lo = v
+        if n == 0 or v > hi:
+            hi = v
+        n += 1
+        delta = v - m
+        m += delta / n
+        m2 += delta * (v - m)
+    state[0], state[1], state[2], state[3], state[4] = n, m, m2, lo, hi
+
+
+class DescribeAccumulator:
+    """
+    Accumulate the summary statistics of a numeric column a chunk at a time. The mean and
+    standard deviation are accumulated with Welford's algorithm, and quantiles are taken
+    from a uniform reservoir sample of the valid values; they are exact when there are no
+    more valid values than the sample size.
+    """
+    def __init__(self, sample_size=DESCRIBE_SAMPLE_SIZE, seed=12345678):
+        self.count = 0
+        self.state = np.zeros(5, dtype=np.float64)
+        self.sample = np.zeros(sample_size, dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, values, valid=None):
+        """
+        Add a chunk of values to the statistics.
+        :param values: an ndarray of numeric values
+        :param valid: optional - a boolean ndarray indicating which values are valid. NaNs
+        are never valid
+        """
+        self.count += len(values)
+        values = np.asarray(values)
+        keep = np.ones(len(values), dtype=bool) if valid is None else np.asarray(valid, bool)
+        if np.issubdtype(values.dtype, np.floating):
+            keep &= np.logical_not(np.isnan(values))
+        values = values[keep]
+        seen = int(self.state[0])
+        _welford_update(values, self.state)
+
+        # reservoir sampling; the i'th value replaces a random sample entry with probability
+        # sample_size / (i + 1). Later values of a chunk win where the entries coincide, as
+        # they would if the values were added one at a time
+        size = len(self.sample)
+        fill = max(min(size - seen, len(values)), 0)
+        self.sample[seen:seen + fill] = values[:fill]
+        rest = values[fill:]
+        if len(rest) > 0:
+            positions = np.arange(seen + fill + 1, seen + fill + 1 + len(rest))
+            entries = (self.rng.random(len(rest)) * positions).astype(np.int64)
+            chosen = entries < size
+            self.sample[entries[chosen]] = rest[chosen]
+
+    def results(self, quantiles=(0.25, 0.5, 0.75)):
+        """
+        Get the accumulated statistics.
+        :param quantiles: the quantiles to calculate, each between 0 and 1
+        :return: a dictionary of 'count', 'count_valid', 'mean', 'std' (the sample standard
+        deviation), 'min', 'max' and a '<q>%' entry for each quantile
+        """
+        n = int(self.state[0])
+        results = {'count': self.count, 'count_valid': n,
+                   'mean': float(self.state[1]) if n > 0 else np.nan,
+                   'std': float(np.sqrt(self.state[2] / (n - 1))) if n > 1 else np.nan,
+                   'min': float(self.state[3]) if n > 0 else np.nan,
+                   'max': float(self.state[4]) if n > 0 else np.nan}
+        sample = self.sample[:min(n, len(self.sample))]
+        for q in quantiles:
+            if not 0 <= q <= 1:
+                raise ValueError("quantiles must be between 0 and 1 but {} is not".format(q))
+            results['{:g}%'.format(q * 100)] = \
+                float(np.quantile(sample, q)) if n > 0 else np.nan
+        return results
+
+
+def describe(column, valid=None, quantiles=(0.25, 0.5, 0.75), chunksize=DEFAULT_CHUNKSIZE,
+             sample_size=DESCRIBE_SAMPLE_SIZE):
+    """
+    Calculate the summary statistics of a numeric column in a single pass, reading it a
+    chunk at a time. See DescribeAccumulator for the statistics calculated.
+    :param column: a numeric field or ndarray
+    :param valid: optional - a boolean field or ndarray indicating which values are valid
+    :param quantiles: the quantiles to calculate
+    :return: a dictionary of statistic name to value
+    """
+    length = _key_length(column)
+    if valid is not None and _key_length(valid) != length:
+        raise ValueError("'valid' (length {}) must be the same length as the source "
+                         "({})".format(_key_length(valid), length))
+    accumulator = DescribeAccumulator(sample_size)
+    for c in chunks(length, chunksize):
+        accumulator.add(_key_chunk(column, c[0], c[1]),
+                        None if valid is None else _key_chunk(valid, c[0], c[1]))
+    return accumulator.results(quantiles)
+
+
+# window functions within spans
+# =============================
+
+SPAN_ROLLING_AGGREGATIONS = ('count', 'sum', 'mean', 'min', 'max')
+
+
+def _check_span_source(spans, src, name='src'):
+    if src is not None and _key_length(src) != spans[-1]:
+        raise ValueError("'{}' (length {}) must be the length of the spans "
+                         "({})".format(name, _key_length(src), spans[-1]))
+
+
+def _span_of_row(spans, row):
+    # the index of the span containing 'row'; where empty spans share the row as their
+    # start, the last of them
+    return np.searchsorted(spans, row, side='right') - 1
+
+
+def _numeric_chunk(src, start, end, name='src'):
+    chunk = _key_chunk(src, start, end)
+    if isinstance(chunk, list) or np.asarray(chunk).dtype.kind not in 'biuf':
+        raise ValueError("'{}' must be numeric".format(name))
+    return np.asarray(chunk)
+
+
+def _valid_values(values, valid, start, end):
+    keep = np.ones(len(values), dtype=bool) if valid is None else \
+        np.asarray(_key_chunk(valid, start, end)).astype(bool, copy=False)
+    if np.issubdtype(values.dtype, np.floating):
+        keep &= np.logical_not(np.isnan(values))
+    return keep
+
+
+class _WindowResults:
+    # collects the chunks of the results of a window function, writing them to 'dest' if
+    # it is set
+    def __init__(self, dest, dtype):
+        self.dest = dest
+        self.dtype = dtype
+        self.parts = list()
+
+    def add(self, part):
+        if self.dest is None:
+            self.parts.append(part)
+        else:
+            self.dest.data.write_part(part.astype(self.dest.data.dtype, copy=False))
+
+    def results(self):
+        if self.dest is None:
+            return np.concatenate(self.parts) if self.parts else np.zeros(0, dtype=self.dtype)
+        self.dest.data.complete()
+        return self.dest
+
+
+@njit(nogil=True)
+def _spans_cumsum(spans, p, base, values, valid, carry, results):
+    total = carry[0]
+    for i in range(len(values)):
+        r = base + i
+        while r >= spans[p + 1]:
+            p += 1
+        if r == spans[p]:
+            total = 0
+        if valid[i]:
+            total += values[i]
+        results[i] = total
+    carry[0] = total
+
+
+@njit(nogil=True)
+def _spans_cumcount(spans, p, base, results):
+    for i in range(len(results)):
+        r = base + i
+        while r >= spans[p + 1]:
+            p += 1
+        results[i] = r - spans[p]
+
+
+def apply_spans_cumulative_streamed(spans, aggregation, src=None, valid=None, dest=None,
+                                    chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Calculate a running aggregation within each span, reading the source a chunk at a time.
+    :param spans: the spans within which to aggregate
+    :param aggregation: 'sum', for the running sum of the valid values of 'src' up to and
+    including each row, or 'count', for the position of each row within its span
+    (starting at 0)
+    :param src: the numeric field or ndarray to sum; not used for 'count'
+    :param valid: optional - a field or ndarray of booleans indicating which values of
+    'src' are summed. NaNs are never summed
+    :param dest: optional - a field to which the results are written a chunk at a time
+    :return: 'dest' if it is set, otherwise an ndarray of results; int64 for counts and for
+    sums of integers, and float64 for sums of floating point values
+    """
+    if aggregation not in ('sum', 'count'):
+        raise ValueError("'aggregation' must be one of ('sum', 'count') but is "
+                         "{}".format(aggregation))
+    spans = np.asarray(spans, dtype=np.int64)
+    if aggregation == 'sum':
+        if src is None:
+            raise ValueError("'src' must be set for a cumulative sum")
+        _check_span_source(spans, src)
+    _check_span_source(spans, valid, 'valid')
+
+    dtype = np.dtype(np.int64)
+    if aggregation == 'sum' and src is not None and \
+            np.issubdtype(_numeric_chunk(src, 0, 0).dtype, np.floating):
+        dtype = np.dtype(np.float64)
+    output = _WindowResults(dest, dtype)
+    carry = np.zeros(1, dtype=dtype)
+    for c in chunks(spans[-1], chunksize):
+        p = _span_of_row(spans, c[0])
+        results = np.zeros(c[1] - c[0], dtype=dtype)
+        if aggregation == 'count':
+            _spans_cumcount(spans, p, c[0], results)
+        else:
+            values = _numeric_chunk(src, c[0], c[1])
+            keep = _valid_values(values, valid, c[0], c[1])
+            _spans_cumsum(spans, p, c[0], values.astype(dtype, copy=False), keep, carry,
+                          results)
+        output.add(results)
+    return output.results()
+
+
+@njit(nogil=True)
+def _spans_shift(spans, p, start, values, value_base, periods, fill, results):
+    for i in range(len(results)):
+        r = start + i
+        while r >= spans[p + 1]:
+            p += 1
+        source = r - periods
+        if spans[p] <= source < spans[p + 1]:
+            results[i] = values[source - value_base]
+        else:
+            results[i] = fill
+
+
+def _shifted_chunks(spans, src, periods, fill, chunksize, dtype=None):
+    # yield each chunk of the source with the values 'periods' rows earlier (or later, if
+    # 'periods' is negative) in the same span, reading the rows either side of the chunk
+    # that the shift needs
+    length = spans[-1]
+    for c in chunks(length, chunksize):
+        value_base = max(c[0] - max(periods, 0), 0)
+        value_end = min(c[1] - min(periods, 0), length)
+        values = _numeric_chunk(src, value_base, value_end)
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        results = np.zeros(c[1] - c[0], dtype=values.dtype)
+        _spans_shift(spans, _span_of_row(spans, c[0]), c[0], values, value_base, periods,
+                     values.dtype.type(fill), results)
+        yield c, values[c[0] - value_base:c[1] - value_base], results
+
+
+def apply_spans_shift_streamed(spans, src, periods=1, fill=None, dest=None,
+                               chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Shift the values of 'src' within each span, reading it a chunk at a time. A positive
+    'periods' gives each row the value 'periods' rows before it in its span (lag), and a
+    negative 'periods' the value that many rows after it (lead).
+    :param spans: the spans within which to shift
+    :param src: a numeric or timestamp field or ndarray
+    :param periods: the number of rows to shift by
+    :param fill: optional - the value of rows without a value 'periods' rows away in their
+    span. Defaults to NaN for floating point sources and 0 otherwise
+    :param dest: optional - a field to which the results are written a chunk at a time
+    :return: 'dest' if it is set, otherwise an ndarray of results, of the dtype of 'src'
+    """
+    spans = np.asarray(spans, dtype=np.int64)
+    _check_span_source(spans, src)
+    dtype = _numeric_chunk(src, 0, 0).dtype
+    if fill is None:
+        fill = np.nan if np.issubdtype(dtype, np.floating) else 0
+    output = _WindowResults(dest, dtype)
+    for _, _, shifted in _shifted_chunks(spans, src, int(periods), fill, chunksize):
+        output.add(shifted)
+    return output.results()
+
+
+def apply_spans_diff_streamed(spans, src, periods=1, dest=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Calculate the difference between each value of 'src' and the value 'periods' rows
+    before it in its span, reading it a chunk at a time. For timestamps, this is the
+    number of seconds since the earlier row.
+    :param spans: the spans within which to calculate differences
+    :param src: a numeric or timestamp field or ndarray
+    :param periods: the number of rows to look back; negative values look forward
+    :param dest: optional - a field to which the results are written a chunk at a time
+    :return: 'dest' if it is set, otherwise a float64 ndarray of results, which are NaN
+    for rows without a row 'periods' rows away in their span
+    """
+    spans = np.asarray(spans, dtype=np.int64)
+    _check_span_source(spans, src)
+    output = _WindowResults(dest, np.float64)
+    for _, values, shifted in _shifted_chunks(spans, src, int(periods), np.nan, chunksize,
+                                              np.float64):
+        output.add(values - shifted)
+    return output.results()
+
+
+@njit(nogil=True)
+def _spans_rolling(spans, p, base, start, values, valid, times, window, duration,
+                   aggregation, min_periods, results):
+    # slide a window over the rows from 'base', writing the results of the rows from
+    # 'start'. The window is the last 'window' rows of the span if 'window' is positive,
+    # and otherwise the rows of the span whose times are within 'duration' of the row.
+    # Minima and maxima are kept in a monotonic queue of the window's rows. Returns the
+    # first row of the window of the last row
+    n = len(values)
+    queue = np.zeros(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    lo = 0
+    total = 0.0
+    count = 0
+    for i in range(n):
+        r = base + i
+        while r >= spans[p + 1]:
+            p += 1
+        if r == spans[p]:
+            lo = i
+            total = 0.0
+            count = 0
+            head = 0
+            tail = 0
+        elif window == 0 and i > 0 and times[i] < times[i - 1]:
+            raise ValueError("'timestamps' must be sorted within each span")
+
+        if valid[i]:
+            total += values[i]
+            count += 1
+            if aggregation == 3:
+                while tail > head and values[queue[tail - 1]] >= values[i]:
+                    tail -= 1
+            elif aggregation == 4:
+                while tail > head and values[queue[tail - 1]] <= values[i]:
+                    tail -= 1
+            queue[tail] = i
+            tail += 1
+        while lo < i and ((window > 0 and i - lo >= window) or
+                          (window == 0 and times[lo] <= times[i] - duration)):
+            if valid[lo]:
+                total -= values[lo]
+                count -= 1
+            lo += 1
+        while tail > head and queue[head] < lo:
+            head += 1
+
+        if r >= start:
+            j = r - start
+            if aggregation == 0:
+                results[j] = count
+            elif count < max(min_periods, 1):
+                results[j] = np.nan
+            elif aggregation == 1:
+                results[j] = total
+            elif aggregation == 2:
+                results[j] = total / count
+            else:
+                results[j] = values[queue[head]]
+    return base + lo
+
+
+def apply_spans_rolling_streamed(spans, src, aggregation, window=None, timestamps=None,
+                                 duration=None, valid=None, min_periods=1, dest=None,
+                                 chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Aggregate the values of 'src' over a trailing window of each row within its span,
+    reading it a chunk at a time. The window is either the row and the 'window' - 1 rows
+    before it, or the rows whose timestamps are greater than the row's timestamp minus
+    'duration' (up to and including the row).
+    :param spans: the spans within which to aggregate
+    :param src: a numeric or timestamp field or ndarray
+    :param aggregation: one of SPAN_ROLLING_AGGREGATIONS
+    :param window: the number of rows in the window
+    :param timestamps: a field or ndarray of timestamps, sorted within each span, if the
+    window is a time window
+    :param duration: the length of a time window, in seconds
+    :param valid: optional - a field or ndarray of booleans indicating which values of
+    'src' are aggregated. NaNs are never aggregated
+    :param min_periods: the number of valid values that a window needs for a result other
+    than a count
+    :param dest: optional - a field to which the results are written a chunk at a time
+    :return: 'dest' if it is set, otherwise a float64 ndarray of results, which are NaN
+    for windows with fewer than 'min_periods' valid values
+    """
+    if aggregation not in SPAN_ROLLING_AGGREGATIONS:
+        raise ValueError("'aggregation' must be one of {} but is "
+                         "{}".format(SPAN_ROLLING_AGGREGATIONS, aggregation))
+    if (window is None) == (timestamps is None):
+        raise ValueError("Exactly one of 'window' and 'timestamps' must be set")
+    if window is not None and int(window) < 1:
+        raise ValueError("'window' must be a positive number of rows but is {}".format(window))
+    if timestamps is not None and (duration is None or duration <= 0):
+        raise ValueError("'duration' must be a positive number of seconds for a time window")
+    spans = np.asarray(spans, dtype=np.int64)
+    _check_span_source(spans, src)
+    _check_span_source(spans, valid, 'valid')
+    _check_span_source(spans, timestamps, 'timestamps')
+
+    output = _WindowResults(dest, np.float64)
+    base = 0
+    for c in chunks(spans[-1], chunksize):
+        # the rows before the chunk that are in the window of its first row are read again
+        values = _numeric_chunk(src, base, c[1])
+        keep = _valid_values(values, valid, base, c[1])
+        times = np.zeros(1, dtype=np.float64) if timestamps is None else \
+            _numeric_chunk(timestamps, base, c[1], 'timestamps').astype(np.float64, copy=False)
+        results = np.zeros(c[1] - c[0], dtype=np.float64)
+        base = _spans_rolling(spans, _span_of_row(spans, base), base, c[0],
+                              values.astype(np.float64, copy=False), keep, times,
+                              0 if window is None else int(window),
+                              0.0 if duration is None else float(duration),
+                              SPAN_ROLLING_AGGREGATIONS.index(aggregation), min_periods,
+                              results)
+        output.add(results)
+    return output.results()
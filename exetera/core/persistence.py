@@ -11,6 +11,8 @@
 
 import os
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timezone
 import time
@@ -24,6 +26,7 @@ import pandas as pd
 
 from exetera.core import validation as val
 from exetera.core import readerwriter as rw
+from exetera.core import operations as ops
 from exetera.core.operations import INVALID_INDEX, DEFAULT_CHUNKSIZE
 
 # TODO: rename this persistence file to hdf5persistence
@@ -661,20 +664,9 @@ def foreign_key_is_in_primary_key(primary_key, foreign_key):
     else:
         fk = foreign_key
 
-    result = np.zeros(len(fk), dtype=np.bool)
-    return _filter_non_orphaned_foreign_keys(pk, fk, result)
-
-
-def _filter_non_orphaned_foreign_keys(primary_key, foreign_key, results):
-    pkids = dict()
-    trueval = np.bool(True)
-    falseval = np.bool(False)
-    for p in primary_key:
-        pkids[p] = trueval
-
-    for i, f in enumerate(foreign_key):
-        results[i] = pkids.get(f, falseval)
-    return results
+    pk = ops.fixed_width_keys(np.asarray(pk))
+    fk = ops.fixed_width_keys(np.asarray(fk))
+    return ops.KeySet(pk, ops.common_key_dtype(pk.dtype, fk.dtype)).contains(fk)
 
 
 # Newest
@@ -715,6 +707,79 @@ def _aggregate_impl(predicate, fkey_indices=None, fkey_index_spans=None,
     return writer if writer is not None else results
 
 
+def _run_predicate(predicate, kwargs, output_names):
+    predicate(**kwargs)
+    return {k: kwargs[k] for k in output_names}
+
+
+PROCESS_EXECUTORS = ('thread', 'process')
+
+
+def process_chunks(inputs, outputs, predicate, chunksize, workers=None, executor='thread',
+                   jit=False):
+    """
+    Run 'predicate' over the inputs a chunk at a time. The predicate is called with a
+    keyword argument for each input, holding that input's chunk, and for each output,
+    holding an array to be filled with that output's chunk, which is then written to the
+    output's writer.
+    When 'workers' is greater than one, the predicate is run on several chunks at once in
+    a pool of threads or processes. Each chunk in flight has its own output arrays, and
+    the outputs are written in chunk order, so the results are identical to a serial run.
+    Inputs are always read on the calling thread.
+    :param inputs: a dictionary of names to readers (or anything that can be sliced)
+    :param outputs: a dictionary of names to writers
+    :param predicate: the function to be run on each chunk
+    :param chunksize: the number of rows in each chunk
+    :param workers: optional - the number of chunks processed at once
+    :param executor: 'thread' (the default) or 'process'; predicates run in a process
+    pool must be picklable
+    :param jit: optional - if set, the predicate is compiled with numba. The predicate must
+    then only use numeric inputs and outputs. Compiled predicates release the GIL, so they
+    run in parallel in a thread pool
+    """
+    if executor not in PROCESS_EXECUTORS:
+        msg = "'executor' must be one of {} but is {}"
+        raise ValueError(msg.format(PROCESS_EXECUTORS, executor))
+    if workers is not None and (not isinstance(workers, int) or workers < 1):
+        raise ValueError("'workers' must be a positive integer but is {}".format(workers))
+    if jit is True:
+        predicate = njit(nogil=True)(predicate)
+
+    input_length = len(next(iter(inputs.values())))
+    output_names = list(outputs.keys())
+
+    def write(results):
+        for k in output_names:
+            outputs[k].write_part(results[k])
+
+    if workers is None or workers == 1:
+        required_chunksize = min(input_length, chunksize)
+        output_arrays = {k: w.chunk_factory(required_chunksize) for k, w in outputs.items()}
+        for c in ops.chunks(input_length, chunksize):
+            kwargs = {k: v[c[0]:c[1]] for k, v in inputs.items()}
+            for k, v in output_arrays.items():
+                kwargs[k] = v[:c[1] - c[0]]
+            predicate(**kwargs)
+            write(kwargs)
+    else:
+        pool_type = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+        with pool_type(max_workers=workers) as pool:
+            pending = deque()
+            for c in ops.chunks(input_length, chunksize):
+                kwargs = {k: v[c[0]:c[1]] for k, v in inputs.items()}
+                for k, w in outputs.items():
+                    kwargs[k] = w.chunk_factory(c[1] - c[0])
+                pending.append(pool.submit(_run_predicate, predicate, kwargs, output_names))
+                # bound the number of chunks in flight, writing completed chunks in order
+                while len(pending) >= 2 * workers:
+                    write(pending.popleft().result())
+            while len(pending) > 0:
+                write(pending.popleft().result())
+
+    for w in outputs.values():
+        w.flush()
+
+
 class DataStore:
 
     def __init__(self, chunksize=DEFAULT_CHUNKSIZE,
@@ -862,24 +927,23 @@ class DataStore:
 
 
     # TODO: write distinct with new readers / writers rather than deleting this
-    def distinct(self, field=None, fields=None, filter=None):
+    def distinct(self, field=None, fields=None, filter=None, return_index=False,
+                 return_counts=False):
         if field is None and fields is None:
-            return ValueError("One of 'field' and 'fields' must be set")
+            raise ValueError("One of 'field' and 'fields' must be set")
         if field is not None and fields is not None:
-            return ValueError("Only one of 'field' and 'fields' may be set")
-
-        if field is not None:
-            field_ = val.raw_array_from_parameter(self, 'field', field)
-            return np.unique(field_)
-
-        entries = [(f'{i}', f.dtype) for i, f in enumerate(fields)]
-        unified = np.empty_like(fields[0], dtype=np.dtype(entries))
-        for i, f in enumerate(fields):
-            unified[f'{i}'] = f
+            raise ValueError("Only one of 'field' and 'fields' may be set")
 
-        uniques = np.unique(unified)
-        results = [uniques[f'{i}'] for i in range(len(fields))]
-        return results
+        columns = [field] if field is not None else fields
+        columns = [self.get_reader(c) if isinstance(c, h5py.Group) else c for c in columns]
+        if isinstance(filter, h5py.Group):
+            filter = self.get_reader(filter)
+        results = ops.distinct(columns, filter, self.chunksize, return_index, return_counts)
+        if field is None:
+            return results
+        if return_index or return_counts:
+            return (results[0][0],) + results[1:]
+        return results[0]
 
 
     def get_spans(self, field=None, fields=None):
@@ -1323,70 +1387,27 @@ class DataStore:
             yield cur, next
             cur = next
 
-    def process(self, inputs, outputs, predicate):
-
-        # TODO: modifying the dictionaries in place is not great
+    def process(self, inputs, outputs, predicate, workers=None, executor='thread', jit=False):
+        """
+        Run 'predicate' over the inputs a chunk at a time, writing its results to the
+        outputs; see 'process_chunks' for a description of the parameters.
+        """
         input_readers = dict()
         for k, v in inputs.items():
             if isinstance(v, rw.Reader):
                 input_readers[k] = v
             else:
                 input_readers[k] = self.get_reader(v)
-        output_writers = dict()
-        output_arrays = dict()
         for k, v in outputs.items():
-            if isinstance(v, rw.Writer):
-                output_writers[k] = v
-            else:
+            if not isinstance(v, rw.Writer):
                 raise ValueError("'outputs': all values must be 'Writers'")
 
-        reader = next(iter(input_readers.values()))
-        input_length = len(reader)
-        writer = next(iter(output_writers.values()))
-        chunksize = writer.chunksize
-        required_chunksize = min(input_length, chunksize)
-        for k, v in outputs.items():
-            output_arrays[k] = output_writers[k].chunk_factory(required_chunksize)
-
-        for c in self.chunks(input_length, chunksize):
-            kwargs = dict()
-
-            for k, v in inputs.items():
-                kwargs[k] = v[c[0]:c[1]]
-            for k, v in output_arrays.items():
-                kwargs[k] = v[:c[1] - c[0]]
-            predicate(**kwargs)
-
-            # TODO: write back to the writer
-            for k in output_arrays.keys():
-                output_writers[k].write_part(kwargs[k])
-        for k, v in output_writers.items():
-            output_writers[k].flush()
+        chunksize = next(iter(outputs.values())).chunksize
+        process_chunks(input_readers, outputs, predicate, chunksize, workers, executor, jit)
 
 
     def get_index(self, target, foreign_key, destination=None):
-        # print('  building patient_id index')
-        t0 = time.time()
-        target_lookup = dict()
-        for i, v in enumerate(target[:]):
-            target_lookup[v] = i
-        # print(f'  target lookup built in {time.time() - t0}s')
-
-        # print('  perform initial index')
-        t0 = time.time()
-        foreign_key_elems = foreign_key[:]
-        # foreign_key_index = np.asarray([target_lookup.get(i, -1) for i in foreign_key_elems],
-        #                                    dtype=np.int64)
-        foreign_key_index = np.zeros(len(foreign_key_elems), dtype=np.int64)
-
-        current_invalid = np.int64(INVALID_INDEX)
-        for i_k, k in enumerate(foreign_key_elems):
-            index = target_lookup.get(k, current_invalid)
-            if index >= INVALID_INDEX:
-                current_invalid += 1
-                target_lookup[k] = index
-            foreign_key_index[i_k] = index
-        # print(f'  initial index performed in {time.time() - t0}s')
+        foreign_key_index = ops.get_index(target[:], foreign_key[:])
 
         if destination:
             destination.write(foreign_key_index)
@@ -0,0 +1,783 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import operator
+
+import numpy as np
+from numba import njit
+
+from exetera.core import fields
+from exetera.core import operations as ops
+
+
+# expressions
+# ===========
+
+_BINARY_OPS = {
+    '+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv,
+    '//': operator.floordiv, '%': operator.mod, '**': operator.pow,
+    '==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge, '&': operator.and_, '|': operator.or_
+}
+
+_UNARY_OPS = {'-': operator.neg, '~': operator.invert}
+
+
+def _as_expr(value):
+    return value if isinstance(value, Expr) else Lit(value)
+
+
+class Expr:
+    """
+    An element-wise expression over the columns of a LazyFrame. Expressions are built with
+    'col' and 'lit' and the usual arithmetic, comparison and logical operators; '&', '|'
+    and '~' are used for 'and', 'or' and 'not'.
+    """
+    __hash__ = object.__hash__
+
+    def _binary(self, op, other, reverse=False):
+        other = _as_expr(other)
+        return BinaryOp(op, other, self) if reverse else BinaryOp(op, self, other)
+
+    def __add__(self, other): return self._binary('+', other)
+    def __radd__(self, other): return self._binary('+', other, True)
+    def __sub__(self, other): return self._binary('-', other)
+    def __rsub__(self, other): return self._binary('-', other, True)
+    def __mul__(self, other): return self._binary('*', other)
+    def __rmul__(self, other): return self._binary('*', other, True)
+    def __truediv__(self, other): return self._binary('/', other)
+    def __rtruediv__(self, other): return self._binary('/', other, True)
+    def __floordiv__(self, other): return self._binary('//', other)
+    def __rfloordiv__(self, other): return self._binary('//', other, True)
+    def __mod__(self, other): return self._binary('%', other)
+    def __rmod__(self, other): return self._binary('%', other, True)
+    def __pow__(self, other): return self._binary('**', other)
+    def __rpow__(self, other): return self._binary('**', other, True)
+    def __eq__(self, other): return self._binary('==', other)
+    def __ne__(self, other): return self._binary('!=', other)
+    def __lt__(self, other): return self._binary('<', other)
+    def __le__(self, other): return self._binary('<=', other)
+    def __gt__(self, other): return self._binary('>', other)
+    def __ge__(self, other): return self._binary('>=', other)
+    def __and__(self, other): return self._binary('&', other)
+    def __rand__(self, other): return self._binary('&', other, True)
+    def __or__(self, other): return self._binary('|', other)
+    def __ror__(self, other): return self._binary('|', other, True)
+    def __neg__(self): return UnaryOp('-', self)
+    def __invert__(self): return UnaryOp('~', self)
+
+    def map(self, fn, *others):
+        """
+        Apply an element-wise function 'fn' to this expression (and 'others'); 'fn' is
+        called with ndarrays and must return an ndarray of the same length.
+        """
+        return MapExpr(fn, [self] + [_as_expr(o) for o in others])
+
+    def isin(self, values):
+        values = np.asarray(values)
+        return MapExpr(lambda x: np.isin(x, values), [self])
+
+    def columns(self):
+        raise NotImplementedError()
+
+    def evaluate(self, chunk):
+        raise NotImplementedError()
+
+
+class Col(Expr):
+    def __init__(self, name):
+        self.name = name
+
+    def columns(self):
+        return {self.name}
+
+    def evaluate(self, chunk):
+        return chunk[self.name]
+
+    def __repr__(self):
+        return self.name
+
+
+class Lit(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def columns(self):
+        return set()
+
+    def evaluate(self, chunk):
+        return self.value
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class BinaryOp(Expr):
+    def __init__(self, op, left, right):
+        self.op, self.left, self.right = op, left, right
+
+    def columns(self):
+        return self.left.columns() | self.right.columns()
+
+    def evaluate(self, chunk):
+        return _BINARY_OPS[self.op](self.left.evaluate(chunk), self.right.evaluate(chunk))
+
+    def __repr__(self):
+        return '({} {} {})'.format(self.left, self.op, self.right)
+
+
+class UnaryOp(Expr):
+    def __init__(self, op, operand):
+        self.op, self.operand = op, operand
+
+    def columns(self):
+        return self.operand.columns()
+
+    def evaluate(self, chunk):
+        return _UNARY_OPS[self.op](self.operand.evaluate(chunk))
+
+    def __repr__(self):
+        return '{}{}'.format(self.op, self.operand)
+
+
+class MapExpr(Expr):
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+
+    def columns(self):
+        return set().union(*[a.columns() for a in self.args])
+
+    def evaluate(self, chunk):
+        return self.fn(*[a.evaluate(chunk) for a in self.args])
+
+    def __repr__(self):
+        return '{}({})'.format(getattr(self.fn, '__name__', 'map'),
+                               ', '.join(repr(a) for a in self.args))
+
+
+def col(name):
+    """
+    Refer to the column 'name' in an expression.
+    """
+    return Col(name)
+
+
+def lit(value):
+    """
+    A literal value in an expression.
+    """
+    return Lit(value)
+
+
+def _empty_chunk(schema, names):
+    return {n: np.zeros(0, dtype=schema[n]) for n in names}
+
+
+def _expr_dtype(expr, schema):
+    missing = expr.columns() - set(schema)
+    if len(missing) > 0:
+        raise ValueError("the expression {} refers to columns {} that are not present; the "
+                         "available columns are {}".format(expr, sorted(missing), list(schema)))
+    return np.asarray(expr.evaluate(_empty_chunk(schema, expr.columns()))).dtype
+
+
+def _full_length(values, length):
+    values = np.asarray(values)
+    return np.full(length, values) if values.ndim == 0 else values
+
+
+# fused element-wise stages
+# =========================
+
+_FUSED_KERNELS = dict()
+
+_COMPILABLE_KINDS = 'biuf'
+
+
+def _compilable(expr, schema):
+    if isinstance(expr, Col):
+        return np.dtype(schema[expr.name]).kind in _COMPILABLE_KINDS
+    if isinstance(expr, Lit):
+        return isinstance(expr.value, (bool, int, float, np.bool_, np.number))
+    if isinstance(expr, BinaryOp):
+        return _compilable(expr.left, schema) and _compilable(expr.right, schema)
+    if isinstance(expr, UnaryOp):
+        return _compilable(expr.operand, schema)
+    return False
+
+
+class _StageKernel:
+    """
+    Generates a single compiled loop that evaluates all of the filters and derived columns
+    of a stage for each row, without materialising any intermediate arrays. The loop
+    produces a mask of the rows that pass every filter and the full-length derived
+    columns, which are then compressed along with any columns passed through.
+    """
+    def __init__(self, steps, schema, outputs):
+        self.inputs = list()
+        self.literals = list()
+        self.derived = list()
+        self.derived_dtypes = list()
+        current = dict()
+        dtypes = dict(schema)
+        body = list()
+
+        def generate(expr):
+            if isinstance(expr, Col):
+                if expr.name in current:
+                    return current[expr.name]
+                if expr.name not in self.inputs:
+                    self.inputs.append(expr.name)
+                return 'a_{}[i]'.format(self.inputs.index(expr.name))
+            if isinstance(expr, Lit):
+                self.literals.append(expr.value)
+                return 'l_{}'.format(len(self.literals) - 1)
+            if isinstance(expr, BinaryOp):
+                return '({} {} {})'.format(generate(expr.left), expr.op, generate(expr.right))
+            if expr.op == '~' and _expr_dtype(expr.operand, dtypes) == np.bool_:
+                return '(not {})'.format(generate(expr.operand))
+            return '({}{})'.format(expr.op, generate(expr.operand))
+
+        for step in steps:
+            if step[0] == 'filter':
+                body.append('if not {}:'.format(generate(step[1])))
+                body.append('    continue')
+            elif step[0] == 'with_column':
+                local = 't_{}'.format(len(body))
+                body.append('{} = {}'.format(local, generate(step[2])))
+                dtypes[step[1]] = _expr_dtype(step[2], dtypes)
+                current[step[1]] = local
+        for name in outputs:
+            if name in current:
+                self.derived.append(name)
+                self.derived_dtypes.append(dtypes[name])
+                body.append('d_{}[i] = {}'.format(len(self.derived) - 1, current[name]))
+        body.append('keep[i] = True')
+
+        args = ['n', 'keep'] + ['a_{}'.format(i) for i in range(len(self.inputs))] + \
+               ['l_{}'.format(i) for i in range(len(self.literals))] + \
+               ['d_{}'.format(i) for i in range(len(self.derived))]
+        self.source = 'def _fused({}):\n    for i in range(n):\n{}\n'.format(
+            ', '.join(args), '\n'.join('        ' + line for line in body))
+        self.kernel = _FUSED_KERNELS.get(self.source)
+        if self.kernel is None:
+            scope = dict()
+            exec(self.source, scope)
+            self.kernel = njit(error_model='numpy')(scope['_fused'])
+            _FUSED_KERNELS[self.source] = self.kernel
+
+    def __call__(self, chunk, length):
+        keep = np.zeros(length, dtype=bool)
+        derived = [np.zeros(length, dtype=d) for d in self.derived_dtypes]
+        self.kernel(length, keep, *[chunk[n] for n in self.inputs], *self.literals, *derived)
+        return keep, dict(zip(self.derived, derived))
+
+
+# plan nodes
+# ==========
+
+class _Node:
+    def children(self):
+        return []
+
+    def describe(self):
+        raise NotImplementedError()
+
+    def explain(self, depth=0):
+        lines = ['  ' * depth + self.describe()]
+        for c in self.children():
+            lines.append(c.explain(depth + 1))
+        return '\n'.join(lines)
+
+
+class _Scan(_Node):
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+
+    def schema(self):
+        schema = dict()
+        for name, c in self.columns.items():
+            if isinstance(c, fields.IndexedStringField):
+                schema[name] = np.dtype(object)
+            elif isinstance(c, fields.Field):
+                schema[name] = c.data.dtype
+            else:
+                schema[name] = c.dtype
+        return schema
+
+    def describe(self):
+        return 'Scan({})'.format(', '.join(self.columns))
+
+    def execute(self, chunksize):
+        for c in ops.chunks(self.length, chunksize):
+            chunk = dict()
+            for name, column in self.columns.items():
+                if isinstance(column, fields.IndexedStringField):
+                    values = column.data[c[0]:c[1]]
+                    chunk[name] = np.empty(len(values), dtype=object)
+                    chunk[name][:] = values
+                else:
+                    chunk[name] = ops._key_chunk(column, c[0], c[1])
+            yield chunk
+
+
+class _Filter(_Node):
+    def __init__(self, child, expr):
+        self.child, self.expr = child, expr
+
+    def children(self):
+        return [self.child]
+
+    def schema(self):
+        return self.child.schema()
+
+    def describe(self):
+        return 'Filter({})'.format(self.expr)
+
+
+class _WithColumn(_Node):
+    def __init__(self, child, name, expr):
+        self.child, self.name, self.expr = child, name, expr
+
+    def children(self):
+        return [self.child]
+
+    def schema(self):
+        schema = dict(self.child.schema())
+        schema[self.name] = _expr_dtype(self.expr, schema)
+        return schema
+
+    def describe(self):
+        return 'WithColumn({} = {})'.format(self.name, self.expr)
+
+
+class _Select(_Node):
+    def __init__(self, child, names):
+        self.child, self.names = child, list(names)
+
+    def children(self):
+        return [self.child]
+
+    def schema(self):
+        schema = self.child.schema()
+        return {n: schema[n] for n in self.names}
+
+    def describe(self):
+        return 'Select({})'.format(', '.join(self.names))
+
+
+class _Stage(_Node):
+    """
+    A fused sequence of filters, derived columns and selections that is applied to each
+    chunk of its child in a single pass.
+    """
+    def __init__(self, child, steps, outputs):
+        self.child, self.steps, self.outputs = child, steps, outputs
+        schema = child.schema()
+        self.kernel = None
+        expressions = [s[-1] for s in steps if s[0] != 'select']
+        current = dict(schema)
+        compilable = True
+        for step in steps:
+            if step[0] == 'filter':
+                compilable = compilable and _compilable(step[1], current)
+            elif step[0] == 'with_column':
+                compilable = compilable and _compilable(step[2], current)
+                current[step[1]] = _expr_dtype(step[2], current)
+        if compilable and len(expressions) > 0:
+            self.kernel = _StageKernel(steps, schema, outputs)
+
+    def children(self):
+        return [self.child]
+
+    def schema(self):
+        node = self.child.schema()
+        schema = dict(node)
+        for step in self.steps:
+            if step[0] == 'with_column':
+                schema[step[1]] = _expr_dtype(step[2], schema)
+        return {n: schema[n] for n in self.outputs}
+
+    def describe(self):
+        steps = list()
+        for step in self.steps:
+            if step[0] == 'filter':
+                steps.append('filter {}'.format(step[1]))
+            elif step[0] == 'with_column':
+                steps.append('{} = {}'.format(step[1], step[2]))
+            else:
+                steps.append('select {}'.format(', '.join(step[1])))
+        return 'Stage[{}]({}) -> {}'.format('compiled' if self.kernel else 'numpy',
+                                           '; '.join(steps), ', '.join(self.outputs))
+
+    def apply(self, chunk):
+        length = len(next(iter(chunk.values()))) if len(chunk) > 0 else 0
+        if self.kernel is not None:
+            keep, derived = self.kernel(chunk, length)
+            return {n: derived[n][keep] if n in derived else chunk[n][keep]
+                    for n in self.outputs}
+        chunk = dict(chunk)
+        for step in self.steps:
+            if step[0] == 'filter':
+                mask = _full_length(step[1].evaluate(chunk), length).astype(bool)
+                chunk = {k: v[mask] for k, v in chunk.items()}
+                length = int(np.count_nonzero(mask))
+            elif step[0] == 'with_column':
+                chunk[step[1]] = _full_length(step[2].evaluate(chunk), length)
+        return {n: chunk[n] for n in self.outputs}
+
+    def execute(self, chunksize):
+        for chunk in self.child.execute(chunksize):
+            yield self.apply(chunk)
+
+
+def _map_valid(values, map_, filter_):
+    if values.dtype.hasobject:
+        result = np.full(len(map_), '', dtype=object)
+    else:
+        result = np.zeros(len(map_), dtype=values.dtype)
+    result[filter_] = values[map_[filter_]]
+    return result
+
+
+class _Join(_Node):
+    def __init__(self, left, right, left_on, right_on, how):
+        self.left, self.right = left, right
+        self.left_on, self.right_on, self.how = left_on, right_on, how
+
+    def children(self):
+        return [self.left, self.right]
+
+    def right_columns(self):
+        return [n for n in self.right.schema()
+                if not (n == self.right_on and n == self.left_on)]
+
+    def schema(self):
+        schema = dict(self.left.schema())
+        right = self.right.schema()
+        for n in self.right_columns():
+            schema[n] = right[n]
+        return schema
+
+    def describe(self):
+        return 'Join({}, {} = {})'.format(self.how, self.left_on, self.right_on)
+
+    def execute(self, chunksize):
+        # the right side is the build side and is held in memory; the left side streams
+        right = _collect(self.right, chunksize)
+        dtype = ops.common_key_dtype(self.left.schema()[self.left_on],
+                                     self.right.schema()[self.right_on])
+        index = ops.HashJoinIndex(right[self.right_on], dtype)
+        for chunk in self.left.execute(chunksize):
+            left_map, right_map, right_filter = index.probe(chunk[self.left_on], self.how)
+            result = {k: v[left_map] for k, v in chunk.items()}
+            for n in self.right_columns():
+                result[n] = _map_valid(right[n], right_map, right_filter)
+            yield result
+
+
+class _Aggregate(_Node):
+    def __init__(self, child, key, aggregations):
+        self.child, self.key, self.aggregations = child, key, dict(aggregations)
+
+    def children(self):
+        return [self.child]
+
+    def schema(self):
+        child = self.child.schema()
+        schema = {self.key: child[self.key]}
+        for name, (src, agg) in self.aggregations.items():
+            schema[name] = ops.span_aggregation_dtype(agg, child[src])
+        return schema
+
+    def describe(self):
+        return 'Aggregate({}; {})'.format(
+            self.key, ', '.join('{} = {}({})'.format(n, a, s)
+                                for n, (s, a) in self.aggregations.items()))
+
+    def execute(self, chunksize):
+        child = self.child.schema()
+        sources = list()
+        for src, agg in self.aggregations.values():
+            if src not in sources:
+                sources.append(src)
+        source_aggs = [[a for s, a in self.aggregations.values() if s == src]
+                       for src in sources]
+        group_by = ops.HashGroupBy(child[self.key],
+                                   [(child[s], aggs) for s, aggs in zip(sources, source_aggs)])
+        for chunk in self.child.execute(chunksize):
+            group_by.add(chunk[self.key], [(chunk[s], None) for s in sources])
+        keys, results = group_by.results()
+        columns = {self.key: keys}
+        for name, (src, agg) in self.aggregations.items():
+            columns[name] = results[sources.index(src)][agg]
+        for c in ops.chunks(len(keys), chunksize):
+            yield {k: v[c[0]:c[1]] for k, v in columns.items()}
+
+
+def _collect(node, chunksize):
+    parts = {n: list() for n in node.schema()}
+    for chunk in node.execute(chunksize):
+        for n, v in chunk.items():
+            parts[n].append(v)
+    schema = node.schema()
+    return {n: np.concatenate(p) if len(p) > 0 else np.zeros(0, dtype=schema[n])
+            for n, p in parts.items()}
+
+
+# optimisation
+# ============
+
+def _rebuild(node, children):
+    if isinstance(node, _Filter):
+        return _Filter(children[0], node.expr)
+    if isinstance(node, _WithColumn):
+        return _WithColumn(children[0], node.name, node.expr)
+    if isinstance(node, _Select):
+        return _Select(children[0], node.names)
+    if isinstance(node, _Join):
+        return _Join(children[0], children[1], node.left_on, node.right_on, node.how)
+    if isinstance(node, _Aggregate):
+        return _Aggregate(children[0], node.key, node.aggregations)
+    return node
+
+
+def _push_filter(expr, child):
+    columns = expr.columns()
+    if isinstance(child, _WithColumn) and child.name not in columns:
+        return _WithColumn(_push_filter(expr, child.child), child.name, child.expr)
+    if isinstance(child, (_Select, _Filter)):
+        return _rebuild(child, [_push_filter(expr, child.child)])
+    if isinstance(child, _Join):
+        if columns <= set(child.left.schema()):
+            return _Join(_push_filter(expr, child.left), child.right,
+                         child.left_on, child.right_on, child.how)
+        if child.how == 'inner' and columns <= set(child.right.schema()):
+            return _Join(child.left, _push_filter(expr, child.right),
+                         child.left_on, child.right_on, child.how)
+    if isinstance(child, _Aggregate) and columns <= {child.key}:
+        return _Aggregate(_push_filter(expr, child.child), child.key, child.aggregations)
+    return _Filter(child, expr)
+
+
+def push_down_filters(node):
+    """
+    Move filters as close to the scans as possible: below derived columns that they don't
+    refer to, below joins to the side whose columns they refer to, and below aggregations
+    when they only refer to the group key.
+    """
+    children = [push_down_filters(c) for c in node.children()]
+    if isinstance(node, _Filter):
+        return _push_filter(node.expr, children[0])
+    return _rebuild(node, children)
+
+
+def prune_columns(node, required=None):
+    """
+    Remove columns that are not required by the result of the plan, so that they are
+    neither read from the source fields nor calculated.
+    """
+    if required is None:
+        required = set(node.schema())
+    if isinstance(node, _Scan):
+        names = [n for n in node.columns if n in required]
+        if len(names) == 0:
+            names = list(node.columns)[:1]
+        return _Scan({n: node.columns[n] for n in names}, node.length)
+    if isinstance(node, _Filter):
+        return _Filter(prune_columns(node.child, required | node.expr.columns()), node.expr)
+    if isinstance(node, _WithColumn):
+        if node.name not in required:
+            return prune_columns(node.child, required)
+        child_required = (required - {node.name}) | node.expr.columns()
+        return _WithColumn(prune_columns(node.child, child_required), node.name, node.expr)
+    if isinstance(node, _Select):
+        names = [n for n in node.names if n in required]
+        return _Select(prune_columns(node.child, set(names)), names)
+    if isinstance(node, _Join):
+        left = (required & set(node.left.schema())) | {node.left_on}
+        right = (required & set(node.right.schema())) | {node.right_on}
+        return _Join(prune_columns(node.left, left), prune_columns(node.right, right),
+                     node.left_on, node.right_on, node.how)
+    if isinstance(node, _Aggregate):
+        aggregations = {n: a for n, a in node.aggregations.items() if n in required}
+        child_required = {node.key} | {s for s, _ in aggregations.values()}
+        return _Aggregate(prune_columns(node.child, child_required), node.key, aggregations)
+    return node
+
+
+def fuse(node):
+    """
+    Fuse each chain of filters, derived columns and selections into a single stage that is
+    applied to each chunk in one pass.
+    """
+    if isinstance(node, (_Filter, _WithColumn, _Select)):
+        outputs = list(node.schema())
+        steps = list()
+        while isinstance(node, (_Filter, _WithColumn, _Select)):
+            if isinstance(node, _Filter):
+                steps.append(('filter', node.expr))
+            elif isinstance(node, _WithColumn):
+                steps.append(('with_column', node.name, node.expr))
+            else:
+                steps.append(('select', node.names))
+            node = node.child
+        return _Stage(fuse(node), steps[::-1], outputs)
+    return _rebuild(node, [fuse(c) for c in node.children()])
+
+
+def optimise(node):
+    return fuse(prune_columns(push_down_filters(node)))
+
+
+# lazy frames
+# ===========
+
+AGGREGATIONS = ops.SPAN_AGGREGATIONS
+
+
+class LazyFrame:
+    """
+    A lazily evaluated table of columns. Operations on a LazyFrame build a plan rather
+    than reading or writing any data; when the frame is collected, the plan is optimised
+    and then executed a chunk at a time:
+     * filters are pushed down towards the source fields
+     * columns that are not needed for the result are neither read nor calculated
+     * each chain of element-wise filters and derived columns is fused into a single pass
+       over each chunk, which is compiled when the columns it uses are numeric
+    :param session: the session used to create result fields
+    :param node: the plan that generates the frame
+    :param chunksize: the number of rows of the source fields processed at a time
+    """
+    def __init__(self, session, node, chunksize=None):
+        self._session = session
+        self._node = node
+        self.chunksize = ops.DEFAULT_CHUNKSIZE if chunksize is None else chunksize
+
+    def _derive(self, node):
+        return LazyFrame(self._session, node, self.chunksize)
+
+    @property
+    def columns(self):
+        return list(self._node.schema())
+
+    @property
+    def dtypes(self):
+        return dict(self._node.schema())
+
+    def _check_columns(self, names):
+        missing = set(names) - set(self.columns)
+        if len(missing) > 0:
+            raise ValueError("columns {} are not present; the available columns are "
+                             "{}".format(sorted(missing), self.columns))
+
+    def filter(self, predicate):
+        """
+        Keep only the rows for which the boolean expression 'predicate' is True.
+        """
+        predicate = _as_expr(predicate)
+        _expr_dtype(predicate, self._node.schema())
+        return self._derive(_Filter(self._node, predicate))
+
+    def with_column(self, name, expr):
+        """
+        Add (or replace) the column 'name' with the values of the expression 'expr'.
+        """
+        expr = _as_expr(expr)
+        _expr_dtype(expr, self._node.schema())
+        return self._derive(_WithColumn(self._node, name, expr))
+
+    def select(self, *names):
+        """
+        Keep only the columns 'names'.
+        """
+        self._check_columns(names)
+        return self._derive(_Select(self._node, names))
+
+    def join(self, other, left_on, right_on=None, how='left'):
+        """
+        Join the rows of 'other' onto this frame by matching 'left_on' with 'right_on'.
+        The rows of the result follow the order of this frame. 'other' is collected into
+        memory as the build side of a hash join, and this frame is streamed through it.
+        :param other: the LazyFrame to join onto this frame
+        :param left_on: the key column of this frame
+        :param right_on: the key column of 'other'; defaults to 'left_on'
+        :param how: 'left' or 'inner'
+        """
+        right_on = left_on if right_on is None else right_on
+        if how not in ('left', 'inner'):
+            raise ValueError("'how' must be one of 'left' or 'inner' but is {}".format(how))
+        self._check_columns([left_on])
+        other._check_columns([right_on])
+        clashes = [n for n in other.columns if n in self.columns and
+                   not (n == right_on and n == left_on)]
+        if len(clashes) > 0:
+            raise ValueError("columns {} are present in both frames".format(clashes))
+        return self._derive(_Join(self._node, other._node, left_on, right_on, how))
+
+    def aggregate(self, key, aggregations):
+        """
+        Group the rows by the values of 'key' and aggregate each group. Groups appear in
+        the order in which their keys first appear, so sorted keys give sorted groups.
+        :param key: the key column, which must have a fixed-width dtype
+        :param aggregations: a dictionary of result column name to (column, aggregation)
+        tuples, where aggregation is one of AGGREGATIONS
+        """
+        self._check_columns([key] + [s for s, _ in aggregations.values()])
+        schema = self._node.schema()
+        if schema[key].hasobject:
+            raise ValueError("'key' must have a fixed-width dtype")
+        for name, (_, agg) in aggregations.items():
+            if agg not in AGGREGATIONS:
+                msg = "'{}' is not a supported aggregation; it must be one of {}"
+                raise ValueError(msg.format(agg, AGGREGATIONS))
+        return self._derive(_Aggregate(self._node, key, aggregations))
+
+    def plan(self):
+        """
+        Get the optimised plan of the frame.
+        """
+        return optimise(self._node)
+
+    def explain(self):
+        """
+        Describe the optimised plan of the frame.
+        """
+        return self.plan().explain()
+
+    def collect(self, dest=None):
+        """
+        Execute the plan.
+        :param dest: optional - a group to which the columns of the result are written as
+        fields, a chunk at a time
+        :return: a dictionary of column names to ndarrays or, if 'dest' is set, to fields
+        """
+        plan = self.plan()
+        if dest is None:
+            return _collect(plan, self.chunksize)
+
+        schema = plan.schema()
+        results = {n: self._create_field(dest, n, d) for n, d in schema.items()}
+        for chunk in plan.execute(self.chunksize):
+            for n, v in chunk.items():
+                if len(v) > 0:
+                    results[n].data.write_part(v.tolist() if v.dtype.hasobject else v)
+        for f in results.values():
+            f.data.complete()
+        return results
+
+    def _create_field(self, group, name, dtype):
+        if dtype.hasobject:
+            return self._session.create_indexed_string(group, name)
+        if dtype.kind == 'S':
+            return self._session.create_fixed_string(group, name, dtype.itemsize)
+        return self._session.create_numeric(group, name, dtype.name)
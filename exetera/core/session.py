@@ -1,10 +1,11 @@
 import os
+import json
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pandas as pd
 
 import h5py
 
@@ -14,6 +15,12 @@ from exetera.core import fields as fld
 from exetera.core import readerwriter as rw
 from exetera.core import validation as val
 from exetera.core import operations as ops
+from exetera.core import join_map as jm
+from exetera.core import filtered_field as ff
+from exetera.core import query
+from exetera.core import bitmap as bm
+from exetera.core import indexes as idx
+from exetera.core import sketches as sk
 from exetera.core import utils
 
 
@@ -57,13 +64,28 @@ from exetera.core import utils
 class Session:
 
     def __init__(self, chunksize=ops.DEFAULT_CHUNKSIZE,
-                 timestamp=str(datetime.now(timezone.utc))):
+                 timestamp=str(datetime.now(timezone.utc)), threads=None):
         if not isinstance(timestamp, str):
             error_str = "'timestamp' must be a string but is of type {}"
             raise ValueError(error_str.format(type(timestamp)))
         self.chunksize = chunksize
         self.timestamp = timestamp
         self.datasets = dict()
+        self.set_threads(threads)
+
+
+    def set_threads(self, threads=None):
+        """
+        Set the number of threads used by the parallel kernels of this session, such as
+        those used by the apply_spans functions. If not set, numba's default thread count
+        is used. Setting the thread count to 1 runs all kernels sequentially.
+
+        :param threads: the number of threads, or None for the default
+        :return: None
+        """
+        if threads is not None and (not isinstance(threads, int) or threads < 1):
+            raise ValueError("'threads' must be a positive integer or None but is {}".format(threads))
+        self.threads = threads
 
 
     def __enter__(self):
@@ -118,7 +140,7 @@ class Session:
         self.datasets = dict()
 
 
-    def get_shared_index(self, keys):
+    def get_shared_index(self, keys, destinations=None):
         """
         Create a shared index based on a tuple numpy arrays containing keys.
         This function generates the sorted union of a tuple of key fields and
@@ -136,23 +158,39 @@ class Session:
             key_2_index = [1, 1, 2, 2, 4, 5, 8]
             key_3_index = [0, 2, 3, 4, 5, 6, 6, 7]
 
+        If 'destinations' is set, the keys are read in chunks and each key's index is
+        written to the corresponding destination field as it is generated. When all of
+        the keys are sorted, the sorted union is built by merging the keys a chunk at a
+        time, so no key is loaded in its entirety.
+
             :param keys: a tuple of groups, fields or ndarrays whose contents represent keys
+            :param destinations: optional - a tuple of groups or fields, one per key, to
+            which the indices are written
+            :return: a tuple of the destination fields if 'destinations' is set, otherwise
+            a tuple of numpy arrays
         """
         if not isinstance(keys, tuple):
             raise ValueError("'keys' must be a tuple")
-        concatted = None
-        raw_keys = list()
-        for k in keys:
-            raw_field = val.raw_array_from_parameter(self, 'keys', k)
-            raw_keys.append(raw_field)
-            if concatted is None:
-                concatted = pd.unique(raw_field)
-            else:
-                concatted = np.concatenate((concatted, raw_field), axis=0)
-        concatted = pd.unique(concatted)
-        concatted = np.sort(concatted)
 
-        return tuple(np.searchsorted(concatted, k) for k in raw_keys)
+        if destinations is not None:
+            if not isinstance(destinations, tuple) or len(destinations) != len(keys):
+                raise ValueError("'destinations' must be a tuple of the same length as 'keys'")
+            keys_ = tuple(val.field_from_parameter(self, 'keys', k)
+                          if val.is_field_parameter(k)
+                          else val.raw_array_from_parameter(self, 'keys', k)
+                          for k in keys)
+            destinations_ = tuple(val.field_from_parameter(self, 'destinations', d)
+                                  for d in destinations)
+            ops.get_shared_index_streamed(keys_, destinations_, self.chunksize)
+            return destinations_
+
+        raw_keys = [val.raw_array_from_parameter(self, 'keys', k) for k in keys]
+        union = None
+        for k in raw_keys:
+            distinct = np.unique(k)
+            union = distinct if union is None else np.union1d(union, distinct)
+
+        return tuple(np.searchsorted(union, k) for k in raw_keys)
 
 
     def set_timestamp(self, timestamp=str(datetime.now(timezone.utc))):
@@ -250,17 +288,26 @@ class Session:
         return acc_index
 
 
-    def apply_filter(self, filter_to_apply, src, dest=None):
+    def apply_filter(self, filter_to_apply, src, dest=None, stream=False):
         """
         Apply a filter to an a src field. The filtered field is written to dest if it set,
         and returned from the function call. If the field is an IndexedStringField, the
         indices and values are returned separately.
 
-        :param filter_to_apply: the filter to be applied to the source field
+        :param filter_to_apply: the filter to be applied to the source field. This can also
+        be a Bitmap, such as one taken from a bitmap index
         :param src: the field to be filtered
         :param dest: optional - a field to write the filtered data to
+        :param stream: optional - if set, the filter and the source field are read a chunk
+        at a time and each filtered chunk is written to dest, which must be set, so that
+        memory use doesn't scale with the size of the field. dest is returned.
         :return: the filtered values
         """
+        if stream is True:
+            return self._apply_streamed('filter_to_apply', filter_to_apply, src, dest,
+                                        ops.apply_filter_streamed)
+        if isinstance(filter_to_apply, bm.Bitmap):
+            filter_to_apply = filter_to_apply.to_filter()
         filter_to_apply_ = val.array_from_parameter(self, 'index_to_apply', filter_to_apply)
         writer_ = None
         if dest is not None:
@@ -282,7 +329,7 @@ class Session:
             return result
 
 
-    def apply_index(self, index_to_apply, src, dest=None):
+    def apply_index(self, index_to_apply, src, dest=None, stream=False, memory_budget=None):
         """
         Apply a index to an a src field. The indexed field is written to dest if it set,
         and returned from the function call. If the field is an IndexedStringField, the
@@ -291,8 +338,17 @@ class Session:
         :param index_to_apply: the index to be applied to the source field
         :param src: the field to be index
         :param dest: optional - a field to write the indexed data to
+        :param stream: optional - if set, the index is applied a chunk at a time, gathering
+        from the source field through bounded reads, and each chunk is written to dest,
+        which must be set. Sorted indices read the source field sequentially. dest is
+        returned.
+        :param memory_budget: optional - when streaming, the maximum number of bytes of the
+        source field that are read at a time
         :return: the indexed values
         """
+        if stream is True:
+            return self._apply_streamed('index_to_apply', index_to_apply, src, dest,
+                                        ops.apply_index_streamed, memory_budget=memory_budget)
         index_to_apply_ = val.array_from_parameter(self, 'index_to_apply', index_to_apply)
         writer_ = None
         if dest is not None:
@@ -314,24 +370,394 @@ class Session:
             return result
 
 
+    def create_view(self, src, filter=None, index=None):
+        """
+        Create a lazy view of a field through a filter or an index. Views can be filtered
+        and indexed further without reading or writing any data; the composed selection
+        is only applied to the field when the view is read or realised.
+        :param src: the field, group or view to be viewed
+        :param filter: optional - a boolean filter over the rows of src
+        :param index: optional - an index of rows of src
+        :return: a FieldView
+        """
+        if not isinstance(src, ff.FieldView):
+            src = val.field_from_parameter(self, 'src', src)
+        return ff.FieldView(src, filter=filter, index=index, chunksize=self.chunksize)
+
+
+    def create_bitmap_index(self, field):
+        """
+        Build a bitmap index for a categorical field and store it with the field, replacing
+        any existing index. The index is built reading the field a chunk at a time.
+        :param field: the categorical field (or group) to be indexed
+        :return: a BitmapIndex
+        """
+        field_ = val.field_from_parameter(self, 'field', field)
+        if not isinstance(field_, fld.CategoricalField):
+            raise ValueError("'field' must be a categorical field but is {}".format(type(field_)))
+        index = bm.build_bitmap_index(field_._field, self.chunksize)
+        index.write(field_._field)
+        return index
+
+
+    def get_bitmap_index(self, field, build=True):
+        """
+        Get the stored bitmap index for a categorical field. The bitmaps of the index can be
+        combined with '&', '|', '-' and '~' and passed to apply_filter as filters.
+        :param field: the categorical field (or group)
+        :param build: optional - if set, the index is built if the field has no index or
+        the field has been rewritten since its index was built. Otherwise None is returned
+        in those cases
+        :return: a BitmapIndex
+        """
+        field_ = val.field_from_parameter(self, 'field', field)
+        if not isinstance(field_, fld.CategoricalField):
+            raise ValueError("'field' must be a categorical field but is {}".format(type(field_)))
+        index = bm.read_bitmap_index(field_._field)
+        if index is None and build is True:
+            index = self.create_bitmap_index(field_)
+        return index
+
+
+    def create_key_index(self, field):
+        """
+        Build a hash index over the values of a key field and store it with the field,
+        replacing any existing key index.
+        :param field: the field (or group) to be indexed
+        :return: a KeyIndex
+        """
+        field_ = val.field_from_parameter(self, 'field', field)
+        index = idx.build_key_index(field_._field, self.chunksize)
+        index.write(field_._field)
+        return index
+
+
+    def lookup(self, table, keys, key=None, fields=None):
+        """
+        Find the rows of a table that hold the given keys, using the key index stored with
+        the key field rather than reading the field. If the key field has no index, or it
+        has been rewritten since its index was built, the index is built first.
+        :param table: the group of fields that make up the table
+        :param keys: a sequence of keys to be found
+        :param key: optional - the name of the key field. Defaults to the table's primary
+        key, as recorded from the schema at import
+        :param fields: optional - the names of fields whose values should be fetched for
+        the rows found
+        :return: an int64 array of the row for each key, with INVALID_INDEX for keys that
+        aren't present. If 'fields' is set, a tuple of the rows and a dictionary of field
+        names to the values of each field for the rows that were found
+        """
+        if key is None:
+            if 'primary_keys' not in table.attrs.keys():
+                raise ValueError("'key' must be set as {} has no primary key".format(table.name))
+            key = table.attrs['primary_keys'][0]
+        if key not in table.keys():
+            raise ValueError("'{}' is not a field of {}".format(key, table.name))
+        index = idx.read_key_index(table[key])
+        if index is None:
+            index = self.create_key_index(table[key])
+        rows = index.lookup(table[key], keys)
+        if fields is None:
+            return rows
+        found = rows[rows != ops.INVALID_INDEX]
+        results = dict()
+        for name in fields:
+            field_ = self.get(table[name])
+            results[name] = [field_.data[int(r)] for r in found]
+        return rows, results
+
+
+    def create_sorted_index(self, field):
+        """
+        Build a sorted index over a numeric or timestamp field and store it with the field,
+        replacing any existing sorted index.
+        :param field: the field (or group) to be indexed
+        :return: a SortedIndex
+        """
+        field_ = val.field_from_parameter(self, 'field', field)
+        index = idx.build_sorted_index(field_._field)
+        index.write(field_._field)
+        return index
+
+
+    def range_query(self, field, low=None, high=None, include_low=True, include_high=False,
+                    as_mask=False):
+        """
+        Find the rows of a numeric or timestamp field whose values lie between 'low' and
+        'high', by binary search of the sorted index stored with the field. If the field
+        has no sorted index, or the field has been written since the index was built, the
+        index is built first.
+        :param field: the field (or group) to be queried
+        :param low: optional - the lower bound; unbounded if not set. datetimes can be
+        used as bounds for timestamp fields
+        :param high: optional - the upper bound; unbounded if not set
+        :param include_low: optional - whether values equal to 'low' match. Defaults to
+        True
+        :param include_high: optional - whether values equal to 'high' match. Defaults to
+        False
+        :param as_mask: optional - if set, return a boolean filter over the field rather
+        than the rows
+        :return: the matching rows in ascending order, or a filter if 'as_mask' is set
+        """
+        field_ = val.field_from_parameter(self, 'field', field)
+        index = idx.read_sorted_index(field_._field)
+        if index is None:
+            index = self.create_sorted_index(field_)
+        low, high = (b.timestamp() if isinstance(b, datetime) else b for b in (low, high))
+        return index.range(low, high, include_low, include_high, as_mask)
+
+
+    def lazy(self, source, chunksize=None):
+        """
+        Create a LazyFrame over a set of fields, on which filter, derived column, join and
+        aggregation steps can be built up and then optimised and executed together,
+        a chunk at a time.
+        :param source: a group of fields, or a dictionary of column names to fields, groups
+        or ndarrays. All of the columns must be the same length
+        :param chunksize: optional - the number of rows processed at a time; defaults to
+        the session chunksize
+        :return: a LazyFrame
+        """
+        if isinstance(source, h5py.Group):
+            columns = {k: self.get(source[k]) for k in source.keys()
+                       if 'fieldtype' in source[k].attrs.keys()}
+        else:
+            columns = {k: self.get(v) if isinstance(v, h5py.Group) else v
+                       for k, v in source.items()}
+        if len(columns) == 0:
+            raise ValueError("'source' must contain at least one field")
+        lengths = {k: ops._key_length(v) for k, v in columns.items()}
+        if len(set(lengths.values())) > 1:
+            raise ValueError("all columns must be the same length but have lengths "
+                             "{}".format(lengths))
+        chunksize = self.chunksize if chunksize is None else chunksize
+        node = query._Scan(columns, next(iter(lengths.values())))
+        return query.LazyFrame(self, node, chunksize)
+
+
+    def _apply_streamed(self, name, to_apply, src, dest, streamed_fn, **kwargs):
+        if dest is None:
+            raise ValueError("'dest' must be set when 'stream' is True")
+        if not val.is_field_parameter(src):
+            raise ValueError("'src' must be a field when 'stream' is True")
+        src_ = val.field_from_parameter(self, 'src', src)
+        dest_ = val.field_from_parameter(self, 'dest', dest)
+        streamed_fn(self._key_parameter(name, to_apply), src_, dest_, self.chunksize, **kwargs)
+        return dest_
+
+
     # TODO: write distinct with new readers / writers rather than deleting this
-    def distinct(self, field=None, fields=None, filter=None):
+    def distinct(self, field=None, fields=None, filter=None, return_index=False,
+                 return_counts=False):
+        """
+        Find the distinct values of a field, or the distinct tuples of values of several
+        fields, with a hash table that is filled a chunk at a time. Fields of any type,
+        including indexed strings, can be used. The results are sorted.
+
+        :param field: the field (or ndarray) to find the distinct values of
+        :param fields: a sequence of fields (or ndarrays) to find the distinct tuples of
+        :param filter: optional - a boolean field or ndarray; only rows for which it is True
+        are considered
+        :param return_index: optional - also return the row of the first occurrence of each
+        distinct value
+        :param return_counts: optional - also return the number of occurrences of each
+        distinct value
+        :return: the distinct values if 'field' is set, or a list of the distinct values of
+        each field if 'fields' is set. If 'return_index' or 'return_counts' are set, a tuple
+        of the distinct values followed by the requested arrays
+        """
         if field is None and fields is None:
-            return ValueError("One of 'field' and 'fields' must be set")
+            raise ValueError("One of 'field' and 'fields' must be set")
         if field is not None and fields is not None:
-            return ValueError("Only one of 'field' and 'fields' may be set")
+            raise ValueError("Only one of 'field' and 'fields' may be set")
 
-        if field is not None:
-            return np.unique(field)
+        columns = [field] if field is not None else fields
+        columns = [self._key_parameter('fields', f) for f in columns]
+        filter_ = None if filter is None else self._key_parameter('filter', filter)
+        results = ops.distinct(columns, filter_, self.chunksize, return_index, return_counts)
+        if field is None:
+            return results
+        if return_index or return_counts:
+            return (results[0][0],) + results[1:]
+        return results[0]
 
-        entries = [(f'{i}', f.dtype) for i, f in enumerate(fields)]
-        unified = np.empty_like(fields[0], dtype=np.dtype(entries))
-        for i, f in enumerate(fields):
-            unified[f'{i}'] = f
 
-        uniques = np.unique(unified)
-        results = [uniques[f'{i}'] for i in range(len(fields))]
-        return results
+    def value_counts(self, field, filter=None, by=None):
+        """
+        Count the occurrences of each distinct value of a field, reading it a chunk at a
+        time. Categorical and integer fields are counted with bincount, and other fields,
+        including strings, with a hash table.
+        :param field: the field (or ndarray) whose values are counted
+        :param filter: optional - a boolean field or ndarray (or Bitmap); only rows for
+        which it is True are counted
+        :param by: optional - a field or ndarray, typically categorical, to crosstab the
+        counts against
+        :return: a tuple of the sorted distinct values and their counts. If 'by' is set, a
+        tuple of the distinct values, the distinct values of 'by' and a two dimensional
+        array of counts
+        """
+        field_ = self._key_parameter('field', field)
+        filter_ = None if filter is None else self._key_parameter('filter', filter)
+        by_ = None if by is None else self._key_parameter('by', by)
+        return ops.value_counts(field_, filter_, by_, self.chunksize)
+
+
+    def histogram(self, field, bins=10, value_range=None, filter=None, by=None):
+        """
+        Count the values of a numeric or timestamp field that fall in each of a set of bins,
+        reading it a chunk at a time.
+        :param field: the numeric or timestamp field (or ndarray)
+        :param bins: the number of equal-width bins, or an increasing array of bin edges
+        :param value_range: optional - the (lower, upper) range of the bins when 'bins' is
+        a number; defaults to the range of the field's values
+        :param filter: optional - a boolean field or ndarray (or Bitmap); only rows for
+        which it is True are counted
+        :param by: optional - a field or ndarray, typically categorical, to crosstab the
+        counts against
+        :return: a tuple of the counts and the bin edges. If 'by' is set, a tuple of the
+        two dimensional counts, the bin edges and the sorted distinct values of 'by'
+        """
+        field_ = self._key_parameter('field', field)
+        if isinstance(field_, fld.Field):
+            if not isinstance(field_, (fld.NumericField, fld.TimestampField)):
+                raise ValueError("'field' must be a numeric or timestamp field but is "
+                                 "{}".format(type(field_)))
+        elif not np.issubdtype(field_.dtype, np.number):
+            raise ValueError("'field' must be numeric but has dtype {}".format(field_.dtype))
+        filter_ = None if filter is None else self._key_parameter('filter', filter)
+        by_ = None if by is None else self._key_parameter('by', by)
+        return ops.histogram(field_, bins, value_range, filter_, by_, self.chunksize)
+
+
+    def describe(self, group, fields=None, quantiles=(0.25, 0.5, 0.75), workers=None):
+        """
+        Calculate summary statistics for the numeric and timestamp fields of a group, making
+        a single pass over each field. Fields are described in parallel when 'workers' is
+        greater than one.
+        Where a field 'x' has a companion 'x_valid' field, only the rows for which it is
+        True are counted as valid. Results are cached in the attributes of each field, along
+        with the version and length of the field, so that describing a field that hasn't
+        changed doesn't read it again.
+        :param group: the group whose fields are described
+        :param fields: optional - the names of the fields to describe. If not set, all
+        numeric (other than boolean) and timestamp fields, other than '_valid' companion
+        fields, are described
+        :param quantiles: the quantiles to calculate, each between 0 and 1. Quantiles are
+        exact for fields with up to ops.DESCRIBE_SAMPLE_SIZE valid values, and are
+        estimated from a uniform sample of the valid values otherwise
+        :param workers: optional - the number of fields described at once
+        :return: a dictionary of field name to a dictionary of 'count', 'count_valid',
+        'mean', 'std', 'min', 'max' and a '<q>%' entry for each quantile
+        """
+        self._check_workers(workers)
+        if fields is None:
+            fields = list()
+            for k, v in group.items():
+                if not isinstance(v, h5py.Group) or 'fieldtype' not in v.attrs.keys():
+                    continue
+                fieldtype = v.attrs['fieldtype'].split(',')
+                if k.endswith('_valid') and k[:-len('_valid')] in group:
+                    continue
+                if fieldtype[0] == 'timestamp' or \
+                        (fieldtype[0] == 'numeric' and fieldtype[1] != 'bool'):
+                    fields.append(k)
+        quantiles = [float(q) for q in quantiles]
+
+        results = dict()
+        pending = dict()
+        for name in fields:
+            field = self.get(group[name])
+            if not isinstance(field, (fld.NumericField, fld.TimestampField)):
+                raise ValueError("'{}' must be a numeric or timestamp field but is "
+                                 "{}".format(name, type(field)))
+            valid_name = '{}_valid'.format(name)
+            valid = self.get(group[valid_name]) if valid_name in group else None
+            key = self._describe_cache_key(field, valid, quantiles)
+            cached = field._field.attrs.get(fld.DESCRIBE_ATTR)
+            if cached is not None:
+                cached = json.loads(cached)
+                if cached['key'] == key:
+                    results[name] = cached['statistics']
+                    continue
+            pending[name] = (field, valid, key)
+
+        def describe_field(field, valid):
+            return ops.describe(field, valid, quantiles, self.chunksize)
+
+        if workers is None or workers == 1:
+            computed = {k: describe_field(f, v) for k, (f, v, _) in pending.items()}
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {k: pool.submit(describe_field, f, v)
+                           for k, (f, v, _) in pending.items()}
+                computed = {k: f.result() for k, f in futures.items()}
+
+        writeable = group.file.mode != 'r'
+        for name, (field, _, key) in pending.items():
+            results[name] = computed[name]
+            if writeable:
+                field._field.attrs[fld.DESCRIBE_ATTR] = \
+                    json.dumps({'key': key, 'statistics': computed[name]})
+        return {name: results[name] for name in fields}
+
+
+    @staticmethod
+    def _describe_cache_key(field, valid, quantiles):
+        key = {'version': fld.field_version(field._field), 'length': len(field.data),
+               'quantiles': quantiles, 'sample_size': ops.DESCRIBE_SAMPLE_SIZE}
+        if valid is not None:
+            key['valid_version'] = fld.field_version(valid._field)
+            key['valid_length'] = len(valid.data)
+        return key
+
+
+    def approx_count_distinct(self, field, filter=None, precision=sk.HLL_DEFAULT_PRECISION,
+                              workers=None):
+        """
+        Estimate the number of distinct values of a field with a HyperLogLog sketch, making
+        a single pass over the field. The relative standard error of the estimate is about
+        1.04 / sqrt(2 ** precision), which is 0.8% for the default precision.
+        :param field: the field (or ndarray) whose distinct values are counted
+        :param filter: optional - a boolean field or ndarray (or Bitmap); only rows for
+        which it is True are counted
+        :param precision: the base two logarithm of the number of registers of the sketch
+        :param workers: optional - the number of partitions of the field sketched at once
+        :return: the estimated number of distinct values
+        """
+        field_ = self._key_parameter('field', field)
+        filter_ = None if filter is None else self._key_parameter('filter', filter)
+        return sk.approx_count_distinct(field_, filter_, precision, self.chunksize,
+                                        self._check_workers(workers))
+
+
+    def approx_quantiles(self, field, quantiles=(0.5,), filter=None, k=sk.KLL_DEFAULT_K,
+                         workers=None):
+        """
+        Estimate quantiles of a numeric or timestamp field with a KLL sketch, making a single
+        pass over the field. The rank error of the estimates is about 1.7 / k.
+        :param field: the numeric or timestamp field (or ndarray)
+        :param quantiles: a sequence of quantiles, each between 0 and 1
+        :param filter: optional - a boolean field or ndarray (or Bitmap); only rows for
+        which it is True are included
+        :param k: the size of the sketch
+        :param workers: optional - the number of partitions of the field sketched at once
+        :return: an ndarray of estimates, one per quantile
+        """
+        field_ = self._key_parameter('field', field)
+        if isinstance(field_, fld.Field) and \
+                not isinstance(field_, (fld.NumericField, fld.TimestampField)):
+            raise ValueError("'field' must be a numeric or timestamp field but is "
+                             "{}".format(type(field_)))
+        filter_ = None if filter is None else self._key_parameter('filter', filter)
+        return sk.approx_quantiles(field_, quantiles, filter_, k, self.chunksize,
+                                   self._check_workers(workers))
+
+
+    @staticmethod
+    def _check_workers(workers):
+        if workers is not None and (not isinstance(workers, int) or workers < 1):
+            raise ValueError("'workers' must be a positive integer but is {}".format(workers))
+        return workers
 
 
     def get_spans(self, field=None, fields=None):
@@ -371,12 +797,12 @@ class Session:
         if dest is not None:
             dest_f = val.field_from_parameter(self, 'dest', dest)
             results = np.zeros(len(spans) - 1, dtype=dest_f.data.dtype)
-            predicate(spans, results)
+            ops.apply_spans_parallel(predicate, spans, results, threads=self.threads)
             dest_f.data.write(results)
             return results
         else:
             results = np.zeros(len(spans) - 1, dtype='int64')
-            predicate(spans, results)
+            ops.apply_spans_parallel(predicate, spans, results, threads=self.threads)
             return results
 
     def _apply_spans_src(self, predicate, spans, src, dest=None):
@@ -390,12 +816,12 @@ class Session:
         if dest is not None:
             dest_f = val.field_from_parameter(self, 'dest', dest)
             results = np.zeros(len(spans) - 1, dtype=dest_f.data.dtype)
-            predicate(spans, src_, results)
+            ops.apply_spans_parallel(predicate, spans, src_, results, threads=self.threads)
             dest_f.data.write(results)
             return results
         else:
             results = np.zeros(len(spans) - 1, dtype=src_.dtype)
-            predicate(spans, src_, results)
+            ops.apply_spans_parallel(predicate, spans, src_, results, threads=self.threads)
             return results
 
     def apply_spans_index_of_min(self, spans, src, dest=None):
@@ -410,23 +836,411 @@ class Session:
     def apply_spans_index_of_last(self, spans, dest=None):
         return self._apply_spans_no_src(ops.apply_spans_index_of_last, spans, dest)
 
+    def _is_indexed_string(self, src):
+        if isinstance(src, h5py.Group):
+            return src.attrs.get('fieldtype', '').split(',')[0] == 'indexedstring'
+        return isinstance(src, fld.IndexedStringField)
+
+    def _apply_spans_indexed_src(self, aggregation, spans, src, dest=None):
+        # indexed strings are aggregated on their index / value buffers, and the results
+        # are returned as a tuple of (indices, values)
+        src_ = val.field_from_parameter(self, 'src', src)
+        if len(src_) != spans[-1]:
+            error_msg = "'src' (length {}) must be the length of the spans ({})"
+            raise ValueError(error_msg.format(len(src_), spans[-1]))
+        indices, values = ops.apply_spans_indexed(aggregation, spans,
+                                                  src_.indices[:], src_.values[:])
+        if dest is not None:
+            dest_f = val.field_from_parameter(self, 'dest', dest)
+            if not isinstance(dest_f, fld.IndexedStringField):
+                raise ValueError(f"'dest' must be one of 'IndexedStringField' but is {type(dest_f)}")
+            dest_f.indices.write(indices)
+            dest_f.values.write(values)
+        return indices, values
+
     def apply_spans_count(self, spans, src=None, dest=None):
         return self._apply_spans_no_src(ops.apply_spans_count, spans, dest)
 
     def apply_spans_min(self, spans, src, dest=None):
+        if self._is_indexed_string(src):
+            return self._apply_spans_indexed_src('min', spans, src, dest)
         return self._apply_spans_src(ops.apply_spans_min, spans, src, dest)
 
     def apply_spans_max(self, spans, src, dest=None):
+        if self._is_indexed_string(src):
+            return self._apply_spans_indexed_src('max', spans, src, dest)
         return self._apply_spans_src(ops.apply_spans_max, spans, src, dest)
 
     def apply_spans_first(self, spans, src, dest=None):
+        if self._is_indexed_string(src):
+            return self._apply_spans_indexed_src('first', spans, src, dest)
         return self._apply_spans_src(ops.apply_spans_first, spans, src, dest)
 
     def apply_spans_last(self, spans, src, dest=None):
+        if self._is_indexed_string(src):
+            return self._apply_spans_indexed_src('last', spans, src, dest)
         return self._apply_spans_src(ops.apply_spans_last, spans, src, dest)
 
+    def apply_spans_longest(self, spans, src, dest=None):
+        """
+        Select the longest string of each span of an indexed string field. Where several
+        strings in a span share the longest length, the first of them is selected.
+        :param spans: the spans over which to aggregate
+        :param src: the indexed string group/field
+        :param dest: optional - an indexed string field to which the results are written
+        :return: a tuple of the index and values arrays of the result
+        """
+        if not self._is_indexed_string(src):
+            raise ValueError(f"'src' must be one of 'IndexedStringField' but is {type(src)}")
+        return self._apply_spans_indexed_src('longest', spans, src, dest)
+
+    def _apply_spans_aggregation(self, aggregation, spans, src, dest=None):
+        assert(dest is None or isinstance(dest, fld.Field))
+        src_ = val.array_from_parameter(self, 'src', src)
+        results = ops.apply_spans_aggregations(spans, src_, (aggregation,))[aggregation]
+        if dest is not None:
+            dest_f = val.field_from_parameter(self, 'dest', dest)
+            results = results.astype(dest_f.data.dtype, copy=False)
+            dest_f.data.write(results)
+        return results
+
+    def apply_spans_sum(self, spans, src, dest=None):
+        return self._apply_spans_aggregation('sum', spans, src, dest)
+
+    def apply_spans_mean(self, spans, src, dest=None):
+        return self._apply_spans_aggregation('mean', spans, src, dest)
+
+    def apply_spans_var(self, spans, src, dest=None):
+        return self._apply_spans_aggregation('var', spans, src, dest)
+
+    def apply_spans_count_valid(self, spans, src, dest=None):
+        return self._apply_spans_aggregation('count_valid', spans, src, dest)
+
+    def apply_spans_count_distinct(self, spans, src, dest=None):
+        return self._apply_spans_aggregation('count_distinct', spans, src, dest)
+
+    def apply_spans_approx_count_distinct(self, spans, src, valid=None,
+                                          precision=sk.HLL_DEFAULT_PRECISION, dest=None):
+        """
+        Estimate the number of distinct values in each span with HyperLogLog sketches,
+        reading 'src' a chunk at a time. Spans may be longer than a chunk.
+        :param spans: the spans over which to aggregate
+        :param src: the group/field/numpy array whose distinct values are counted
+        :param valid: optional - a group/field/numpy array of booleans indicating which
+        values of 'src' are counted
+        :param precision: the base two logarithm of the number of registers of the sketches
+        :param dest: optional - a field to which the results are written
+        :return: an int64 ndarray of estimates, one per span
+        """
+        src_ = self._key_parameter('src', src)
+        valid_ = None if valid is None else self._key_parameter('valid', valid)
+        results = sk.apply_spans_approx_count_distinct(spans, src_, valid_, precision,
+                                                       self.chunksize)
+        if dest is not None:
+            dest_f = val.field_from_parameter(self, 'dest', dest)
+            results = results.astype(dest_f.data.dtype, copy=False)
+            dest_f.data.write(results)
+        return results
+
+    def apply_spans_approx_quantiles(self, spans, src, quantiles=0.5, valid=None,
+                                     k=sk.KLL_DEFAULT_K, dest=None):
+        """
+        Estimate quantiles of the values in each span, such as the median temperature of
+        each patient, with KLL sketches, reading 'src' a chunk at a time. Spans may be longer
+        than a chunk. Spans of up to about 3 * k values have exact quantiles.
+        :param spans: the spans over which to aggregate
+        :param src: the numeric or timestamp group/field/numpy array
+        :param quantiles: a quantile between 0 and 1, or a sequence of them. The estimate
+        of a quantile q is the smallest value whose rank is at least q times the number of
+        values (numpy's 'inverted_cdf' method)
+        :param valid: optional - a group/field/numpy array of booleans indicating which
+        values of 'src' are included. NaNs are never included
+        :param k: the size of the sketches
+        :param dest: optional - a field, or a sequence of fields if 'quantiles' is a
+        sequence, to which the results are written
+        :return: a float64 ndarray with an estimate per span, or of shape (span count,
+        quantile count) if 'quantiles' is a sequence. Spans without values have NaN
+        estimates
+        """
+        src_ = self._key_parameter('src', src)
+        valid_ = None if valid is None else self._key_parameter('valid', valid)
+        results = sk.apply_spans_approx_quantiles(spans, src_, quantiles, valid_, k,
+                                                  self.chunksize)
+        if np.ndim(quantiles) == 0:
+            results = results[:, 0]
+            destinations = None if dest is None else (dest,)
+        else:
+            destinations = dest
+        if destinations is not None:
+            if len(destinations) != np.size(quantiles):
+                raise ValueError("'dest' must have one field per quantile")
+            for i, d in enumerate(destinations):
+                dest_f = val.field_from_parameter(self, 'dest', d)
+                column = results if results.ndim == 1 else results[:, i]
+                dest_f.data.write(column.astype(dest_f.data.dtype, copy=False))
+        return results
+
+
+    def _window_parameters(self, src, valid, dest):
+        src_ = None if src is None else self._key_parameter('src', src)
+        valid_ = None if valid is None else self._key_parameter('valid', valid)
+        dest_ = None if dest is None else val.field_from_parameter(self, 'dest', dest)
+        return src_, valid_, dest_
+
+
+    def apply_spans_cumsum(self, spans, src, valid=None, dest=None):
+        """
+        Calculate the running sum of 'src' within each span, such as a running count of
+        symptomatic days per patient, reading 'src' a chunk at a time.
+        :param spans: the spans within which to sum
+        :param src: the numeric (or boolean) group/field/numpy array to sum
+        :param valid: optional - a group/field/numpy array of booleans indicating which
+        values of 'src' are summed. NaNs are never summed
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise an ndarray with the sum up to and including
+        each row; float64 for floating point sources and int64 otherwise
+        """
+        src_, valid_, dest_ = self._window_parameters(src, valid, dest)
+        return ops.apply_spans_cumulative_streamed(spans, 'sum', src_, valid_, dest_,
+                                                   self.chunksize)
+
+
+    def apply_spans_cumcount(self, spans, dest=None):
+        """
+        Number the rows of each span, starting at 0.
+        :param spans: the spans within which to number rows
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise an int64 ndarray with the position of each
+        row in its span
+        """
+        _, _, dest_ = self._window_parameters(None, None, dest)
+        return ops.apply_spans_cumulative_streamed(spans, 'count', dest=dest_,
+                                                   chunksize=self.chunksize)
+
+
+    def apply_spans_lag(self, spans, src, k=1, fill=None, dest=None):
+        """
+        Give each row the value of 'src' k rows before it in its span, reading 'src' a chunk
+        at a time.
+        :param spans: the spans within which to look back
+        :param src: the numeric or timestamp group/field/numpy array
+        :param k: the number of rows to look back
+        :param fill: optional - the value of the first k rows of each span. Defaults to NaN
+        for floating point sources and 0 otherwise
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise an ndarray of results, of the dtype of 'src'
+        """
+        src_, _, dest_ = self._window_parameters(src, None, dest)
+        return ops.apply_spans_shift_streamed(spans, src_, k, fill, dest_, self.chunksize)
+
+
+    def apply_spans_lead(self, spans, src, k=1, fill=None, dest=None):
+        """
+        Give each row the value of 'src' k rows after it in its span, reading 'src' a chunk
+        at a time.
+        :param spans: the spans within which to look ahead
+        :param src: the numeric or timestamp group/field/numpy array
+        :param k: the number of rows to look ahead
+        :param fill: optional - the value of the last k rows of each span. Defaults to NaN
+        for floating point sources and 0 otherwise
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise an ndarray of results, of the dtype of 'src'
+        """
+        src_, _, dest_ = self._window_parameters(src, None, dest)
+        return ops.apply_spans_shift_streamed(spans, src_, -k, fill, dest_, self.chunksize)
+
+
+    def apply_spans_diff(self, spans, src, k=1, dest=None):
+        """
+        Calculate the difference between each value of 'src' and the value k rows before it
+        in its span, reading 'src' a chunk at a time. For a timestamp field this is the
+        number of seconds since the earlier row, such as the time since a patient's previous
+        assessment.
+        :param spans: the spans within which to calculate differences
+        :param src: the numeric or timestamp group/field/numpy array
+        :param k: the number of rows to look back
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise a float64 ndarray of results, which are NaN
+        for the first k rows of each span
+        """
+        src_, _, dest_ = self._window_parameters(src, None, dest)
+        return ops.apply_spans_diff_streamed(spans, src_, k, dest_, self.chunksize)
+
+
+    def apply_spans_rolling(self, spans, src, aggregation, window=None, timestamps=None,
+                            duration=None, valid=None, min_periods=1, dest=None):
+        """
+        Aggregate 'src' over a trailing window of each row within its span, reading it a
+        chunk at a time. The window is either a number of rows or, if 'timestamps' is set,
+        a length of time; for example, the maximum temperature of each patient over the
+        last 7 days:
+
+            s.apply_spans_rolling(spans, temperature, 'max', timestamps=created_at,
+                                  duration=timedelta(days=7))
+
+        :param spans: the spans within which to aggregate
+        :param src: the numeric or timestamp group/field/numpy array
+        :param aggregation: one of 'count', 'sum', 'mean', 'min' and 'max'
+        :param window: the number of rows in the window, including the row itself
+        :param timestamps: a timestamp group/field/numpy array, sorted within each span,
+        for time windows. The window of a row holds the rows whose timestamps are within
+        'duration' before the row's timestamp, up to and including the row
+        :param duration: the length of a time window, as a timedelta or a number of seconds
+        :param valid: optional - a group/field/numpy array of booleans indicating which
+        values of 'src' are aggregated. NaNs are never aggregated
+        :param min_periods: the number of valid values that a window needs for a result
+        other than a count
+        :param dest: optional - a field to which the results are written a chunk at a time
+        :return: 'dest' if it is set, otherwise a float64 ndarray of results, which are NaN
+        for windows with fewer than 'min_periods' valid values
+        """
+        src_, valid_, dest_ = self._window_parameters(src, valid, dest)
+        timestamps_ = None if timestamps is None else \
+            self._key_parameter('timestamps', timestamps)
+        if isinstance(duration, timedelta):
+            duration = duration.total_seconds()
+        return ops.apply_spans_rolling_streamed(spans, src_, aggregation, window, timestamps_,
+                                                duration, valid_, min_periods, dest_,
+                                                self.chunksize)
+
+
+    def apply_spans_multi(self, aggregations, spans=None, keys=None, destinations=None):
+        """
+        Calculate a number of aggregations over spans in a single call. The spans are
+        calculated once (from 'keys' if 'spans' is not set), and all of the aggregations
+        of a given source are calculated in a single compiled pass over that source.
+
+        Example:
+            s.apply_spans_multi(((age, 'min'), (age, 'max'), (age, 'mean'),
+                                 (weight, 'count_valid', weight_valid)),
+                                keys=patient_id)
+
+        :param aggregations: a sequence of (source, aggregation) tuples, where source is a
+        group/field/numpy array and aggregation is one of 'count', 'first', 'last', 'min',
+        'max', 'sum', 'mean', 'var', 'count_valid' and 'count_distinct'. A third element
+        can be given, which is a group/field/numpy array of booleans indicating which
+        values of the source are valid; otherwise all values other than NaNs are valid.
+        'count', 'first' and 'last' are calculated over all values and the other
+        aggregations over valid values only. 'var' is the sample variance
+        :param spans: the spans to aggregate over
+        :param keys: if 'spans' is not set, a sorted group/field/numpy array, or a tuple of
+        them, from which the spans are calculated
+        :param destinations: optional - a sequence of fields, one per aggregation, to
+        which the results are written
+        :return: a list of the results, in the order of 'aggregations'
+        """
+        if spans is None:
+            if keys is None:
+                raise ValueError("One of 'spans' and 'keys' must be set")
+            if isinstance(keys, tuple):
+                spans = self.get_spans(fields=keys)
+            else:
+                spans = self.get_spans(field=keys)
+        if destinations is not None and len(destinations) != len(aggregations):
+            raise ValueError("'destinations' must be the same length as 'aggregations'")
+
+        # group the aggregations by source so that each source is only read once
+        by_source = dict()
+        for i, agg in enumerate(aggregations):
+            if len(agg) not in (2, 3):
+                raise ValueError("'aggregations' entries must be (source, aggregation) or "
+                                 "(source, aggregation, valid) tuples")
+            key = (id(agg[0]), id(agg[2]) if len(agg) == 3 else None)
+            by_source.setdefault(key, list()).append(i)
+
+        results = [None] * len(aggregations)
+        for indices in by_source.values():
+            agg = aggregations[indices[0]]
+            src_ = val.array_from_parameter(self, 'src', agg[0])
+            valid_ = None
+            if len(agg) == 3:
+                valid_ = val.array_from_parameter(self, 'valid', agg[2]).astype(bool, copy=False)
+            names = tuple(aggregations[i][1] for i in indices)
+            source_results = ops.apply_spans_aggregations(spans, src_, names, valid_)
+            for i in indices:
+                results[i] = source_results[aggregations[i][1]]
+
+        if destinations is not None:
+            for i, d in enumerate(destinations):
+                dest_f = val.field_from_parameter(self, 'destinations', d)
+                results[i] = results[i].astype(dest_f.data.dtype, copy=False)
+                dest_f.data.write(results[i])
+        return results
+
+    def apply_hash_group_by(self, keys, aggregations, key_destination=None,
+                            destinations=None):
+        """
+        Calculate a number of aggregations grouped by the values of 'keys', which do not
+        need to be sorted. This avoids having to sort a dataset by a key such as a
+        categorical field in order to aggregate by it. The keys and sources are read a
+        chunk at a time, and per-group accumulators are held in compiled hash tables.
+
+        Example:
+            country, results = s.apply_hash_group_by(country_code,
+                                                     ((age, 'mean'), (age, 'count')))
+
+        :param keys: a group/field/numpy array of integer, categorical or fixed-length
+        string keys
+        :param aggregations: a sequence of (source, aggregation) or (source, aggregation,
+        valid) tuples, as described for 'apply_spans_multi'
+        :param key_destination: optional - a field to which the group keys are written
+        :param destinations: optional - a sequence of fields, one per aggregation, to
+        which the results are written
+        :return: a tuple of the group keys and a list of the results, in the order of
+        'aggregations'. Groups are in order of the first appearance of their key
+        """
+        if destinations is not None and len(destinations) != len(aggregations):
+            raise ValueError("'destinations' must be the same length as 'aggregations'")
+        keys_ = self._key_parameter('keys', keys)
+
+        # group the aggregations by source so that each source is only read once
+        by_source = dict()
+        for i, agg in enumerate(aggregations):
+            if len(agg) not in (2, 3):
+                raise ValueError("'aggregations' entries must be (source, aggregation) or "
+                                 "(source, aggregation, valid) tuples")
+            key = (id(agg[0]), id(agg[2]) if len(agg) == 3 else None)
+            by_source.setdefault(key, list()).append(i)
+
+        sources = list()
+        for indices in by_source.values():
+            agg = aggregations[indices[0]]
+            valid = self._key_parameter('valid', agg[2]) if len(agg) == 3 else None
+            sources.append((self._key_parameter('src', agg[0]),
+                            tuple(aggregations[i][1] for i in indices), valid))
+        group_keys, source_results = ops.hash_group_by(keys_, sources, self.chunksize)
+
+        results = [None] * len(aggregations)
+        for indices, source_result in zip(by_source.values(), source_results):
+            for i in indices:
+                results[i] = source_result[aggregations[i][1]]
+
+        if key_destination is not None:
+            val.field_from_parameter(self, 'key_destination', key_destination).data.write(
+                group_keys)
+        if destinations is not None:
+            for i, d in enumerate(destinations):
+                dest_f = val.field_from_parameter(self, 'destinations', d)
+                results[i] = results[i].astype(dest_f.data.dtype, copy=False)
+                dest_f.data.write(results[i])
+        return group_keys, results
+
     def apply_spans_concat(self, spans, src, dest,
                            src_chunksize=None, dest_chunksize=None, chunksize_mult=None):
+        """
+        Concatenate the non-empty entries of an indexed string field within each span,
+        separated by commas, and quoting any entries that contain commas or quotes.
+        The source is streamed in blocks of whole spans, so spans that cross chunk
+        boundaries are handled, and memory is bounded by the chunk sizes rather than the
+        size of the field.
+        :param spans: the spans over which to concatenate
+        :param src: the IndexedStringField to be concatenated
+        :param dest: the IndexedStringField to which the results are written
+        :param src_chunksize: the maximum number of source rows read at a time
+        :param dest_chunksize: together with 'chunksize_mult', the maximum number of bytes
+        of source values read at a time
+        :param chunksize_mult: the multiplier applied to 'dest_chunksize'
+        """
         if not isinstance(src, fld.IndexedStringField):
             raise ValueError(f"'src' must be one of 'IndexedStringField' but is {type(src)}")
         if not isinstance(dest, fld.IndexedStringField):
@@ -436,42 +1250,36 @@ class Session:
         dest_chunksize = dest.chunksize if dest_chunksize is None else dest_chunksize
         chunksize_mult = 16 if chunksize_mult is None else chunksize_mult
 
-
-        src_index = src.indices[:]
-        src_values = src.values[:]
-        dest_index = np.zeros(src_chunksize, src_index.dtype)
-        dest_values = np.zeros(dest_chunksize * chunksize_mult, src_values.dtype)
-
-        max_index_i = src_chunksize
-        max_value_i = dest_chunksize * chunksize_mult // 2
-
-        if src_values.dtype == 'S1':
+        values_dtype = src.values.dtype
+        if values_dtype == 'S1':
             separator = b','
             delimiter = b'"'
-        elif src_values.dtype == np.uint8:
+        elif values_dtype == np.uint8:
             separator = np.frombuffer(b',', dtype='S1')[0][0]
             delimiter = np.frombuffer(b'"', dtype='S1')[0][0]
 
-        s = 0
-        index_v = 0
-        while s < len(spans) - 1:
-            # s, index_i, index_v = per._apply_spans_concat(spans, src_index, src_values,
-            #                                               dest_index, dest_values,
-            #                                               max_index_i, max_value_i, s,
-            #                                               separator, delimiter)
-            s, index_i, index_v = per._apply_spans_concat_2(spans, src_index, src_values,
+        dest_start_v = 0
+        dest.indices.write_part(np.zeros(1, dtype=np.int64))
+        for _, b_spans, b_index, value_start in \
+                ops.indexed_span_chunks(spans, src.indices, src_chunksize,
+                                        dest_chunksize * chunksize_mult):
+            b_values = src.values[value_start:value_start + b_index[-1]]
+            # each entry grows by at most twice its length plus two quotes and a separator,
+            # so the whole block is processed by a single kernel call
+            dest_index = np.zeros(len(b_spans), dtype=np.int64)
+            dest_values = np.zeros(2 * len(b_values) + 3 * (len(b_index) - 1) + 1,
+                                   dtype=values_dtype)
+            _, index_i, index_v = per._apply_spans_concat_2(b_spans, b_index, b_values,
                                                             dest_index, dest_values,
-                                                            max_index_i, max_value_i,
-                                                            separator, delimiter, s, index_v)
-
-            if index_i > 0 or index_v > 0:
-                dest.indices.write_part(dest_index[:index_i])
+                                                            len(b_spans), len(dest_values),
+                                                            separator, delimiter, 0,
+                                                            dest_start_v)
+            dest.indices.write_part(dest_index[1:index_i])
+            if index_v > 0:
                 dest.values.write_part(dest_values[:index_v])
+            dest_start_v += index_v
         dest.indices.complete()
         dest.values.complete()
-        #         dest.write_raw(dest_index[:index_i], dest_values[:index_v])
-        # dest.complete()
-
 
     def _aggregate_impl(self, predicate, index, src=None, dest=None):
         index_ = val.raw_array_from_parameter(self, "index", index)
@@ -508,6 +1316,26 @@ class Session:
         return self.aggregate_custom(self.apply_spans_max, index, src, dest)
 
 
+    def aggregate_sum(self, index, src=None, dest=None):
+        return self.aggregate_custom(self.apply_spans_sum, index, src, dest)
+
+
+    def aggregate_mean(self, index, src=None, dest=None):
+        return self.aggregate_custom(self.apply_spans_mean, index, src, dest)
+
+
+    def aggregate_var(self, index, src=None, dest=None):
+        return self.aggregate_custom(self.apply_spans_var, index, src, dest)
+
+
+    def aggregate_count_valid(self, index, src=None, dest=None):
+        return self.aggregate_custom(self.apply_spans_count_valid, index, src, dest)
+
+
+    def aggregate_count_distinct(self, index, src=None, dest=None):
+        return self.aggregate_custom(self.apply_spans_count_distinct, index, src, dest)
+
+
     def aggregate_custom(self, predicate, index, src=None, dest=None):
         if src is None:
             raise ValueError("'src' must not be None")
@@ -685,75 +1513,71 @@ class Session:
             cur = next
 
 
-    def process(self, inputs, outputs, predicate):
-
-        # TODO: modifying the dictionaries in place is not great
+    def process(self, inputs, outputs, predicate, workers=None, executor='thread', jit=False):
+        """
+        Run 'predicate' over the inputs a chunk at a time, writing its results to the
+        outputs; see 'persistence.process_chunks' for a description of the parameters.
+        """
         input_readers = dict()
         for k, v in inputs.items():
             if isinstance(v, rw.Reader):
                 input_readers[k] = v
             else:
                 input_readers[k] = self.get_reader(v)
-        output_writers = dict()
-        output_arrays = dict()
         for k, v in outputs.items():
-            if isinstance(v, rw.Writer):
-                output_writers[k] = v
-            else:
+            if not isinstance(v, rw.Writer):
                 raise ValueError("'outputs': all values must be 'Writers'")
 
-        reader = next(iter(input_readers.values()))
-        input_length = len(reader)
-        writer = next(iter(output_writers.values()))
-        chunksize = writer.chunksize
-        required_chunksize = min(input_length, chunksize)
-        for k, v in outputs.items():
-            output_arrays[k] = output_writers[k].chunk_factory(required_chunksize)
-
-        for c in self.chunks(input_length, chunksize):
-            kwargs = dict()
+        chunksize = next(iter(outputs.values())).chunksize
+        per.process_chunks(input_readers, outputs, predicate, chunksize, workers, executor, jit)
 
-            for k, v in inputs.items():
-                kwargs[k] = v[c[0]:c[1]]
-            for k, v in output_arrays.items():
-                kwargs[k] = v[:c[1] - c[0]]
-            predicate(**kwargs)
 
-            # TODO: write back to the writer
-            for k in output_arrays.keys():
-                output_writers[k].write_part(kwargs[k])
-        for k, v in output_writers.items():
-            output_writers[k].flush()
+    def get_index(self, target, foreign_key, destination=None):
+        """
+        Generate an index that maps each element of 'foreign_key' to the position of the
+        element with the same value in 'target'. Foreign keys that are not present in
+        'target' are given invalid indices, starting at INVALID_INDEX and incrementing for
+        each missing foreign key, including repeated ones; a repeated missing value keeps
+        the invalid index it was first given.
+        If 'foreign_key' and 'destination' are both groups / fields, the foreign key is
+        read in chunks and the index is streamed to the destination field.
+        :param target: the group/field/numpy array of keys to map to
+        :param foreign_key: the group/field/numpy array of keys to be mapped
+        :param destination: optional - a group/field/numpy array to write the index to
+        :return: the index if 'destination' is not set
+        """
+        fk_index = self._stored_foreign_key_index(foreign_key, target)
+        if fk_index is not None and fk_index.orphan_count() == 0:
+            # every foreign key has a match, so the stored index is the result
+            foreign_key_index = fk_index.parent_rows
+            if destination is None:
+                return foreign_key_index
+            if val.is_field_parameter(destination):
+                val.field_from_parameter(self, "destination", destination).data.write(
+                    foreign_key_index)
+            else:
+                destination[:] = foreign_key_index
+            return
 
+        if val.is_field_parameter(foreign_key) and destination is not None and \
+                val.is_field_parameter(destination):
+            if val.is_field_parameter(target):
+                target_ = val.field_from_parameter(self, "target", target)
+            else:
+                target_ = val.raw_array_from_parameter(self, "target", target)
+            foreign_key_ = val.field_from_parameter(self, "foreign_key", foreign_key)
+            destination_ = val.field_from_parameter(self, "destination", destination)
+            ops.get_index_streamed(target_, foreign_key_, destination_, self.chunksize)
+            return
 
-    def get_index(self, target, foreign_key, destination=None):
-        print('  building patient_id index')
-        t0 = time.time()
-        target_lookup = dict()
         target_ = val.raw_array_from_parameter(self, "target", target)
-        for i, v in enumerate(target_):
-            target_lookup[v] = i
-        print(f'  target lookup built in {time.time() - t0}s')
-
-        print('  perform initial index')
-        t0 = time.time()
         foreign_key_elems = val.raw_array_from_parameter(self, "foreign_key", foreign_key)
-        # foreign_key_index = np.asarray([target_lookup.get(i, -1) for i in foreign_key_elems],
-        #                                    dtype=np.int64)
-        foreign_key_index = np.zeros(len(foreign_key_elems), dtype=np.int64)
-
-        current_invalid = np.int64(operations.INVALID_INDEX)
-        for i_k, k in enumerate(foreign_key_elems):
-            index = target_lookup.get(k, current_invalid)
-            if index >= operations.INVALID_INDEX:
-                current_invalid += 1
-                target_lookup[k] = index
-            foreign_key_index[i_k] = index
-        print(f'  initial index performed in {time.time() - t0}s')
+        foreign_key_index = ops.get_index(target_, foreign_key_elems)
 
         if destination is not None:
             if val.is_field_parameter(destination):
-                destination.data.write(foreign_key_index)
+                destination_ = val.field_from_parameter(self, "destination", destination)
+                destination_.data.write(foreign_key_index)
             else:
                 destination[:] = foreign_key_index
         else:
@@ -780,25 +1604,275 @@ class Session:
         return uid + '.hdf5'
 
 
-    def merge_left(self, left_on, right_on,
-                   right_fields=tuple(), right_writers=None):
-        l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
-        l_index = np.arange(len(l_key_raw), dtype=np.int64)
-        l_df = pd.DataFrame({'l_k': l_key_raw, 'l_index': l_index})
+    def _key_parameter(self, name, key):
+        if isinstance(key, bm.Bitmap):
+            # bitmaps are decompressed a chunk at a time by slicing
+            return key
+        if val.is_field_parameter(key):
+            return val.field_from_parameter(self, name, key)
+        return val.raw_array_from_parameter(self, name, key)
+
+
+    def create_foreign_key_index(self, foreign_key, primary_key):
+        """
+        Match a foreign key with the primary key that it references and store the result
+        with the foreign key: the primary key row of each foreign key row, and the spans
+        of foreign key rows that reference each primary key row. merge_left, merge_right,
+        merge_inner, get_index and aggregate_by_foreign_key use the stored index rather
+        than matching the keys again, until either key is changed.
+        :param foreign_key: the foreign key field (or group)
+        :param primary_key: the primary key field (or group); its values must be unique
+        :return: a ForeignKeyIndex
+        """
+        fk_ = val.field_from_parameter(self, 'foreign_key', foreign_key)
+        pk_ = val.field_from_parameter(self, 'primary_key', primary_key)
+        index = idx.build_foreign_key_index(fk_._field, pk_._field, self.chunksize)
+        index.write(fk_._field, pk_._field)
+        return index
+
+
+    def _stored_foreign_key_index(self, foreign_key, primary_key):
+        if not val.is_field_parameter(foreign_key) or not val.is_field_parameter(primary_key):
+            return None
+        fk_ = val.field_from_parameter(self, 'foreign_key', foreign_key)
+        pk_ = val.field_from_parameter(self, 'primary_key', primary_key)
+        return idx.read_foreign_key_index(fk_._field, pk_._field)
+
+
+    def _foreign_key_join_maps(self, how, left_on, right_on):
+        # the join maps from a stored foreign key index, if either key references the other
+        for child, parent, child_is_left in ((left_on, right_on, True),
+                                             (right_on, left_on, False)):
+            index = self._stored_foreign_key_index(child, parent)
+            if index is not None:
+                return index.join_maps(how, child_is_left)
+        return None
+
+
+    def aggregate_by_foreign_key(self, foreign_key, primary_key, src, aggregation, dest=None):
+        """
+        Aggregate the values of a field of the foreign key's table for each row of the
+        primary key's table, such as the maximum temperature of each patient's
+        assessments. The foreign key index is built and stored if there isn't a current
+        one. Primary key rows that are not referenced have a count of 0, NaN means and
+        variances, NaN minima and maxima for floating point sources, and other
+        aggregations of 0.
+        :param foreign_key: the foreign key field (or group)
+        :param primary_key: the primary key field (or group)
+        :param src: the group/field/numpy array of values to aggregate, with a value for each
+        row of the foreign key
+        :param aggregation: the name of an aggregation from SPAN_AGGREGATIONS
+        :param dest: optional - a field to which the results are written
+        :return: the aggregated values, with one value for each primary key row
+        """
+        index = self._stored_foreign_key_index(foreign_key, primary_key)
+        if index is None:
+            index = self.create_foreign_key_index(foreign_key, primary_key)
+        src_ = val.array_from_parameter(self, 'src', src)
+        if len(src_) != len(index.parent_rows):
+            raise ValueError("'src' (length {}) must be the length of the foreign key "
+                             "({})".format(len(src_), len(index.parent_rows)))
+        counts = np.diff(index.spans)
+        referenced = counts > 0
+        spans = np.zeros(referenced.sum() + 1, dtype=np.int64)
+        np.cumsum(counts[referenced], out=spans[1:])
+        values = src_[index.child_order[:index.spans[-1]]]
+        partial = ops.apply_spans_aggregations(spans, values, (aggregation,))[aggregation]
+        results = np.zeros(len(counts), dtype=partial.dtype)
+        if aggregation in ('mean', 'var') or \
+                (aggregation in ('min', 'max') and np.issubdtype(partial.dtype, np.floating)):
+            results[:] = np.nan
+        results[referenced] = partial
+        if dest is not None:
+            dest_f = val.field_from_parameter(self, 'dest', dest)
+            results = results.astype(dest_f.data.dtype, copy=False)
+            dest_f.data.write(results)
+        return results
+
+
+    def propagate_filter(self, parent_filter, parent_key, child_key, dest=None):
+        """
+        Propagate a filter on the rows of a parent table to the rows of a child table that
+        reference them, such as from a filter on patients to their assessments. If the
+        child key has a current foreign key index on the parent key, the stored parent
+        rows are used. Otherwise the keys of the selected parent rows are put in a KeySet
+        (binary searched if they are sorted, hashed if not) and the child key is streamed
+        through it a chunk at a time.
+        The result is a filter on the child table, so it can be propagated further, to
+        tables that reference the child table, by calling propagate_filter again with the
+        child table's primary key as the parent key.
+        :param parent_filter: a boolean group/field/numpy array (or Bitmap) over the rows of
+        the parent table
+        :param parent_key: the group/field/numpy array of parent keys
+        :param child_key: the group/field/numpy array of child keys that reference them
+        :param dest: optional - a field to which the child filter is written, a chunk at a
+        time when the child key is streamed
+        :return: the child filter, or dest if it is set
+        """
+        if isinstance(parent_filter, bm.Bitmap):
+            parent_filter = parent_filter.to_filter()
+        parent_filter_ = val.array_from_parameter(self, 'parent_filter', parent_filter)
+        parent_ = self._key_parameter('parent_key', parent_key)
+        if len(parent_filter_) != ops._key_length(parent_):
+            raise ValueError("'parent_filter' (length {}) must be the length of 'parent_key' "
+                             "({})".format(len(parent_filter_), ops._key_length(parent_)))
+        dest_ = None if dest is None else val.field_from_parameter(self, 'dest', dest)
+
+        index = self._stored_foreign_key_index(child_key, parent_key)
+        if index is not None:
+            result = ops.filter_by_parent_rows(index.parent_rows, parent_filter_)
+            if dest_ is not None:
+                dest_.data.write(result)
+                return dest_
+            return result
+
+        selected = ops.fixed_width_keys(
+            val.raw_array_from_parameter(self, 'parent_key', parent_))[parent_filter_]
+        child_ = self._key_parameter('child_key', child_key)
+        key_set = None
+        parts = list()
+        for c in ops.chunks(ops._key_length(child_), self.chunksize):
+            chunk = ops.fixed_width_keys(ops._key_chunk(child_, c[0], c[1]))
+            dtype = ops.common_key_dtype(selected.dtype if key_set is None else key_set.dtype,
+                                         chunk.dtype)
+            if key_set is None or dtype != key_set.dtype:
+                # the keys of indexed string chunks can be wider than those seen so far;
+                # converting them to a narrower dtype would truncate them
+                key_set = ops.KeySet(selected, dtype)
+            part = key_set.contains(chunk)
+            if dest_ is not None:
+                dest_.data.write_part(part)
+            else:
+                parts.append(part)
+        if dest_ is not None:
+            dest_.data.complete()
+            return dest_
+        return np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=bool)
+
+
+    def create_join_map(self, left_on, right_on, how='left', ordered=False, destination=None,
+                        build=None, memory_budget=None):
+        """
+        Match the keys of a join once, generating a JoinMap that can be passed to any of
+        the merge functions to join fields without matching the keys again. The join map
+        records the identity and version of each key, and merge functions reject it if
+        either key has changed.
+        :param left_on: the group/field/numpy array of left keys
+        :param right_on: the group/field/numpy array of right keys
+        :param how: the type of join; one of 'left', 'right', 'inner' or 'outer'
+        :param ordered: whether the keys are sorted. Ordered join maps are generated with
+        the ordered merge kernels and are streamed to 'destination' when the keys are
+        fields. Outer join maps require sorted keys
+        :param destination: optional - a group to which the join map is written, so that
+        it can be reloaded with 'load_join_map'
+        :param build: optional - the build side of the hash join for unordered keys
+        :param memory_budget: optional - the memory budget of the hash join for unordered
+        keys
+        :return: the JoinMap
+        """
+        if how not in jm.JOIN_TYPES:
+            raise ValueError("'how' must be one of {} but is {}".format(jm.JOIN_TYPES, how))
+        left_ = self._key_parameter('left_on', left_on)
+        right_ = self._key_parameter('right_on', right_on)
+        left_outer = how in ('left', 'outer')
+        right_outer = how in ('right', 'outer')
+        identities = (jm.key_identity(left_, self.chunksize),
+                      jm.key_identity(right_, self.chunksize))
+
+        if ordered:
+            if destination is not None and isinstance(left_, fld.Field) and \
+                    isinstance(right_, fld.Field):
+                left_map = self.create_numeric(destination, 'left_map', 'int64')
+                right_map = self.create_numeric(destination, 'right_map', 'int64')
+                for l_map, r_map in ops.ordered_merge_chunks(left_, right_, left_outer,
+                                                             right_outer, self.chunksize):
+                    left_map.data.write_part(l_map)
+                    right_map.data.write_part(r_map)
+                left_map.data.complete()
+                right_map.data.complete()
+                jm.write_join_map_attrs(destination, how, *identities)
+                return jm.JoinMap(how, left_map, right_map, *identities)
+            left_map, right_map = \
+                ops.ordered_merge_maps(val.raw_array_from_parameter(self, 'left_on', left_),
+                                       val.raw_array_from_parameter(self, 'right_on', right_),
+                                       left_outer, right_outer)
+        else:
+            if how == 'outer':
+                raise ValueError("outer join maps can only be created for ordered keys")
+            l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_)
+            r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_)
+            if how == 'right':
+                swapped_build = {'left': 'right', 'right': 'left'}.get(build, build)
+                right_map, left_map, _, _ = ops.hash_join(r_key_raw, l_key_raw, 'left',
+                                                          swapped_build, memory_budget)
+            else:
+                left_map, right_map, _, _ = ops.hash_join(l_key_raw, r_key_raw, how,
+                                                          build, memory_budget)
+
+        join_map = jm.JoinMap(how, left_map, right_map, *identities)
+        if destination is not None:
+            join_map = join_map.write(self, destination)
+        return join_map
 
-        r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
-        r_index = np.arange(len(r_key_raw), dtype=np.int64)
-        r_df = pd.DataFrame({'r_k': r_key_raw, 'r_index': r_index})
 
-        df = pd.merge(left=l_df, right=r_df, left_on='l_k', right_on='r_k', how='left')
-        r_to_l_map = df['r_index'].to_numpy(dtype=np.int64)
-        r_to_l_filt = np.logical_not(df['r_index'].isnull()).to_numpy()
+    def load_join_map(self, group):
+        """
+        Load a join map that was written to 'group' by 'create_join_map'.
+        :param group: the group containing the join map
+        :return: the JoinMap
+        """
+        return jm.read_join_map(self, group)
+
+
+    def _join_map_maps(self, join_map, how, left_on, right_on):
+        # validate the join map against the keys and return its maps as raw arrays
+        join_map.validate(how,
+                          self._key_parameter('left_on', left_on),
+                          self._key_parameter('right_on', right_on),
+                          self.chunksize)
+        return (val.raw_array_from_parameter(self, 'join_map', join_map.left_map),
+                val.raw_array_from_parameter(self, 'join_map', join_map.right_map))
+
+
+    def merge_left(self, left_on, right_on,
+                   right_fields=tuple(), right_writers=None, build=None, memory_budget=None,
+                   join_map=None):
+        """
+        Perform a left join of 'right_fields' onto the keys of 'left_on', using a hash join
+        of the key arrays. Left keys without a match are given empty values.
+        If the keys are fields and one is a foreign key with a current foreign key index
+        on the other, the stored index is used instead of matching the keys.
+        :param left_on: the group/field/numpy array of left keys
+        :param right_on: the group/field/numpy array of right keys
+        :param right_fields: a tuple of groups/fields/numpy arrays to be joined
+        :param right_writers: optional - a tuple of fields to which the joined fields are
+        written
+        :param build: optional - 'left' or 'right'; the side whose keys are inserted into
+        the hash table. Defaults to the side with fewer keys
+        :param memory_budget: optional - the maximum number of bytes for the hash table;
+        larger joins are partitioned by key hash and performed one partition at a time
+        :param join_map: optional - a 'left' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
+        :return: a list of the joined fields if 'right_writers' is not set
+        """
+        fk_maps = None if join_map is not None else \
+            self._foreign_key_join_maps('left', left_on, right_on)
+        if join_map is not None:
+            _, r_to_l_map = self._join_map_maps(join_map, 'left', left_on, right_on)
+            r_to_l_filt = r_to_l_map < ops.INVALID_INDEX
+        elif fk_maps is not None:
+            r_to_l_map = fk_maps[1]
+            r_to_l_filt = r_to_l_map < ops.INVALID_INDEX
+        else:
+            l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
+            r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
+            _, r_to_l_map, _, r_to_l_filt = ops.hash_join(l_key_raw, r_key_raw, 'left',
+                                                          build, memory_budget)
 
         right_results = list()
         for irf, rf in enumerate(right_fields):
             rf_raw = val.raw_array_from_parameter(self, 'right_fields[{}]'.format(irf), rf)
             joined_field = ops.safe_map(rf_raw, r_to_l_map, r_to_l_filt)
-            # joined_field = per._safe_map(rf_raw, r_to_l_map, r_to_l_filt)
             if right_writers is None:
                 right_results.append(joined_field)
             else:
@@ -808,18 +1882,40 @@ class Session:
 
 
     def merge_right(self, left_on, right_on,
-                    left_fields=None, left_writers=None):
-        l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
-        l_index = np.arange(len(l_key_raw), dtype=np.int64)
-        l_df = pd.DataFrame({'l_k': l_key_raw, 'l_index': l_index})
-
-        r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
-        r_index = np.arange(len(r_key_raw), dtype=np.int64)
-        r_df = pd.DataFrame({'r_k': r_key_raw, 'r_index': r_index})
-
-        df = pd.merge(left=r_df, right=l_df, left_on='r_k', right_on='l_k', how='left')
-        l_to_r_map = df['l_index'].to_numpy(dtype='int64')
-        l_to_r_filt = np.logical_not(df['l_index'].isnull()).to_numpy()
+                    left_fields=None, left_writers=None, build=None, memory_budget=None,
+                    join_map=None):
+        """
+        Perform a right join of 'left_fields' onto the keys of 'right_on', using a hash
+        join of the key arrays. Right keys without a match are given empty values.
+        If the keys are fields and one is a foreign key with a current foreign key index
+        on the other, the stored index is used instead of matching the keys.
+        :param left_on: the group/field/numpy array of left keys
+        :param right_on: the group/field/numpy array of right keys
+        :param left_fields: a tuple of groups/fields/numpy arrays to be joined
+        :param left_writers: optional - a tuple of fields to which the joined fields are
+        written
+        :param build: optional - 'left' or 'right'; the side whose keys are inserted into
+        the hash table. Defaults to the side with fewer keys
+        :param memory_budget: optional - the maximum number of bytes for the hash table;
+        larger joins are partitioned by key hash and performed one partition at a time
+        :param join_map: optional - a 'right' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
+        :return: a list of the joined fields if 'left_writers' is not set
+        """
+        fk_maps = None if join_map is not None else \
+            self._foreign_key_join_maps('right', left_on, right_on)
+        if join_map is not None:
+            l_to_r_map, _ = self._join_map_maps(join_map, 'right', left_on, right_on)
+            l_to_r_filt = l_to_r_map < ops.INVALID_INDEX
+        elif fk_maps is not None:
+            l_to_r_map = fk_maps[0]
+            l_to_r_filt = l_to_r_map < ops.INVALID_INDEX
+        else:
+            l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
+            r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
+            swapped_build = {'left': 'right', 'right': 'left'}.get(build, build)
+            _, l_to_r_map, _, l_to_r_filt = ops.hash_join(r_key_raw, l_key_raw, 'left',
+                                                          swapped_build, memory_budget)
 
         left_results = list()
         for ilf, lf in enumerate(left_fields):
@@ -834,20 +1930,44 @@ class Session:
 
 
     def merge_inner(self, left_on, right_on,
-                    left_fields=None, left_writers=None, right_fields=None, right_writers=None):
-        l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
-        l_index = np.arange(len(l_key_raw), dtype=np.int64)
-        l_df = pd.DataFrame({'l_k': l_key_raw, 'l_index': l_index})
-
-        r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
-        r_index = np.arange(len(r_key_raw), dtype=np.int64)
-        r_df = pd.DataFrame({'r_k': r_key_raw, 'r_index': r_index})
-
-        df = pd.merge(left=l_df, right=r_df, left_on='l_k', right_on='r_k', how='inner')
-        l_to_i_map = df['l_index'].to_numpy(dtype='int64')
-        l_to_i_filt = np.logical_not(df['l_index'].isnull()).to_numpy()
-        r_to_i_map = df['r_index'].to_numpy(dtype='int64')
-        r_to_i_filt = np.logical_not(df['r_index'].isnull()).to_numpy()
+                    left_fields=None, left_writers=None, right_fields=None, right_writers=None,
+                    build=None, memory_budget=None, join_map=None):
+        """
+        Perform an inner join of 'left_fields' and 'right_fields' on the keys 'left_on'
+        and 'right_on', using a hash join of the key arrays.
+        If the keys are fields and one is a foreign key with a current foreign key index
+        on the other, the stored index is used instead of matching the keys.
+        :param left_on: the group/field/numpy array of left keys
+        :param right_on: the group/field/numpy array of right keys
+        :param left_fields: a tuple of groups/fields/numpy arrays to be joined
+        :param left_writers: optional - a tuple of fields to which the joined left fields
+        are written
+        :param right_fields: a tuple of groups/fields/numpy arrays to be joined
+        :param right_writers: optional - a tuple of fields to which the joined right fields
+        are written
+        :param build: optional - 'left' or 'right'; the side whose keys are inserted into
+        the hash table. Defaults to the side with fewer keys
+        :param memory_budget: optional - the maximum number of bytes for the hash table;
+        larger joins are partitioned by key hash and performed one partition at a time
+        :param join_map: optional - an 'inner' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
+        :return: a tuple of the lists of joined left and right fields
+        """
+        fk_maps = None if join_map is not None else \
+            self._foreign_key_join_maps('inner', left_on, right_on)
+        if join_map is not None or fk_maps is not None:
+            if fk_maps is not None:
+                l_to_i_map, r_to_i_map = fk_maps
+            else:
+                l_to_i_map, r_to_i_map = \
+                    self._join_map_maps(join_map, 'inner', left_on, right_on)
+            l_to_i_filt = l_to_i_map < ops.INVALID_INDEX
+            r_to_i_filt = r_to_i_map < ops.INVALID_INDEX
+        else:
+            l_key_raw = val.raw_array_from_parameter(self, 'left_on', left_on)
+            r_key_raw = val.raw_array_from_parameter(self, 'right_on', right_on)
+            l_to_i_map, r_to_i_map, l_to_i_filt, r_to_i_filt = \
+                ops.hash_join(l_key_raw, r_key_raw, 'inner', build, memory_budget)
 
         left_results = list()
         for ilf, lf in enumerate(left_fields):
@@ -907,8 +2027,92 @@ class Session:
             ops.ordered_map_valid_stream(src_, map_, snk_)
 
 
+    def _streaming_ordered_merge(self, left_on, right_on, left_outer, right_outer,
+                                 left_map=None, right_map=None,
+                                 left_field_sources=tuple(), left_field_sinks=tuple(),
+                                 right_field_sources=tuple(), right_field_sinks=tuple(),
+                                 merged_key=None):
+        # keys, maps, sources and sinks must be fields; the merge is generated a chunk at a
+        # time and each chunk of the maps is applied to the sources as it is generated
+        left_ = val.field_from_parameter(self, 'left_on', left_on)
+        right_ = val.field_from_parameter(self, 'right_on', right_on)
+        merged_key_ = None if merged_key is None \
+            else val.field_from_parameter(self, 'merged_key', merged_key)
+        maps = list()
+        for name, m in (('left_map', left_map), ('right_map', right_map)):
+            maps.append(None if m is None else val.field_from_parameter(self, name, m))
+        pairs = list()
+        for side, sources, sinks in ((0, left_field_sources, left_field_sinks),
+                                     (1, right_field_sources, right_field_sinks)):
+            for src, snk in zip(sources, sinks):
+                pairs.append((side,
+                              val.field_from_parameter(self, 'field_sources', src),
+                              val.field_from_parameter(self, 'field_sinks', snk)))
+
+        for chunk_maps in ops.ordered_merge_chunks(left_, right_, left_outer, right_outer,
+                                                   self.chunksize):
+            for m, chunk_map in zip(maps, chunk_maps):
+                if m is not None:
+                    m.data.write_part(chunk_map)
+            for side, src, snk in pairs:
+                snk.data.write_part(
+                    ops.map_valid_window(src, chunk_maps[side], snk.data.dtype))
+            if merged_key_ is not None:
+                merged_key_.data.write_part(ops.merged_keys(left_, right_, *chunk_maps))
+
+        for m in maps:
+            if m is not None:
+                m.data.complete()
+        for _, _, snk in pairs:
+            snk.data.complete()
+        if merged_key_ is not None:
+            merged_key_.data.complete()
+
+
+    def _apply_join_map(self, join_map, how, left_on, right_on,
+                        left_field_sources=tuple(), left_field_sinks=None,
+                        right_field_sources=tuple(), right_field_sinks=None):
+        # validate the join map and apply its maps to the sources; persisted maps are
+        # streamed into sinks that are fields
+        join_map.validate(how,
+                          self._key_parameter('left_on', left_on),
+                          self._key_parameter('right_on', right_on),
+                          self.chunksize)
+        results = list()
+        for field_map, sources, sinks in ((join_map.left_map, left_field_sources, left_field_sinks),
+                                          (join_map.right_map, right_field_sources, right_field_sinks)):
+            if len(sources) == 0:
+                results.append(None)
+            elif isinstance(field_map, fld.Field) and sinks is not None and \
+                    val.is_field_parameter(sinks[0]):
+                for src, snk in zip(sources, sinks):
+                    src_ = self._key_parameter('field_sources', src)
+                    snk_ = val.field_from_parameter(self, 'field_sinks', snk)
+                    ops.map_valid_streamed(src_, field_map, snk_, self.chunksize)
+                results.append(None)
+            else:
+                raw_map = val.raw_array_from_parameter(self, 'join_map', field_map)
+                results.append(self._map_fields(raw_map, sources, sinks))
+        return tuple(results)
+
+
+    def _is_streamable_merge(self, keys, maps, sinks):
+        # keys must be fields, and any maps or sinks that are provided must be fields
+        if not all(val.is_field_parameter(k) for k in keys):
+            return False
+        if not all(m is None or val.is_field_parameter(m) for m in maps):
+            return False
+        for sources, field_sinks in sinks:
+            if len(sources) > 0:
+                if field_sinks is None or \
+                        not all(val.is_field_parameter(f) for f in field_sinks):
+                    return False
+        return True
+
+
     def ordered_merge_left(self, left_on, right_on, right_field_sources=tuple(), left_field_sinks=None,
-                           left_to_right_map=None, left_unique=False, right_unique=False):
+                           left_to_right_map=None, left_unique=False, right_unique=False,
+                           left_to_merged_map=None, join_map=None):
         """
         Generate the results of a left join apply it to the fields described in the tuple
         'left_field_sources'. If 'left_field_sinks' is set, the mapped values are written
@@ -929,6 +2133,11 @@ class Session:
         values
         :param right_unique: a hint to indicate whether the 'right_on' field contains
         unique values
+        :param left_to_merged_map: optional - a group/field that the map from the left key
+        to the result is written to. This is only required when neither key is unique, as
+        left rows are then repeated for each matching right row
+        :param join_map: optional - a 'left' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
         :return: If left_field_sinks is not set, a tuple of the output fields is returned
         """
         if left_field_sinks is not None:
@@ -940,6 +2149,11 @@ class Session:
         if left_field_sinks and len(left_field_sinks) > 0:
             val.all_same_basic_type('left_field_sinks', left_field_sinks)
 
+        if join_map is not None:
+            return self._apply_join_map(join_map, 'left', left_on, right_on,
+                                        right_field_sources=right_field_sources,
+                                        right_field_sinks=left_field_sinks)[1]
+
         streamable = val.is_field_parameter(left_on) and \
                      val.is_field_parameter(right_on) and \
                      val.is_field_parameter(right_field_sources[0]) and \
@@ -947,33 +2161,51 @@ class Session:
                      val.is_field_parameter(left_field_sinks[0]) and \
                      left_to_right_map is not None
 
+        if right_unique == False:
+            # many-to-many or one-to-many; left rows can be repeated in the result
+            if self._is_streamable_merge((left_on, right_on),
+                                         (left_to_right_map, left_to_merged_map),
+                                         ((right_field_sources, left_field_sinks),)):
+                self._streaming_ordered_merge(left_on, right_on, True, False,
+                                              left_to_merged_map, left_to_right_map,
+                                              right_field_sources=right_field_sources,
+                                              right_field_sinks=left_field_sinks or tuple())
+                return None
+            left_data = val.array_from_parameter(self, "left_on", left_on)
+            right_data = val.array_from_parameter(self, "right_on", right_on)
+            left_to_merged, result = ops.ordered_merge_maps(left_data, right_data, True, False)
+            if left_to_merged_map is not None:
+                val.field_from_parameter(self, 'left_to_merged_map',
+                                         left_to_merged_map).data.write(left_to_merged)
+            if left_to_right_map is not None:
+                if val.is_field_parameter(left_to_right_map):
+                    val.field_from_parameter(self, 'left_to_right_map',
+                                             left_to_right_map).data.write(result)
+                else:
+                    left_to_right_map[:] = result
+            return self._map_fields(result, right_field_sources, left_field_sinks)
+
         result = None
         has_unmapped = None
         if left_unique == False:
-            if right_unique == False:
-                raise ValueError("Right key must not have duplicates")
-            else:
-                if streamable:
-                    has_unmapped = \
-                        ops.ordered_map_to_right_right_unique_streamed(left_on, right_on,
-                                                                      left_to_right_map)
-                    result = left_to_right_map
-                else:
-                    result = np.zeros(len(left_on), dtype=np.int64)
-                    left_data = val.array_from_parameter(self, "left_on", left_on)
-                    right_data = val.array_from_parameter(self, "right_on", right_on)
-                    has_unmapped = \
-                        ops.ordered_map_to_right_right_unique(
-                            left_data, right_data, result)
-        else:
-            if right_unique == False:
-                raise ValueError("Right key must not have duplicates")
+            if streamable:
+                has_unmapped = \
+                    ops.ordered_map_to_right_right_unique_streamed(left_on, right_on,
+                                                                  left_to_right_map)
+                result = left_to_right_map
             else:
                 result = np.zeros(len(left_on), dtype=np.int64)
                 left_data = val.array_from_parameter(self, "left_on", left_on)
                 right_data = val.array_from_parameter(self, "right_on", right_on)
-                has_unmapped = ops.ordered_map_to_right_both_unique(
-                    left_data, right_data, result)
+                has_unmapped = \
+                    ops.ordered_map_to_right_right_unique(
+                        left_data, right_data, result)
+        else:
+            result = np.zeros(len(left_on), dtype=np.int64)
+            left_data = val.array_from_parameter(self, "left_on", left_on)
+            right_data = val.array_from_parameter(self, "right_on", right_on)
+            has_unmapped = ops.ordered_map_to_right_both_unique(
+                left_data, right_data, result)
 
         if streamable:
             self._streaming_map_fields(result, right_field_sources, left_field_sinks)
@@ -985,7 +2217,8 @@ class Session:
 
     def ordered_merge_right(self, left_on, right_on,
                             left_field_sources=tuple(), right_field_sinks=None,
-                            right_to_left_map=None, left_unique=False, right_unique=False):
+                            right_to_left_map=None, left_unique=False, right_unique=False,
+                            right_to_merged_map=None, join_map=None):
         """
         Generate the results of a right join apply it to the fields described in the tuple
         'right_field_sources'. If 'right_field_sinks' is set, the mapped values are written
@@ -1006,17 +2239,54 @@ class Session:
         values
         :param right_unique: a hint to indicate whether the 'right_on' field contains
         unique values
+        :param right_to_merged_map: optional - a group/field that the map from the right
+        key to the result is written to. This is only required when neither key is unique,
+        as right rows are then repeated for each matching left row
+        :param join_map: optional - a 'right' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
         :return: If right_field_sinks is not set, a tuple of the output fields is returned
         """
+        if join_map is not None:
+            return self._apply_join_map(join_map, 'right', left_on, right_on,
+                                        left_field_sources=left_field_sources,
+                                        left_field_sinks=right_field_sinks)[0]
         return self.ordered_merge_left(right_on, left_on, left_field_sources, right_field_sinks,
-                                       right_to_left_map, right_unique, left_unique)
+                                       right_to_left_map, right_unique, left_unique,
+                                       right_to_merged_map)
 
 
     def ordered_merge_inner(self, left_on, right_on,
                             left_field_sources=tuple(), left_field_sinks=None,
                             right_field_sources=tuple(), right_field_sinks=None,
-                            left_unique=False, right_unique=False):
-
+                            left_unique=False, right_unique=False,
+                            left_to_inner_map=None, right_to_inner_map=None, join_map=None):
+        """
+        Generate the results of an inner join and apply it to the fields described in the
+        tuples 'left_field_sources' and 'right_field_sources'. If the sinks are set, the
+        mapped values are written to the fields / arrays set there.
+        If the keys are groups / fields and all sinks and maps are groups / fields, the
+        merge is performed a chunk at a time, and each chunk of the maps is applied to the
+        sources as it is generated, so neither the keys nor the maps are held in memory.
+        :param left_on: the group/field/numba array that contains the left key values
+        :param right_on: the group/field/numba array that contains the right key values
+        :param left_field_sources: a tuple of group/fields/numba arrays that contain the
+        left fields to be joined
+        :param left_field_sinks: optional - a tuple of group/fields/numba arrays that
+        the mapped left fields should be written to
+        :param right_field_sources: a tuple of group/fields/numba arrays that contain the
+        right fields to be joined
+        :param right_field_sinks: optional - a tuple of group/fields/numba arrays that
+        the mapped right fields should be written to
+        :param left_unique: a hint to indicate whether the 'left_on' field contains unique
+        values
+        :param right_unique: a hint to indicate whether the 'right_on' field contains
+        unique values
+        :param left_to_inner_map: optional - a group/field that the left map is written to
+        :param right_to_inner_map: optional - a group/field that the right map is written to
+        :param join_map: optional - an 'inner' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again
+        :return: If the sinks are not set, the output fields are returned
+        """
         if left_field_sinks is not None:
             if len(left_field_sources) != len(left_field_sinks):
                 msg = ("{} and {} should be of the same length but are length {} and {} "
@@ -1035,6 +2305,25 @@ class Session:
         if right_field_sinks and len(right_field_sinks) > 0:
             val.all_same_basic_type('right_field_sinks', right_field_sinks)
 
+        if join_map is not None:
+            rtn_left_sinks, rtn_right_sinks = \
+                self._apply_join_map(join_map, 'inner', left_on, right_on,
+                                     left_field_sources, left_field_sinks,
+                                     right_field_sources, right_field_sinks)
+            if rtn_left_sinks:
+                return (rtn_left_sinks, rtn_right_sinks) if rtn_right_sinks else rtn_left_sinks
+            return rtn_right_sinks
+
+        if self._is_streamable_merge((left_on, right_on),
+                                     (left_to_inner_map, right_to_inner_map),
+                                     ((left_field_sources, left_field_sinks),
+                                      (right_field_sources, right_field_sinks))):
+            self._streaming_ordered_merge(left_on, right_on, False, False,
+                                          left_to_inner_map, right_to_inner_map,
+                                          left_field_sources, left_field_sinks or tuple(),
+                                          right_field_sources, right_field_sinks or tuple())
+            return None
+
         left_data = val.array_from_parameter(self, 'left_on', left_on)
         right_data = val.array_from_parameter(self, 'right_on', right_on)
 
@@ -1064,3 +2353,105 @@ class Session:
                 return rtn_left_sinks
         else:
             return rtn_right_sinks
+
+
+    def ordered_merge_outer(self, left_on, right_on,
+                            left_field_sources=tuple(), left_field_sinks=None,
+                            right_field_sources=tuple(), right_field_sinks=None,
+                            left_unique=False, right_unique=False,
+                            left_to_outer_map=None, right_to_outer_map=None, merged_key=None,
+                            join_map=None):
+        """
+        Generate the results of a full outer join of sorted keys and apply it to the fields
+        described in the tuples 'left_field_sources' and 'right_field_sources'. Rows of
+        the result that have no left or right key have INVALID_INDEX in the corresponding
+        map, and the mapped fields are given a value of 0 for those rows.
+        If the keys are groups / fields and all sinks and maps are groups / fields, the
+        merge is performed a chunk at a time, in a single pass over both keys.
+        :param left_on: the group/field/numba array that contains the left key values
+        :param right_on: the group/field/numba array that contains the right key values
+        :param left_field_sources: a tuple of group/fields/numba arrays that contain the
+        left fields to be joined
+        :param left_field_sinks: optional - a tuple of group/fields that the mapped left
+        fields should be written to
+        :param right_field_sources: a tuple of group/fields/numba arrays that contain the
+        right fields to be joined
+        :param right_field_sinks: optional - a tuple of group/fields that the mapped right
+        fields should be written to
+        :param left_unique: a hint to indicate whether the 'left_on' field contains unique
+        values
+        :param right_unique: a hint to indicate whether the 'right_on' field contains
+        unique values
+        :param left_to_outer_map: optional - a group/field that the left map is written to
+        :param right_to_outer_map: optional - a group/field that the right map is written to
+        :param merged_key: optional - a group/field that the keys of the result are
+        written to
+        :param join_map: optional - an 'outer' JoinMap for these keys, created with
+        'create_join_map'. If set, the keys are not matched again and the maps of the
+        join map are returned in place of 'left_to_outer_map' and 'right_to_outer_map'
+        :return: a tuple of (left_to_outer_map, right_to_outer_map, merged_key,
+        left_results, right_results). When streaming, these are the fields that were
+        passed in and the results are None; otherwise the maps and merged key are numpy
+        arrays and the results are tuples of the mapped fields if sinks were not set
+        """
+        for sources, sinks, name in ((left_field_sources, left_field_sinks, 'left'),
+                                     (right_field_sources, right_field_sinks, 'right')):
+            if sinks is not None and len(sources) != len(sinks):
+                msg = ("{}_field_sources and {}_field_sinks should be of the same length but "
+                       "are length {} and {} respectively")
+                raise ValueError(msg.format(name, name, len(sources), len(sinks)))
+
+        if join_map is not None:
+            rtn_left_sinks, rtn_right_sinks = \
+                self._apply_join_map(join_map, 'outer', left_on, right_on,
+                                     left_field_sources, left_field_sinks,
+                                     right_field_sources, right_field_sinks)
+            left_ = self._key_parameter('left_on', left_on)
+            right_ = self._key_parameter('right_on', right_on)
+            if merged_key is None:
+                merged = None
+                if not join_map.is_persisted():
+                    merged = ops.merged_keys(left_, right_,
+                                             join_map.left_map, join_map.right_map)
+            else:
+                merged = val.field_from_parameter(self, 'merged_key', merged_key)
+                for c in ops.chunks(len(join_map), self.chunksize):
+                    merged.data.write_part(
+                        ops.merged_keys(left_, right_, *join_map.maps(c[0], c[1])))
+                merged.data.complete()
+            return join_map.left_map, join_map.right_map, merged, \
+                rtn_left_sinks, rtn_right_sinks
+
+        if self._is_streamable_merge((left_on, right_on),
+                                     (left_to_outer_map, right_to_outer_map, merged_key),
+                                     ((left_field_sources, left_field_sinks),
+                                      (right_field_sources, right_field_sinks))):
+            self._streaming_ordered_merge(left_on, right_on, True, True,
+                                          left_to_outer_map, right_to_outer_map,
+                                          left_field_sources, left_field_sinks or tuple(),
+                                          right_field_sources, right_field_sinks or tuple(),
+                                          merged_key)
+            return left_to_outer_map, right_to_outer_map, merged_key, None, None
+
+        left_data = val.array_from_parameter(self, 'left_on', left_on)
+        right_data = val.array_from_parameter(self, 'right_on', right_on)
+        if left_unique and right_unique:
+            outer_length = ops.ordered_outer_map_result_size_both_unique(left_data, right_data)
+            left_to_outer = np.zeros(outer_length, dtype=np.int64)
+            right_to_outer = np.zeros(outer_length, dtype=np.int64)
+            ops.ordered_outer_map_both_unique(left_data, right_data,
+                                              left_to_outer, right_to_outer)
+        else:
+            left_to_outer, right_to_outer = \
+                ops.ordered_merge_maps(left_data, right_data, True, True)
+        merged = ops.merged_keys(left_data, right_data, left_to_outer, right_to_outer)
+
+        for name, dest, result in (('left_to_outer_map', left_to_outer_map, left_to_outer),
+                                   ('right_to_outer_map', right_to_outer_map, right_to_outer),
+                                   ('merged_key', merged_key, merged)):
+            if dest is not None:
+                val.field_from_parameter(self, name, dest).data.write(result)
+
+        rtn_left_sinks = self._map_fields(left_to_outer, left_field_sources, left_field_sinks)
+        rtn_right_sinks = self._map_fields(right_to_outer, right_field_sources, right_field_sinks)
+        return left_to_outer, right_to_outer, merged, rtn_left_sinks, rtn_right_sinks
@@ -0,0 +1,541 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numba import njit
+
+from exetera.core import fields
+from exetera.core import operations as ops
+
+
+# Sketches are small summaries of a stream of values from which distinct counts and
+# quantiles can be estimated. A sketch can be built a chunk at a time, and sketches of
+# different parts of a field can be merged, so fields can be summarised in partitions.
+
+# HyperLogLog distinct counts
+# ===========================
+
+HLL_DEFAULT_PRECISION = 14
+
+_TOP_BIT = np.uint64(1 << 63)
+
+
+def _check_precision(precision):
+    if not 4 <= precision <= 18:
+        raise ValueError("'precision' must be between 4 and 18 but is {}".format(precision))
+
+
+@njit(nogil=True)
+def _hll_register(h, precision):
+    # the register is chosen by the top bits of the (remixed) hash, and its rank is one
+    # more than the number of leading zeros of the remaining bits
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    register = np.int64(h >> np.uint64(64 - precision))
+    w = (h << np.uint64(precision)) | (np.uint64(1) << np.uint64(precision - 1))
+    rank = 1
+    while w & _TOP_BIT == np.uint64(0):
+        rank += 1
+        w <<= np.uint64(1)
+    return register, rank
+
+
+@njit(nogil=True)
+def _hll_add(hashes, valid, precision, registers):
+    for i in range(len(hashes)):
+        if valid[i]:
+            register, rank = _hll_register(hashes[i], precision)
+            if rank > registers[register]:
+                registers[register] = rank
+
+
+@njit(nogil=True)
+def _hll_estimate(inverse_sum, zeros, m):
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / inverse_sum
+    if estimate <= 2.5 * m and zeros > 0:
+        # linear counting is more accurate for small cardinalities
+        estimate = m * np.log(m / zeros)
+    return estimate
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog sketch for estimating the number of distinct values in a stream. The
+    relative standard error of the estimate is about 1.04 / sqrt(2 ** precision).
+    :param precision: the base two logarithm of the number of registers, between 4 and 18
+    """
+    def __init__(self, precision=HLL_DEFAULT_PRECISION):
+        _check_precision(precision)
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes, valid=None):
+        """
+        Add a chunk of values, given as their 64 bit hashes, to the sketch.
+        """
+        valid = np.ones(len(hashes), dtype=bool) if valid is None else valid
+        _hll_add(hashes, valid, self.precision, self.registers)
+
+    def add(self, values, valid=None):
+        """
+        Add a chunk of values to the sketch. NaNs are never counted.
+        :param values: an ndarray of fixed-width values, or a list of strings
+        :param valid: optional - a boolean ndarray indicating which values to add
+        """
+        hashes, keep = _hash_values(values)
+        self.add_hashes(hashes, keep if valid is None else keep & valid)
+
+    def merge(self, other):
+        """
+        Merge another sketch of the same precision into this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Sketches of precision {} and {} can't be "
+                             "merged".format(self.precision, other.precision))
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        """
+        Estimate the number of distinct values added to the sketch.
+        """
+        m = len(self.registers)
+        inverse_sum = np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = np.count_nonzero(self.registers == 0)
+        return int(round(_hll_estimate(inverse_sum, zeros, m)))
+
+
+@njit(nogil=True)
+def _hll_spans_add(hashes, valid, boundaries, chunk_start, precision,
+                   registers, touched, state, results):
+    # add a chunk of values to the sketch of the current span, completing a span at each
+    # boundary in the chunk. Only the registers touched by a span are reset after it, so
+    # short spans don't pay for the size of the sketch. state holds the number of touched
+    # registers and the index of the current span
+    m = len(registers)
+    start = 0
+    for b in range(len(boundaries) + 1):
+        end = boundaries[b] - chunk_start if b < len(boundaries) else len(hashes)
+        for i in range(start, end):
+            if not valid[i]:
+                continue
+            register, rank = _hll_register(hashes[i], precision)
+            if registers[register] == 0:
+                touched[state[0]] = register
+                state[0] += 1
+            if rank > registers[register]:
+                registers[register] = rank
+        start = end
+        if b < len(boundaries):
+            count = state[0]
+            inverse_sum = np.float64(m - count)
+            for t in range(count):
+                inverse_sum += 2.0 ** -np.float64(registers[touched[t]])
+                registers[touched[t]] = 0
+            results[state[1]] = 0 if count == 0 else \
+                np.int64(np.round(_hll_estimate(inverse_sum, m - count, m)))
+            state[0] = 0
+            state[1] += 1
+
+
+# KLL quantiles
+# =============
+
+KLL_DEFAULT_K = 200
+KLL_MAX_LEVELS = 48
+
+
+def _check_k(k):
+    if k < 8:
+        raise ValueError("'k' must be at least 8 but is {}".format(k))
+
+
+KLL_MIN_CAPACITY = 8
+
+
+@njit(nogil=True)
+def _kll_grow(k, caps, meta):
+    # add a level to the top of the sketch; the capacity of each level shrinks
+    # geometrically with its depth below the top level
+    meta[0] += 1
+    meta[2] = 0
+    for h in range(meta[0]):
+        caps[h] = max(KLL_MIN_CAPACITY, int(np.ceil(k * (2.0 / 3.0) ** (meta[0] - h - 1))))
+        meta[2] += caps[h]
+
+
+@njit(nogil=True)
+def _kll_compact(k, items, counts, caps, meta, rng, level):
+    # sort a level and promote every other item (starting at a random offset) to the level
+    # above, where each item stands for twice as many values
+    if level + 1 == meta[0]:
+        _kll_grow(k, caps, meta)
+    c = counts[level]
+    items[level, :c].sort()
+    rng[0] ^= rng[0] << np.uint64(13)
+    rng[0] ^= rng[0] >> np.uint64(7)
+    rng[0] ^= rng[0] << np.uint64(17)
+    offset = np.int64(rng[0] & np.uint64(1))
+    pairs = c // 2
+    dest = counts[level + 1]
+    for i in range(pairs):
+        items[level + 1, dest + i] = items[level, 2 * i + offset]
+    counts[level + 1] += pairs
+    if c % 2 == 1:
+        items[level, 0] = items[level, c - 1]
+    counts[level] = c % 2
+    meta[1] -= pairs
+
+
+@njit(nogil=True)
+def _kll_insert(k, items, counts, caps, meta, rng, level, v):
+    while level >= meta[0]:
+        _kll_grow(k, caps, meta)
+    items[level, counts[level]] = v
+    counts[level] += 1
+    meta[1] += 1
+    # compact the lowest level that is over capacity until the sketch is below its
+    # maximum size; there is always such a level while it is not
+    while meta[1] >= meta[2]:
+        for h in range(meta[0]):
+            if counts[h] >= caps[h]:
+                _kll_compact(k, items, counts, caps, meta, rng, h)
+                break
+
+
+@njit(nogil=True)
+def _kll_add(values, valid, k, items, counts, caps, meta, rng, bounds):
+    for i in range(len(values)):
+        v = np.float64(values[i])
+        if valid[i] and not np.isnan(v):
+            if meta[3] == 0 or v < bounds[0]:
+                bounds[0] = v
+            if meta[3] == 0 or v > bounds[1]:
+                bounds[1] = v
+            meta[3] += 1
+            _kll_insert(k, items, counts, caps, meta, rng, 0, v)
+
+
+@njit(nogil=True)
+def _kll_merge(k, items, counts, caps, meta, rng, bounds,
+               other_items, other_counts, other_meta, other_bounds):
+    if other_meta[3] == 0:
+        return
+    if meta[3] == 0 or other_bounds[0] < bounds[0]:
+        bounds[0] = other_bounds[0]
+    if meta[3] == 0 or other_bounds[1] > bounds[1]:
+        bounds[1] = other_bounds[1]
+    meta[3] += other_meta[3]
+    for h in range(other_meta[0]):
+        for i in range(other_counts[h]):
+            _kll_insert(k, items, counts, caps, meta, rng, h, other_items[h, i])
+
+
+@njit(nogil=True)
+def _kll_quantiles(items, counts, meta, bounds, quantiles, results):
+    # each item at level h stands for 2 ** h values; a quantile is the smallest retained
+    # item whose cumulative weight reaches that fraction of the values
+    if meta[3] == 0:
+        results[:] = np.nan
+        return
+    retained = np.zeros(meta[1], dtype=np.float64)
+    weights = np.zeros(meta[1], dtype=np.float64)
+    n = 0
+    for h in range(meta[0]):
+        for i in range(counts[h]):
+            retained[n] = items[h, i]
+            weights[n] = 2.0 ** h
+            n += 1
+    order = np.argsort(retained)
+    cumulative = np.cumsum(weights[order])
+    for q in range(len(quantiles)):
+        if quantiles[q] <= 0:
+            results[q] = bounds[0]
+        elif quantiles[q] >= 1:
+            results[q] = bounds[1]
+        else:
+            pos = np.searchsorted(cumulative, quantiles[q] * cumulative[-1])
+            results[q] = retained[order[min(pos, n - 1)]]
+
+
+def _kll_arrays(k):
+    # the items and counts of each level, the capacities of the levels, the metadata of the
+    # sketch, the state of its random number generator and the minimum and maximum values.
+    # The metadata holds the number of levels, the number of retained items, the number of
+    # retained items that triggers a compaction and the number of values added
+    caps = np.zeros(KLL_MAX_LEVELS, dtype=np.int64)
+    meta = np.zeros(4, dtype=np.int64)
+    _kll_grow(k, caps, meta)
+    # no level can hold more items than the largest maximum size of the sketch
+    width = max(KLL_MIN_CAPACITY, int(np.ceil(k))) * 3 + KLL_MIN_CAPACITY * KLL_MAX_LEVELS
+    return (np.zeros((KLL_MAX_LEVELS, width), dtype=np.float64),
+            np.zeros(KLL_MAX_LEVELS, dtype=np.int64), caps, meta,
+            np.asarray([0x9e3779b97f4a7c15], dtype=np.uint64), np.zeros(2, dtype=np.float64))
+
+
+def _check_quantiles(quantiles):
+    quantiles = np.asarray(quantiles, dtype=np.float64).reshape(-1)
+    if np.any(np.isnan(quantiles)) or np.any(quantiles < 0) or np.any(quantiles > 1):
+        raise ValueError("quantiles must be between 0 and 1 but are {}".format(quantiles))
+    return quantiles
+
+
+class KLLSketch:
+    """
+    A KLL sketch for estimating the quantiles of a stream of numeric values. The rank
+    error of an estimate is about 1.7 / k; quantiles are exact until more than about
+    3 * k values have been added.
+    :param k: the size of the top level of the sketch
+    """
+    def __init__(self, k=KLL_DEFAULT_K):
+        _check_k(k)
+        self.k = k
+        self.items, self.counts, self.caps, self.meta, self.rng, self.bounds = _kll_arrays(k)
+
+    def __len__(self):
+        return int(self.meta[3])
+
+    def add(self, values, valid=None):
+        """
+        Add a chunk of values to the sketch. NaNs are never added.
+        :param values: an ndarray of numeric values
+        :param valid: optional - a boolean ndarray indicating which values to add
+        """
+        values = np.asarray(values)
+        valid = np.ones(len(values), dtype=bool) if valid is None else valid
+        _kll_add(values, valid, self.k, self.items, self.counts, self.caps, self.meta,
+                 self.rng, self.bounds)
+
+    def merge(self, other):
+        """
+        Merge another sketch with the same 'k' into this one.
+        """
+        if other.k != self.k:
+            raise ValueError("Sketches with k of {} and {} can't be merged".format(self.k,
+                                                                                  other.k))
+        _kll_merge(self.k, self.items, self.counts, self.caps, self.meta, self.rng,
+                   self.bounds, other.items, other.counts, other.meta, other.bounds)
+        return self
+
+    def quantiles(self, quantiles):
+        """
+        Estimate quantiles of the values added to the sketch.
+        :param quantiles: a sequence of quantiles, each between 0 and 1. The estimate of a
+        quantile q is the smallest value whose rank is at least q times the number of values
+        (numpy's 'inverted_cdf' method); 0 and 1 give the exact minimum and maximum
+        :return: an ndarray of estimates, which are NaN if no values have been added
+        """
+        quantiles = _check_quantiles(quantiles)
+        results = np.zeros(len(quantiles), dtype=np.float64)
+        _kll_quantiles(self.items, self.counts, self.meta, self.bounds, quantiles, results)
+        return results
+
+
+@njit(nogil=True)
+def _kll_spans_add(values, valid, boundaries, chunk_start, k, items, counts, caps, meta,
+                   rng, bounds, quantiles, span, results):
+    # add a chunk of values to the sketch of the current span, completing a span at each
+    # boundary in the chunk
+    start = 0
+    for b in range(len(boundaries) + 1):
+        end = boundaries[b] - chunk_start if b < len(boundaries) else len(values)
+        _kll_add(values[start:end], valid[start:end], k, items, counts, caps, meta, rng,
+                 bounds)
+        start = end
+        if b < len(boundaries):
+            _kll_quantiles(items, counts, meta, bounds, quantiles, results[span[0]])
+            counts[:meta[0]] = 0
+            meta[:] = 0
+            _kll_grow(k, caps, meta)
+            span[0] += 1
+
+
+# streaming over fields and spans
+# ===============================
+
+def _hash_values(values):
+    # hash a chunk of values, returning the hashes and a filter of the values that are
+    # not NaN
+    if isinstance(values, list) or np.asarray(values).dtype.hasobject:
+        indices, raw = ops.encode_strings(values)
+        return ops.hash_indexed_strings(indices, raw, np.zeros(len(values), dtype=np.uint64)), \
+            np.ones(len(values), dtype=bool)
+    values = np.asarray(values)
+    keep = np.ones(len(values), dtype=bool)
+    if np.issubdtype(values.dtype, np.floating):
+        keep = np.logical_not(np.isnan(values))
+        # -0.0 and 0.0 are the same value but have different bytes
+        values = values + values.dtype.type(0)
+    return ops.hash_key_rows(ops.key_rows(values), np.zeros(len(values), dtype=np.uint64)), keep
+
+
+def _hash_chunk(column, start, end):
+    if isinstance(column, fields.IndexedStringField):
+        indices = np.asarray(column.indices[start:end + 1], dtype=np.int64)
+        values = column.values[indices[0]:indices[-1]]
+        return ops.hash_indexed_strings(indices - indices[0], values,
+                                        np.zeros(end - start, dtype=np.uint64)), \
+            np.ones(end - start, dtype=bool)
+    return _hash_values(ops._key_chunk(column, start, end))
+
+
+def _valid_chunk(valid, start, end):
+    if valid is None:
+        return np.ones(end - start, dtype=bool)
+    return np.asarray(ops._key_chunk(valid, start, end)).astype(bool, copy=False)
+
+
+def _check_valid(length, valid, name):
+    if valid is not None and ops._key_length(valid) != length:
+        raise ValueError("'{}' (length {}) must be the same length as the source "
+                         "({})".format(name, ops._key_length(valid), length))
+
+
+def _sketch_column(sketch_factory, add_chunk, column, chunksize, workers):
+    # build a sketch of each of 'workers' contiguous partitions of the column in parallel
+    # and merge them
+    length = ops._key_length(column)
+
+    def sketch_partition(start, end):
+        sketch = sketch_factory()
+        for c in ops.chunks(end - start, chunksize):
+            add_chunk(sketch, start + c[0], start + c[1])
+        return sketch
+
+    if workers is None or workers == 1 or length == 0:
+        return sketch_partition(0, length)
+    bounds = np.linspace(0, length, workers + 1).astype(np.int64)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(sketch_partition, bounds[i], bounds[i + 1])
+                   for i in range(workers)]
+        sketches = [f.result() for f in futures]
+    for s in sketches[1:]:
+        sketches[0].merge(s)
+    return sketches[0]
+
+
+def approx_count_distinct(column, filter=None, precision=HLL_DEFAULT_PRECISION,
+                          chunksize=ops.DEFAULT_CHUNKSIZE, workers=None):
+    """
+    Estimate the number of distinct values of a column with a HyperLogLog sketch, reading
+    it a chunk at a time.
+    :param column: a field or ndarray
+    :param filter: optional - a field or ndarray of booleans; only rows for which it is
+    True are counted
+    :param precision: the precision of the sketch; see HyperLogLog
+    :param workers: optional - the number of partitions of the column sketched at once
+    :return: the estimated number of distinct values
+    """
+    _check_valid(ops._key_length(column), filter, 'filter')
+
+    def add_chunk(sketch, start, end):
+        hashes, keep = _hash_chunk(column, start, end)
+        sketch.add_hashes(hashes, keep & _valid_chunk(filter, start, end))
+
+    return _sketch_column(lambda: HyperLogLog(precision), add_chunk, column, chunksize,
+                          workers).estimate()
+
+
+def approx_quantiles(column, quantiles, filter=None, k=KLL_DEFAULT_K,
+                     chunksize=ops.DEFAULT_CHUNKSIZE, workers=None):
+    """
+    Estimate quantiles of a numeric column with a KLL sketch, reading it a chunk at a time.
+    :param column: a numeric field or ndarray
+    :param quantiles: a sequence of quantiles, each between 0 and 1
+    :param filter: optional - a field or ndarray of booleans; only rows for which it is
+    True are included
+    :param k: the size of the sketch; see KLLSketch
+    :param workers: optional - the number of partitions of the column sketched at once
+    :return: an ndarray of estimates, one per quantile
+    """
+    _check_valid(ops._key_length(column), filter, 'filter')
+
+    def add_chunk(sketch, start, end):
+        sketch.add(ops._key_chunk(column, start, end), _valid_chunk(filter, start, end))
+
+    return _sketch_column(lambda: KLLSketch(k), add_chunk, column, chunksize,
+                          workers).quantiles(quantiles)
+
+
+def _span_chunks(spans, chunksize):
+    # yield each chunk of rows along with the span boundaries that fall within it (after
+    # its start and up to and including its end)
+    for c in ops.chunks(spans[-1], chunksize):
+        lo = np.searchsorted(spans, c[0], side='right')
+        hi = np.searchsorted(spans, c[1], side='right')
+        yield c[0], c[1], np.asarray(spans[lo:hi], dtype=np.int64)
+
+
+def apply_spans_approx_count_distinct(spans, src, valid=None,
+                                      precision=HLL_DEFAULT_PRECISION,
+                                      chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Estimate the number of distinct values in each span of a column with HyperLogLog
+    sketches, reading the column a chunk at a time. Spans may cross chunks.
+    :param spans: the spans over which to aggregate
+    :param src: a field or ndarray of length spans[-1]
+    :param valid: optional - a field or ndarray of booleans indicating which values count
+    :param precision: the precision of the sketches; see HyperLogLog
+    :return: an int64 ndarray of estimates, one per span
+    """
+    spans = np.asarray(spans, dtype=np.int64)
+    if ops._key_length(src) != spans[-1]:
+        raise ValueError("'src' (length {}) must be the length of the spans "
+                         "({})".format(ops._key_length(src), spans[-1]))
+    _check_valid(spans[-1], valid, 'valid')
+    _check_precision(precision)
+    m = 1 << precision
+    registers = np.zeros(m, dtype=np.uint8)
+    touched = np.zeros(m, dtype=np.int64)
+    state = np.zeros(2, dtype=np.int64)
+    # leading empty spans have no boundary within a chunk
+    state[1] = np.count_nonzero(spans[1:] == 0)
+    results = np.zeros(len(spans) - 1, dtype=np.int64)
+    for start, end, boundaries in _span_chunks(spans, chunksize):
+        hashes, keep = _hash_chunk(src, start, end)
+        _hll_spans_add(hashes, keep & _valid_chunk(valid, start, end), boundaries, start,
+                       precision, registers, touched, state, results)
+    return results
+
+
+def apply_spans_approx_quantiles(spans, src, quantiles, valid=None, k=KLL_DEFAULT_K,
+                                 chunksize=ops.DEFAULT_CHUNKSIZE):
+    """
+    Estimate quantiles of the values in each span of a numeric column with KLL sketches,
+    reading the column a chunk at a time. Spans may cross chunks.
+    :param spans: the spans over which to aggregate
+    :param src: a numeric field or ndarray of length spans[-1]
+    :param quantiles: a sequence of quantiles, each between 0 and 1; see KLLSketch
+    :param valid: optional - a field or ndarray of booleans indicating which values count
+    :param k: the size of the sketches; see KLLSketch
+    :return: a float64 ndarray of shape (span count, quantile count). Spans with no valid
+    values have NaN estimates
+    """
+    spans = np.asarray(spans, dtype=np.int64)
+    if ops._key_length(src) != spans[-1]:
+        raise ValueError("'src' (length {}) must be the length of the spans "
+                         "({})".format(ops._key_length(src), spans[-1]))
+    _check_valid(spans[-1], valid, 'valid')
+    quantiles = _check_quantiles(quantiles)
+    _check_k(k)
+    items, counts, caps, meta, rng, bounds = _kll_arrays(k)
+    results = np.full((len(spans) - 1, len(quantiles)), np.nan, dtype=np.float64)
+    span = np.asarray([np.count_nonzero(spans[1:] == 0)], dtype=np.int64)
+    for start, end, boundaries in _span_chunks(spans, chunksize):
+        values = np.asarray(ops._key_chunk(src, start, end))
+        _kll_spans_add(values, _valid_chunk(valid, start, end), boundaries, start, k,
+                       items, counts, caps, meta, rng, bounds, quantiles, span, results)
+    return results
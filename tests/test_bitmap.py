@@ -0,0 +1,88 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from io import BytesIO
+
+import numpy as np
+import h5py
+
+from exetera.core import session
+from exetera.core.bitmap import Bitmap
+
+
+class TestBitmap(unittest.TestCase):
+
+    def test_set_operations(self):
+        length = 200000
+        rng = np.random.RandomState(12345678)
+        # a mixture of dense, sparse and missing containers
+        a = rng.uniform(size=length) < np.where(np.arange(length) < 70000, 0.5, 0.01)
+        b = rng.uniform(size=length) < np.where(np.arange(length) > 130000, 0.6, 0.02)
+        a[140000:150000] = False
+        ba, bb = Bitmap.from_filter(a), Bitmap.from_filter(b)
+        self.assertEqual(length, len(ba))
+        self.assertEqual(a.sum(), ba.count())
+        self.assertTrue(np.array_equal(a, ba.to_filter()))
+        self.assertTrue(np.array_equal(np.flatnonzero(b), bb.to_indices()))
+        self.assertTrue(np.array_equal(a & b, (ba & bb).to_filter()))
+        self.assertTrue(np.array_equal(a | b, (ba | bb).to_filter()))
+        self.assertTrue(np.array_equal(a & ~b, (ba - bb).to_filter()))
+        self.assertTrue(np.array_equal(~a, (~ba).to_filter()))
+        self.assertTrue(np.array_equal(~(a | b) | (a & b), (~(ba | bb) | (ba & bb)).to_filter()))
+        self.assertTrue(np.array_equal(a[65000:140000], ba[65000:140000]))
+        with self.assertRaises(ValueError):
+            ba & Bitmap.from_filter(a[:-1])
+
+    def test_write_read(self):
+        bio = BytesIO()
+        flt = np.zeros(100000, dtype=bool)
+        flt[:80000:3] = True
+        flt[99990:] = True
+        with h5py.File(bio, 'w') as hf:
+            Bitmap.from_filter(flt).write(hf, 'bitmap')
+            self.assertTrue(np.array_equal(flt, Bitmap.read(hf['bitmap']).to_filter()))
+
+
+class TestBitmapIndex(unittest.TestCase):
+
+    def test_bitmap_index_filters(self):
+        bio = BytesIO()
+        with session.Session(1000) as s:
+            ds = s.open_dataset(bio, 'w', 'ds')
+            rng = np.random.RandomState(12345678)
+            values = rng.randint(0, 4, size=5000).astype(np.int8)
+            cat = s.create_categorical(ds, 'cat', 'int8',
+                                       {'na': 0, 'red': 1, 'green': 2, 'blue': 3})
+            cat.data.write(values)
+            ages = s.create_numeric(ds, 'age', 'int32')
+            ages.data.write(np.arange(5000, dtype=np.int32))
+
+            self.assertIsNone(s.get_bitmap_index(cat, build=False))
+            s.create_bitmap_index(cat)
+            index = s.get_bitmap_index(s.get(ds['cat']), build=False)
+            self.assertTrue(np.array_equal(values == 1, index.eq('red').to_filter()))
+            self.assertTrue(np.array_equal(values == 2, index.eq(2).to_filter()))
+            not_na_or_blue = ~index.isin(['na', b'blue'])
+            expected = np.arange(5000)[(values == 1) | (values == 2)]
+            self.assertListEqual(expected.tolist(),
+                                 s.apply_filter(not_na_or_blue, ages).tolist())
+            dest = s.create_numeric(ds, 'filtered', 'int32')
+            s.apply_filter(not_na_or_blue, ages, dest, stream=True)
+            self.assertListEqual(expected.tolist(), dest.data[:].tolist())
+            with self.assertRaises(ValueError):
+                index.eq('purple')
+
+            # an index that no longer matches the field is rebuilt
+            cat.data.write(values)
+            self.assertIsNone(s.get_bitmap_index(cat, build=False))
+            index = s.get_bitmap_index(cat)
+            self.assertEqual(10000, len(index.eq('na')))
@@ -53,6 +53,16 @@ class TestIndexedStringFields(unittest.TestCase):
             self.assertEqual('ccc', f2.data[1])
 
 
+    def test_indexed_string_slices(self):
+        bio = BytesIO()
+        with session.Session() as s:
+            src = s.open_dataset(bio, "w", "src")
+            strings = ['a', 'bb', '', 'dddd', 'eeeee']
+            f = s.create_indexed_string(src, "a")
+            f.data.write(strings)
+            self.assertListEqual(strings[1:4], f.data[1:4])
+            self.assertListEqual(strings[3:], s.get(src['a']).data[3:])
+
     def test_update_legacy_indexed_string_that_has_uint_values(self):
         bio = BytesIO()
         with h5py.File(bio, 'r+') as hf:
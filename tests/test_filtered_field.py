@@ -10,8 +10,11 @@
 # limitations under the License.
 
 import unittest
+from io import BytesIO
 
-from exetera.core import filtered_field
+import numpy as np
+
+from exetera.core import filtered_field, session
 
 
 class TestFilteredIndex(unittest.TestCase):
@@ -37,3 +40,43 @@ class TestFilteredIndex(unittest.TestCase):
         expected = [8, 6, 5, 2, 1, 0]
         for i in range(len(ff)):
             self.assertEqual(expected[i], ff[i])
+
+
+class TestFieldView(unittest.TestCase):
+
+    def test_chained_views(self):
+        bio = BytesIO()
+        with session.Session(4) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            vals = s.create_numeric(ds, 'vals', 'int32')
+            vals.data.write(np.arange(20, dtype=np.int32))
+            strs = s.create_indexed_string(ds, 'strs')
+            strs.data.write([str(i) * (i % 3) for i in range(20)])
+
+            for field in (vals, strs):
+                expected = np.asarray(field.data[:], dtype=object)
+                view = s.create_view(field, filter=np.arange(20) % 2 == 0)
+                expected = expected[np.arange(20) % 2 == 0]
+                view = view.filter(np.arange(10) < 8)
+                expected = expected[np.arange(10) < 8]
+                filtered = field.create_like(ds, field.name.split('/')[-1] + '_filtered')
+                self.assertListEqual(expected.tolist(), list(view.realise(filtered).data[:]))
+                view = view.apply_index(np.asarray([7, 0, 3, 3, 5]))
+                expected = expected[[7, 0, 3, 3, 5]]
+                view = view.filter(np.asarray([True, False, True, True, True]))
+                expected = expected[[True, False, True, True, True]]
+
+                self.assertEqual(len(expected), len(view))
+                self.assertListEqual(expected.tolist(), list(view.data[:]))
+                self.assertEqual(expected[1], view.data[1])
+                dest = field.create_like(ds, field.name.split('/')[-1] + '_view')
+                view.realise(dest)
+                self.assertListEqual(expected.tolist(), list(dest.data[:]))
+
+    def test_filtered_view_reads_through_mask(self):
+        field = np.arange(10) * 10
+        view = filtered_field.FieldView(field, filter=field > 20).filter([True, False] * 3 + [True])
+        self.assertListEqual([30, 50, 70, 90], view.realise().tolist())
+        self.assertListEqual([30, 50, 70, 90], view.data[:].tolist())
+        with self.assertRaises(ValueError):
+            view.filter([True, False])
@@ -470,3 +470,144 @@ class TestAggregation(unittest.TestCase):
 
         arr = np.asarray([1, 1, 1, 1, 1])
         self.assertTrue(ops.is_ordered(arr))
+
+
+class TestGetIndex(unittest.TestCase):
+
+    def test_hash_table(self):
+        table = ops.HashTable('S2')
+        table.insert(np.asarray([b'ab', b'cd', b'ab'], dtype='S2'), np.asarray([0, 1, 2]))
+        self.assertEqual(2, len(table))
+        self.assertListEqual([b'ab', b'cd'], table.keys.tolist())
+        self.assertListEqual([2, 1], table.values.tolist())
+        entries = table.lookup(np.asarray([b'cd', b'ef', b'ab'], dtype='S2'))
+        self.assertListEqual([1, -1, 0], entries.tolist())
+        entries = table.get_or_insert(np.asarray([b'ef', b'cd', b'ef'] * 10, dtype='S2'))
+        self.assertListEqual([2, 1, 2] * 10, entries.tolist())
+        self.assertListEqual([2, 1, 2], table.values.tolist())
+
+    def test_get_index(self):
+        p_id = np.array([100, 200, 300, 400, 500, 600, 800, 900], dtype=np.int32)
+        a_pid = np.array([100, 100, 100, 200, 200, 400, 400, 400, 400, 600,
+                          600, 600, 700, 700, 900, 900, 900, 1000], dtype=np.int64)
+        ivld = ops.INVALID_INDEX
+        self.assertListEqual(
+            [0, 0, 0, 1, 1, 3, 3, 3, 3, 5, 5, 5, ivld, ivld, 7, 7, 7, ivld+2],
+            ops.get_index(p_id, a_pid).tolist())
+        self.assertListEqual([2, 4, ivld, 8, ivld+1, 11, ivld+2, 16],
+                             ops.get_index(a_pid, p_id).tolist())
+
+    def test_get_index_repeated_missing_keys(self):
+        # the invalid counter advances on every missing key, as the original dict-based
+        # implementation did, while repeats keep the index they were first given
+        ivld = ops.INVALID_INDEX
+        target = np.array([b'a', b'b'], dtype='S1')
+        foreign_key = np.array([b'c', b'c', b'd', b'c'], dtype='S1')
+        self.assertListEqual([ivld, ivld, ivld+2, ivld],
+                             ops.get_index(target, foreign_key).tolist())
+
+    def test_get_index_streamed(self):
+        s = session.Session()
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            p_id = np.array([b'a', b'c', b'd', b'e'], dtype='S1')
+            a_pid = np.array([b'a', b'a', b'a', b'b', b'b', b'b', b'c', b'c', b'e', b'f'],
+                             dtype='S1')
+            f_p_id = s.create_fixed_string(hf, 'p_id', 1)
+            f_p_id.data.write(p_id)
+            f_a_pid = s.create_fixed_string(hf, 'a_pid', 1)
+            f_a_pid.data.write(a_pid)
+            f_index = s.create_numeric(hf, 'a_to_p', 'int64')
+            ops.get_index_streamed(f_p_id, f_a_pid, f_index, chunksize=4)
+            ivld = ops.INVALID_INDEX
+            self.assertListEqual([0, 0, 0, ivld, ivld, ivld, 1, 1, 3, ivld+3],
+                                 f_index.data[:].tolist())
+            self.assertListEqual(ops.get_index(p_id, a_pid).tolist(), f_index.data[:].tolist())
+
+
+class TestHashJoin(unittest.TestCase):
+
+    def _pandas_join(self, l_keys, r_keys, how):
+        import pandas as pd
+        l_df = pd.DataFrame({'l_k': l_keys, 'l_index': np.arange(len(l_keys))})
+        r_df = pd.DataFrame({'r_k': r_keys, 'r_index': np.arange(len(r_keys))})
+        df = pd.merge(left=l_df, right=r_df, left_on='l_k', right_on='r_k', how=how)
+        r_filt = np.logical_not(df['r_index'].isnull()).to_numpy()
+        return (df['l_index'].to_numpy().tolist(),
+                df['r_index'].fillna(-1).to_numpy(dtype=np.int64).tolist(),
+                r_filt.tolist())
+
+    def test_hash_join_matches_pandas(self):
+        np.random.seed(12345)
+        l_keys = np.random.randint(0, 50, 200)
+        r_keys = np.random.randint(20, 80, 150).astype(np.int32)
+        for how in ('left', 'inner'):
+            expected = self._pandas_join(l_keys, r_keys, how)
+            for build in ('left', 'right'):
+                for budget in (None, 256):
+                    l_map, r_map, l_filt, r_filt = \
+                        ops.hash_join(l_keys, r_keys, how, build, budget)
+                    self.assertListEqual(expected[0], l_map.tolist())
+                    self.assertListEqual(expected[1],
+                                         np.where(r_filt, r_map, -1).tolist())
+                    self.assertListEqual(expected[2], r_filt.tolist())
+
+    def test_hash_join_fixed_string(self):
+        l_keys = np.asarray([b'a', b'bb', b'c', b'bb'], dtype='S2')
+        r_keys = np.asarray([b'bb', b'a', b'd', b'a'], dtype='S3')
+        l_map, r_map, l_filt, r_filt = ops.hash_join(l_keys, r_keys, 'left')
+        self.assertListEqual([0, 0, 1, 2, 3], l_map.tolist())
+        self.assertListEqual([True, True, True, False, True], r_filt.tolist())
+        self.assertListEqual([1, 3, 0, 0], r_map[r_filt].tolist())
+
+    def test_hash_join_mixed_signed_unsigned(self):
+        # keys above 2**53 must not collide and negative keys match no unsigned key
+        l_keys = np.array([2**53 + 1, 7, -1, 2**40], dtype=np.int64)
+        r_keys = np.array([2**53, 2**53 + 1, 2**64 - 1, 2**40], dtype=np.uint64)
+        for budget in (None, 32):
+            l_map, r_map, l_filt, r_filt = ops.hash_join(l_keys, r_keys, 'left',
+                                                         memory_budget=budget)
+            self.assertListEqual([0, 1, 2, 3], l_map.tolist())
+            self.assertListEqual([True, False, False, True], r_filt.tolist())
+            self.assertListEqual([1, 3], r_map[r_filt].tolist())
+
+        dtype = ops.common_key_dtype(l_keys.dtype, r_keys.dtype)
+        for keys in (np.sort(l_keys), l_keys):
+            key_set = ops.KeySet(keys, dtype)
+            self.assertListEqual([False, True, False, True],
+                                 key_set.contains(r_keys).tolist())
+
+
+class TestApplySpansParallel(unittest.TestCase):
+
+    def test_span_blocks(self):
+        spans = np.asarray([0, 1, 2, 3, 10, 11, 12, 20], dtype=np.int64)
+        blocks = ops.span_blocks(spans, 2)
+        self.assertEqual(0, blocks[0])
+        self.assertEqual(len(spans) - 1, blocks[-1])
+        self.assertTrue(np.all(np.diff(blocks) > 0))
+
+    def test_apply_spans_parallel(self):
+        np.random.seed(12345)
+        spans = np.cumsum(np.concatenate(([0], np.random.randint(1, 20, 1000)))).astype(np.int64)
+        src = np.random.randint(0, 1000, spans[-1]).astype(np.int32)
+        for kernel in (ops.apply_spans_count, ops.apply_spans_index_of_last):
+            expected = np.zeros(len(spans) - 1, dtype=np.int64)
+            kernel(spans, expected)
+            actual = np.zeros(len(spans) - 1, dtype=np.int64)
+            ops.apply_spans_parallel(kernel, spans, actual, threads=4, min_length=0)
+            self.assertListEqual(expected.tolist(), actual.tolist())
+        for kernel in (ops.apply_spans_min, ops.apply_spans_max, ops.apply_spans_first,
+                       ops.apply_spans_last, ops.apply_spans_index_of_max):
+            expected = np.zeros(len(spans) - 1, dtype=np.int32)
+            kernel(spans, src, expected)
+            actual = np.zeros(len(spans) - 1, dtype=np.int32)
+            ops.apply_spans_parallel(kernel, spans, src, actual, threads=4, min_length=0)
+            self.assertListEqual(expected.tolist(), actual.tolist())
+        expected = (np.zeros(len(spans) - 1, dtype=np.int64), np.zeros(len(spans) - 1, dtype=bool))
+        ops.apply_spans_index_of_min_filter(spans, src, *expected)
+        actual = (np.zeros(len(spans) - 1, dtype=np.int64), np.zeros(len(spans) - 1, dtype=bool))
+        ops.apply_spans_parallel(ops.apply_spans_index_of_min_filter, spans, src, *actual,
+                                 threads=4, min_length=0)
+        self.assertListEqual(expected[0].tolist(), actual[0].tolist())
+        self.assertListEqual(expected[1].tolist(), actual[1].tolist())
@@ -14,6 +14,10 @@ from exetera.core import validation as val
 from exetera.core import utils
 
 
+def _double_plus_one(foo, footwo):
+    footwo[:] = foo * 2 + 1
+
+
 class TestPersistence(unittest.TestCase):
 
 
@@ -921,6 +925,34 @@ class TestPersistanceMiscellaneous(unittest.TestCase):
             for i, j in zip(foo[:], footwo[:]):
                 self.assertTrue(j == i*2)
 
+    def test_predicate_parallel(self):
+        datastore = persistence.DataStore(10)
+        values = np.random.randint(low=0, high=1000, size=95, dtype=np.uint32)
+
+        def functor(foo, footwo):
+            footwo[:] = foo * 2 + 1
+
+        ts = str(datetime.now(timezone.utc))
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            foo = rw.NumericWriter(datastore, hf, 'foo', 'uint32', ts)
+            foo.write_part(values)
+            foo.flush()
+            foo = rw.NumericReader(datastore, hf['foo'])
+
+            for name, kwargs in (('serial', {}),
+                                 ('threads', {'workers': 3}),
+                                 ('jit', {'workers': 3, 'jit': True}),
+                                 ('processes', {'workers': 2, 'executor': 'process'})):
+                predicate = _double_plus_one if name == 'processes' else functor
+                footwo = rw.NumericWriter(datastore, hf, name, 'uint32', ts)
+                datastore.process({'foo': foo}, {'footwo': footwo}, predicate, **kwargs)
+                self.assertListEqual((values * 2 + 1).tolist(), hf[name]['values'][:].tolist())
+
+            with self.assertRaises(ValueError):
+                footwo = rw.NumericWriter(datastore, hf, 'bad', 'uint32', ts)
+                datastore.process({'foo': foo}, {'footwo': footwo}, functor, executor='fibres')
+
     def test_index_spans(self):
         spans = np.asarray([0, 2, 2, 4, 5, 8, 8, 10], dtype='int32')
         results = np.zeros(10, dtype='int32')
@@ -0,0 +1,120 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from exetera.core import session
+from exetera.core.query import col
+
+
+class TestLazyFrame(unittest.TestCase):
+
+    def _tables(self, s, ds):
+        patients = ds.create_group('patients')
+        s.create_numeric(patients, 'id', 'int32').data.write(np.arange(10, dtype=np.int32))
+        s.create_numeric(patients, 'age', 'int32').data.write(
+            np.asarray([20, 35, 60, 45, 80, 15, 50, 70, 30, 65], dtype=np.int32))
+        s.create_fixed_string(patients, 'country', 2).data.write(
+            [b'GB', b'US', b'GB', b'SE', b'US', b'GB', b'SE', b'GB', b'US', b'GB'])
+        assessments = ds.create_group('assessments')
+        pids = np.asarray([3, 0, 9, 3, 4, 7, 2, 2, 8, 11, 5, 6, 0, 9], dtype=np.int32)
+        s.create_numeric(assessments, 'patient_id', 'int32').data.write(pids)
+        s.create_numeric(assessments, 'temperature', 'float32').data.write(
+            np.linspace(36.0, 39.9, len(pids)).astype(np.float32))
+        s.create_indexed_string(assessments, 'note').data.write(
+            ['n{}'.format(i) * (i % 3) for i in range(len(pids))])
+        return patients, assessments
+
+    def test_filter_with_column_select(self):
+        bio = BytesIO()
+        with session.Session(4) as s:
+            patients, assessments = self._tables(s, s.open_dataset(bio, 'w', 'ds'))
+            df = pd.DataFrame({'age': patients['age']['values'][:],
+                               'id': patients['id']['values'][:]})
+            lf = s.lazy(patients)
+            for numeric in (True, False):
+                # a map expression can't be compiled, so the stage runs through numpy
+                older = col('age') > 40 if numeric else col('age').map(lambda a: a > 40)
+                result_lf = lf.filter(older).with_column('decade', col('age') // 10)\
+                    .filter(col('decade') != 6).with_column('score', col('age') * 0.5 + col('id'))\
+                    .select('id', 'decade', 'score')
+                self.assertIn('compiled' if numeric else 'numpy', result_lf.explain())
+                result = result_lf.collect()
+
+                expected = df[df.age > 40].copy()
+                expected['decade'] = expected.age // 10
+                expected = expected[expected.decade != 6]
+                self.assertListEqual(expected.id.tolist(), result['id'].tolist())
+                self.assertListEqual(expected.decade.tolist(), result['decade'].tolist())
+                self.assertListEqual((expected.age * 0.5 + expected.id).tolist(),
+                                     result['score'].tolist())
+
+    def test_join_aggregate(self):
+        bio = BytesIO()
+        with session.Session(4) as s:
+            ds = s.open_dataset(bio, 'w', 'ds')
+            patients, assessments = self._tables(s, ds)
+            lf = s.lazy(assessments).join(s.lazy(patients), 'patient_id', 'id', how='inner')\
+                .filter(col('age') >= 30).filter(col('temperature') > 36.5)\
+                .aggregate('country', {'n': ('temperature', 'count'),
+                                       'max_t': ('temperature', 'max'),
+                                       'mean_age': ('age', 'mean')})
+            plan = lf.explain()
+            # the filters are pushed below the join and the unused columns are pruned
+            self.assertLess(plan.index('Join'), plan.index('age >= 30'))
+            self.assertNotIn('note', plan)
+
+            a = pd.DataFrame({'patient_id': assessments['patient_id']['values'][:],
+                              'temperature': assessments['temperature']['values'][:]})
+            p = pd.DataFrame({'id': patients['id']['values'][:],
+                              'age': patients['age']['values'][:],
+                              'country': patients['country']['values'][:]})
+            m = a.merge(p, left_on='patient_id', right_on='id', how='inner')
+            m = m[(m.age >= 30) & (m.temperature > 36.5)]
+            expected = m.groupby('country', sort=False).agg(
+                n=('temperature', 'count'), max_t=('temperature', 'max'),
+                mean_age=('age', 'mean'))
+
+            results = lf.collect(dest=ds.create_group('results'))
+            self.assertListEqual(expected.index.tolist(), results['country'].data[:].tolist())
+            self.assertListEqual(expected.n.tolist(), results['n'].data[:].tolist())
+            self.assertListEqual(expected.max_t.tolist(), results['max_t'].data[:].tolist())
+            self.assertListEqual(expected.mean_age.tolist(), results['mean_age'].data[:].tolist())
+
+    def test_left_join_indexed_strings(self):
+        bio = BytesIO()
+        with session.Session(5) as s:
+            patients, assessments = self._tables(s, s.open_dataset(bio, 'w', 'ds'))
+            result = s.lazy(patients).select('id')\
+                .join(s.lazy(assessments).select('patient_id', 'note'), 'id', 'patient_id')\
+                .collect()
+            ids = patients['id']['values'][:]
+            pids = assessments['patient_id']['values'][:]
+            notes = s.get(assessments['note']).data[:]
+            expected = [(int(i), notes[j]) for i in ids for j in np.flatnonzero(pids == i)] + \
+                [(int(i), '') for i in ids if i not in pids]
+            actual = list(zip(result['id'].tolist(), result['note'].tolist()))
+            self.assertListEqual(sorted(expected), sorted(actual))
+            self.assertListEqual(sorted(result['id'].tolist()), result['id'].tolist())
+
+    def test_invalid_columns(self):
+        with session.Session() as s:
+            lf = s.lazy({'a': np.arange(5), 'b': np.arange(5)})
+            with self.assertRaises(ValueError):
+                lf.filter(col('c') > 1)
+            with self.assertRaises(ValueError):
+                lf.select('a', 'c')
+            with self.assertRaises(ValueError):
+                s.lazy({'a': np.arange(5), 'b': np.arange(4)})
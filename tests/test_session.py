@@ -1,4 +1,5 @@
 import unittest
+from datetime import timedelta
 
 import numpy as np
 from io import BytesIO
@@ -7,6 +8,7 @@ import h5py
 
 from exetera.core import session
 from exetera.core import fields
+from exetera.core import operations as ops
 from exetera.core import persistence as per
 
 
@@ -166,6 +168,25 @@ class TestSessionMerge(unittest.TestCase):
                              res[0].tolist())
 
 
+    def test_merge_indexed_string_keys(self):
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pk = s.create_indexed_string(ds, 'id')
+            pk.data.write(['a', 'bb'])
+            fk = s.create_indexed_string(ds, 'parent_id')
+            fk.data.write(['a', 'bb', 'cxx', 'd', 'a'])
+            p_vals = np.asarray([10, 20])
+            c_vals = np.asarray([1, 2, 3, 4, 5])
+            self.assertListEqual([10, 20, 0, 0, 10],
+                                 s.merge_left(fk, pk, right_fields=(p_vals,))[0].tolist())
+            self.assertListEqual([10, 20, 0, 0, 10],
+                                 s.merge_right(pk, fk, left_fields=(p_vals,))[0].tolist())
+            left, right = s.merge_inner(pk, fk, left_fields=(p_vals,), right_fields=(c_vals,))
+            self.assertListEqual([10, 10, 20], left[0].tolist())
+            self.assertListEqual([1, 5, 2], right[0].tolist())
+
+
     def test_ordered_merge_left(self):
         l_id = np.asarray([b'a', b'b', b'd', b'f', b'g', b'h'])
         l_vals = np.asarray([100, 200, 400, 600, 700, 800])
@@ -299,6 +320,237 @@ class TestSessionMerge(unittest.TestCase):
         self.assertTrue(np.array_equal(actual[1][1], r_vals_2_exp))
 
 
+class TestSessionOrderedMergeManyToMany(unittest.TestCase):
+
+    l_id = np.asarray([1, 1, 2, 4, 4, 4, 5, 7], dtype=np.int32)
+    l_vals = np.asarray([10, 11, 20, 40, 41, 42, 50, 70], dtype=np.int32)
+    r_id = np.asarray([1, 1, 1, 3, 4, 4, 7, 8], dtype=np.int32)
+    r_vals = np.asarray([100, 101, 102, 300, 400, 401, 700, 800], dtype=np.int32)
+
+    def test_ordered_merge_left_many_to_many(self):
+        s = session.Session()
+        actual = s.ordered_merge_left(self.l_id, self.r_id, right_field_sources=(self.r_vals,))
+        self.assertListEqual([100, 101, 102, 100, 101, 102, 0,
+                              400, 401, 400, 401, 400, 401, 0, 700],
+                             actual[0].tolist())
+
+    def test_ordered_merge_left_many_to_many_streamed(self):
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            s = session.Session(chunksize=3)
+            l_id = s.create_numeric(hf, 'l_id', 'int32'); l_id.data.write(self.l_id)
+            r_id = s.create_numeric(hf, 'r_id', 'int32'); r_id.data.write(self.r_id)
+            r_vals = s.create_numeric(hf, 'r_vals', 'int32'); r_vals.data.write(self.r_vals)
+            l_to_m = s.create_numeric(hf, 'l_to_m', 'int64')
+            r_to_m = s.create_numeric(hf, 'r_to_m', 'int64')
+            m_r_vals = s.create_numeric(hf, 'm_r_vals', 'int32')
+            s.ordered_merge_left(l_id, r_id, right_field_sources=(r_vals,),
+                                 left_field_sinks=(m_r_vals,), left_to_right_map=r_to_m,
+                                 left_to_merged_map=l_to_m)
+            self.assertListEqual([0, 0, 0, 1, 1, 1, 2, 3, 3, 4, 4, 5, 5, 6, 7],
+                                 l_to_m.data[:].tolist())
+            self.assertListEqual([100, 101, 102, 100, 101, 102, 0,
+                                  400, 401, 400, 401, 400, 401, 0, 700],
+                                 m_r_vals.data[:].tolist())
+
+    def test_ordered_merge_inner_many_to_many_streamed(self):
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            s = session.Session(chunksize=2)
+            l_id = s.create_numeric(hf, 'l_id', 'int32'); l_id.data.write(self.l_id)
+            l_vals = s.create_numeric(hf, 'l_vals', 'int32'); l_vals.data.write(self.l_vals)
+            r_id = s.create_numeric(hf, 'r_id', 'int32'); r_id.data.write(self.r_id)
+            r_vals = s.create_numeric(hf, 'r_vals', 'int32'); r_vals.data.write(self.r_vals)
+            i_l_vals = s.create_numeric(hf, 'i_l_vals', 'int32')
+            i_r_vals = s.create_numeric(hf, 'i_r_vals', 'int32')
+            s.ordered_merge_inner(l_id, r_id,
+                                  left_field_sources=(l_vals,), left_field_sinks=(i_l_vals,),
+                                  right_field_sources=(r_vals,), right_field_sinks=(i_r_vals,))
+
+            expected = s.ordered_merge_inner(self.l_id, self.r_id,
+                                             left_field_sources=(self.l_vals,),
+                                             right_field_sources=(self.r_vals,))
+            self.assertListEqual([10, 10, 10, 11, 11, 11, 40, 40, 41, 41, 42, 42, 70],
+                                 i_l_vals.data[:].tolist())
+            self.assertListEqual(expected[0][0].tolist(), i_l_vals.data[:].tolist())
+            self.assertListEqual(expected[1][0].tolist(), i_r_vals.data[:].tolist())
+
+
+class TestSessionOrderedMergeOuter(unittest.TestCase):
+
+    def test_ordered_merge_outer_both_unique(self):
+        l_id = np.asarray([1, 2, 4, 5], dtype=np.int32)
+        l_vals = np.asarray([10, 20, 40, 50], dtype=np.int32)
+        r_id = np.asarray([2, 3, 5, 6], dtype=np.int32)
+        r_vals = np.asarray([200, 300, 500, 600], dtype=np.int32)
+        inv = 1 << 62
+
+        s = session.Session()
+        l_map, r_map, keys, l_res, r_res = \
+            s.ordered_merge_outer(l_id, r_id, left_field_sources=(l_vals,),
+                                  right_field_sources=(r_vals,),
+                                  left_unique=True, right_unique=True)
+        self.assertListEqual([0, 1, inv, 2, 3, inv], l_map.tolist())
+        self.assertListEqual([inv, 0, 1, inv, 2, 3], r_map.tolist())
+        self.assertListEqual([1, 2, 3, 4, 5, 6], keys.tolist())
+        self.assertListEqual([10, 20, 0, 40, 50, 0], l_res[0].tolist())
+        self.assertListEqual([0, 200, 300, 0, 500, 600], r_res[0].tolist())
+
+    def test_ordered_merge_outer_streamed(self):
+        l_id = np.asarray([1, 1, 2, 4, 4, 7], dtype=np.int32)
+        l_vals = np.asarray([10, 11, 20, 40, 41, 70], dtype=np.int32)
+        r_id = np.asarray([0, 1, 1, 3, 4, 8, 8], dtype=np.int32)
+        r_vals = np.asarray([0, 100, 101, 300, 400, 800, 801], dtype=np.int32)
+
+        s = session.Session()
+        exp_l_map, exp_r_map, exp_keys, exp_l, exp_r = \
+            s.ordered_merge_outer(l_id, r_id, left_field_sources=(l_vals,),
+                                  right_field_sources=(r_vals,))
+        self.assertListEqual([0, 1, 1, 1, 1, 2, 3, 4, 4, 7, 8, 8], exp_keys.tolist())
+
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            s = session.Session(chunksize=2)
+            l_id_f = s.create_numeric(hf, 'l_id', 'int32'); l_id_f.data.write(l_id)
+            l_vals_f = s.create_numeric(hf, 'l_vals', 'int32'); l_vals_f.data.write(l_vals)
+            r_id_f = s.create_numeric(hf, 'r_id', 'int32'); r_id_f.data.write(r_id)
+            r_vals_f = s.create_numeric(hf, 'r_vals', 'int32'); r_vals_f.data.write(r_vals)
+            l_map = s.create_numeric(hf, 'l_map', 'int64')
+            r_map = s.create_numeric(hf, 'r_map', 'int64')
+            keys = s.create_numeric(hf, 'keys', 'int32')
+            o_l_vals = s.create_numeric(hf, 'o_l_vals', 'int32')
+            o_r_vals = s.create_numeric(hf, 'o_r_vals', 'int32')
+            s.ordered_merge_outer(l_id_f, r_id_f,
+                                  left_field_sources=(l_vals_f,), left_field_sinks=(o_l_vals,),
+                                  right_field_sources=(r_vals_f,), right_field_sinks=(o_r_vals,),
+                                  left_to_outer_map=l_map, right_to_outer_map=r_map,
+                                  merged_key=keys)
+            self.assertListEqual(exp_l_map.tolist(), l_map.data[:].tolist())
+            self.assertListEqual(exp_r_map.tolist(), r_map.data[:].tolist())
+            self.assertListEqual(exp_keys.tolist(), keys.data[:].tolist())
+            self.assertListEqual(exp_l[0].tolist(), o_l_vals.data[:].tolist())
+            self.assertListEqual(exp_r[0].tolist(), o_r_vals.data[:].tolist())
+
+
+class TestSessionJoinMap(unittest.TestCase):
+
+    def test_join_map_merge_left(self):
+        l_id = np.asarray([b'a', b'b', b'd', b'f', b'g', b'h'])
+        r_id = np.asarray([b'a', b'c', b'c', b'd', b'd', b'e', b'e', b'f', b'f', b'h', b'h'])
+        r_vals = np.asarray([1000, 2000, 2001, 3000, 3001, 4000, 4001, 5000, 5001, 6000, 6001])
+
+        s = session.Session()
+        expected = s.merge_left(l_id, r_id, right_fields=(r_vals,))
+        join_map = s.create_join_map(l_id, r_id, how='left')
+        actual = s.merge_left(l_id, r_id, right_fields=(r_vals,), join_map=join_map)
+        self.assertListEqual(expected[0].tolist(), actual[0].tolist())
+
+        with self.assertRaises(ValueError):
+            s.merge_inner(l_id, r_id, left_fields=(), right_fields=(r_vals,),
+                          join_map=join_map)
+        changed = r_id.copy()
+        changed[0] = b'b'
+        with self.assertRaises(ValueError):
+            s.merge_left(l_id, changed, right_fields=(r_vals,), join_map=join_map)
+
+    def test_join_map_persisted(self):
+        l_id = np.asarray([1, 1, 2, 4, 4, 7], dtype=np.int32)
+        l_vals = np.asarray([10, 11, 20, 40, 41, 70], dtype=np.int32)
+        r_id = np.asarray([0, 1, 1, 3, 4, 8, 8], dtype=np.int32)
+        r_vals = np.asarray([0, 100, 101, 300, 400, 800, 801], dtype=np.int32)
+
+        bio = BytesIO()
+        with h5py.File(bio, 'w') as hf:
+            s = session.Session(chunksize=2)
+            l_id_f = s.create_numeric(hf, 'l_id', 'int32'); l_id_f.data.write(l_id)
+            l_vals_f = s.create_numeric(hf, 'l_vals', 'int32'); l_vals_f.data.write(l_vals)
+            r_id_f = s.create_numeric(hf, 'r_id', 'int32'); r_id_f.data.write(r_id)
+            r_vals_f = s.create_numeric(hf, 'r_vals', 'int32'); r_vals_f.data.write(r_vals)
+            s.create_join_map(l_id_f, r_id_f, how='outer', ordered=True,
+                              destination=hf.create_group('l_r_map'))
+
+            join_map = s.load_join_map(hf['l_r_map'])
+            o_l_vals = s.create_numeric(hf, 'o_l_vals', 'int32')
+            o_r_vals = s.create_numeric(hf, 'o_r_vals', 'int32')
+            keys = s.create_numeric(hf, 'keys', 'int32')
+            s.ordered_merge_outer(l_id_f, r_id_f,
+                                  left_field_sources=(l_vals_f,), left_field_sinks=(o_l_vals,),
+                                  right_field_sources=(r_vals_f,), right_field_sinks=(o_r_vals,),
+                                  merged_key=keys, join_map=join_map)
+
+            _, _, exp_keys, exp_l, exp_r = \
+                s.ordered_merge_outer(l_id, r_id, left_field_sources=(l_vals,),
+                                      right_field_sources=(r_vals,))
+            self.assertListEqual(exp_keys.tolist(), keys.data[:].tolist())
+            self.assertListEqual(exp_l[0].tolist(), o_l_vals.data[:].tolist())
+            self.assertListEqual(exp_r[0].tolist(), o_r_vals.data[:].tolist())
+
+            r_id_f.data[0] = -1
+            with self.assertRaises(ValueError):
+                s.ordered_merge_outer(l_id_f, r_id_f, left_field_sources=(l_vals_f,),
+                                      join_map=join_map)
+
+    def test_join_map_indexed_string_keys(self):
+        from unittest import mock
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pk = s.create_indexed_string(ds, 'id')
+            pk.data.write(['a', 'bb'])
+            fk = s.create_indexed_string(ds, 'parent_id')
+            fk.data.write(['a', 'bb', 'cxx', 'd', 'a'])
+            p_vals = np.asarray([10, 20])
+            join_map = s.create_join_map(fk, pk, how='left',
+                                         destination=ds.create_group('fk_pk_map'))
+            # field keys are validated against their versions without being read
+            with mock.patch('exetera.core.join_map.key_checksum', side_effect=AssertionError):
+                merged = s.merge_left(fk, pk, right_fields=(p_vals,), join_map=join_map)
+            self.assertListEqual([10, 20, 0, 0, 10], merged[0].tolist())
+
+            pk_ = s.get(pk).writeable()
+            pk_.data.clear()
+            pk_.data.write(['bb', 'a'])
+            with self.assertRaises(ValueError):
+                s.merge_left(fk, pk, right_fields=(p_vals,),
+                             join_map=s.load_join_map(ds['fk_pk_map']))
+
+
+class TestSessionSharedIndex(unittest.TestCase):
+
+    def test_get_shared_index(self):
+        a = np.asarray(['a', 'a', 'c', 'c', 'd', 'f', 'f', 'g', 'i'])
+        b = np.asarray(['a', 'b', 'b', 'c', 'f', 'g', 'h', 'h'])
+        c = np.asarray(['b', 'c', 'e', 'e', 'e', 'f', 'f', 'i', 'j'])
+
+        s = session.Session()
+        x, y, z = s.get_shared_index((a, b, c))
+        self.assertListEqual([0, 0, 2, 2, 3, 5, 5, 6, 8], x.tolist())
+        self.assertListEqual([0, 1, 1, 2, 5, 6, 7, 7], y.tolist())
+        self.assertListEqual([1, 2, 4, 4, 4, 5, 5, 8, 9], z.tolist())
+
+    def test_get_shared_index_streamed(self):
+        keys = (np.asarray([1, 1, 3, 3, 3, 3, 4, 6, 6, 9]),
+                np.asarray([1, 2, 2, 2, 3, 6, 7, 7]),
+                np.asarray([3, 3, 3, 3, 3, 3, 3, 8, 9, 9, 9]))
+        union = np.unique(np.concatenate(keys))
+        expected = [np.searchsorted(union, k).tolist() for k in keys]
+
+        for unsorted in (False, True):
+            s = session.Session(chunksize=3)
+            bio = BytesIO()
+            with h5py.File(bio, 'w') as hf:
+                sources = list()
+                for i, k in enumerate(keys):
+                    f = s.create_numeric(hf, 'k{}'.format(i), 'int32')
+                    f.data.write(k[::-1] if unsorted else k)
+                    sources.append(f)
+                dests = tuple(s.create_numeric(hf, 'i{}'.format(i), 'int64')
+                              for i in range(len(keys)))
+                results = s.get_shared_index(tuple(sources), destinations=dests)
+                for r, e in zip(results, expected):
+                    self.assertListEqual(e[::-1] if unsorted else e, r.data[:].tolist())
+
+
 class TestSessionJoin(unittest.TestCase):
 
     def test_session_join(self):
@@ -415,6 +667,330 @@ class TestSessionFilter(unittest.TestCase):
         result = s.apply_filter(filt, vx)
         self.assertListEqual([1, 2, 5, 7], result.tolist())
 
+    def test_apply_filter_streamed(self):
+        bio = BytesIO()
+        with session.Session(3) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            vals = s.create_numeric(ds, 'vals', 'int32')
+            vals.data.write(np.arange(10, dtype=np.int32))
+            strs = s.create_indexed_string(ds, 'strs')
+            strs.data.write(['a', 'bb', '', 'ccc', 'd', 'ee', 'fff', '', 'g', 'hh'])
+            filt = s.create_numeric(ds, 'filt', 'bool')
+            filt.data.write(np.asarray([0, 1, 1, 0, 0, 0, 1, 0, 1, 1], dtype=bool))
+
+            result = s.apply_filter(filt, vals, s.create_numeric(ds, 'r_vals', 'int32'),
+                                    stream=True)
+            self.assertListEqual([1, 2, 6, 8, 9], result.data[:].tolist())
+            result = s.apply_filter(filt, strs, s.create_indexed_string(ds, 'r_strs'),
+                                    stream=True)
+            self.assertListEqual(['bb', '', 'fff', 'g', 'hh'], result.data[:])
+            self.assertListEqual([0, 2, 2, 5, 6, 8], result.indices[:].tolist())
+
+    def test_apply_index_streamed(self):
+        bio = BytesIO()
+        with session.Session(4) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            vals = s.create_numeric(ds, 'vals', 'int32')
+            vals.data.write(np.arange(10, 20, dtype=np.int32))
+            strs = s.create_indexed_string(ds, 'strs')
+            strs.data.write(['a', 'bb', '', 'ccc', 'd', 'ee', 'fff', '', 'g', 'hh'])
+            for i, index in enumerate((np.asarray([0, 1, 1, 4, 7, 8, 9, 9]),
+                                       np.asarray([9, 2, 5, 0, 0, 7, 3, 8, 1]))):
+                for budget in (None, 8):
+                    name = '{}_{}'.format(i, budget)
+                    result = s.apply_index(index, vals, s.create_numeric(ds, 'v' + name, 'int32'),
+                                           stream=True, memory_budget=budget)
+                    self.assertListEqual((index + 10).tolist(), result.data[:].tolist())
+                    result = s.apply_index(index, strs, s.create_indexed_string(ds, 's' + name),
+                                           stream=True, memory_budget=budget)
+                    self.assertListEqual([strs.data[:][j] for j in index], result.data[:])
+
+
+class TestSessionLookup(unittest.TestCase):
+
+    def test_lookup(self):
+        bio = BytesIO()
+        with session.Session(100) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            table = ds.create_group('patients')
+            table.attrs['primary_keys'] = ['id']
+            rng = np.random.RandomState(12345678)
+            ids = rng.permutation(1000).astype(np.int32) * 3
+            s.create_numeric(table, 'id', 'int32').data.write(ids)
+            codes = ['c{:04d}'.format(i) for i in ids]
+            s.create_fixed_string(table, 'code', 5).data.write([c.encode() for c in codes])
+            s.create_indexed_string(table, 'name').data.write(['n' * (i % 7) + str(i) for i in ids])
+            s.create_numeric(table, 'age', 'int32').data.write(np.arange(1000, dtype=np.int32))
+
+            rows, results = s.lookup(table, [ids[10], 4, ids[999], 7.5, ids[0]], fields=['age'])
+            self.assertListEqual([10, per.INVALID_INDEX, 999, per.INVALID_INDEX, 0], rows.tolist())
+            self.assertListEqual([10, 999, 0], results['age'])
+            names = s.get(table['name']).data[:]
+            self.assertListEqual([500, per.INVALID_INDEX],
+                                 s.lookup(table, [codes[500], 'c0001'], key='code').tolist())
+            self.assertListEqual([3, 999], s.lookup(table, [names[3], names[999].encode()],
+                                                    key='name').tolist())
+            self.assertIn('key_index', table['name'].keys())
+
+            # clearing a field removes its index, and the index is rebuilt on the next lookup
+            ages = s.get(table['age']).writeable()
+            s.create_key_index(ages)
+            ages.data.clear()
+            self.assertNotIn('key_index', table['age'].keys())
+            ages.data.write(np.arange(1000, dtype=np.int32)[::-1])
+            self.assertListEqual([999, 0], s.lookup(table, [0, 999], key='age').tolist())
+            with self.assertRaises(ValueError):
+                s.lookup(ds, [1])
+
+
+class TestSessionRangeQuery(unittest.TestCase):
+
+    def test_range_query(self):
+        from datetime import datetime, timezone
+        from exetera.core import indexes
+        bio = BytesIO()
+        with session.Session(timestamp='2020-01-01 00:00:00+00:00') as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            rng = np.random.RandomState(12345678)
+            values = np.round(rng.uniform(15, 45, size=20000), 1).astype(np.float32)
+            bmi = s.create_numeric(ds, 'bmi', 'float32')
+            bmi.data.write(values)
+            self.assertEqual('2020-01-01 00:00:00+00:00', bmi.timestamp)
+
+            for low, high, include_low, include_high in ((20.5, 25.0, True, False),
+                                                         (20.5, 25.0, False, True),
+                                                         (None, 16.0, True, False),
+                                                         (44.9, None, False, False),
+                                                         (30.0, 20.0, True, True)):
+                lower = values >= np.float32(low) if include_low else values > np.float32(low)
+                upper = values <= np.float32(high) if include_high else values < np.float32(high)
+                expected = (lower if low is not None else True) & \
+                    (upper if high is not None else True)
+                rows = s.range_query(bmi, np.float32(low) if low is not None else None,
+                                     np.float32(high) if high is not None else None,
+                                     include_low, include_high)
+                self.assertListEqual(np.flatnonzero(expected).tolist(), rows.tolist())
+            self.assertIsNotNone(indexes.read_sorted_index(ds['bmi']))
+
+            # the index is ignored once the field's version changes
+            ds['bmi'].attrs['version'] = 'rewritten'
+            self.assertIsNone(indexes.read_sorted_index(ds['bmi']))
+            self.assertEqual(20000, s.range_query(bmi, as_mask=True).sum())
+
+            times = np.asarray([datetime(2020, 5, d, tzinfo=timezone.utc).timestamp()
+                                for d in rng.randint(1, 31, size=1000)])
+            updated_at = s.create_timestamp(ds, 'updated_at')
+            updated_at.data.write(times)
+            mask = s.range_query(updated_at, datetime(2020, 5, 11, tzinfo=timezone.utc),
+                                 datetime(2020, 5, 18, tzinfo=timezone.utc), as_mask=True)
+            expected = (times >= datetime(2020, 5, 11, tzinfo=timezone.utc).timestamp()) & \
+                (times < datetime(2020, 5, 18, tzinfo=timezone.utc).timestamp())
+            self.assertListEqual(expected.tolist(), mask.tolist())
+
+            with self.assertRaises(ValueError):
+                s.range_query(s.create_indexed_string(ds, 'names'), 'a', 'b')
+
+
+class TestSessionForeignKeyIndex(unittest.TestCase):
+
+    def test_foreign_key_index_joins(self):
+        from unittest import mock
+        bio = BytesIO()
+        with session.Session(4) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            patients = ds.create_group('patients')
+            assessments = ds.create_group('assessments')
+            pids = [b'p3', b'p1', b'p4', b'p0', b'p2']
+            s.create_fixed_string(patients, 'id', 2).data.write(pids)
+            s.create_numeric(patients, 'age', 'int32').data.write(
+                np.asarray([30, 10, 40, 0, 20], dtype=np.int32))
+            apids = [b'p1', b'p3', b'p9', b'p1', b'p0', b'p3', b'p1']
+            s.create_fixed_string(assessments, 'patient_id', 2).data.write(apids)
+            temps = np.asarray([36.5, 37.0, 38.0, 38.5, 36.0, 39.0, 37.5], dtype=np.float32)
+            s.create_numeric(assessments, 'temp', 'float32').data.write(temps)
+
+            fk, pk = assessments['patient_id'], patients['id']
+            calls = ((s.merge_left, (fk, pk), {'right_fields': (patients['age'],)}),
+                     (s.merge_left, (pk, fk), {'right_fields': (assessments['temp'],)}),
+                     (s.merge_right, (fk, pk), {'left_fields': (assessments['temp'],)}),
+                     (s.merge_right, (pk, fk), {'left_fields': (patients['age'],)}),
+                     (s.merge_inner, (fk, pk), {'left_fields': (assessments['temp'],),
+                                                'right_fields': (patients['age'],)}),
+                     (s.merge_inner, (pk, fk), {'left_fields': (patients['age'],),
+                                                'right_fields': (assessments['temp'],)}))
+            expected = [f(*a, **k) for f, a, k in calls]
+            index = s.create_foreign_key_index(fk, pk)
+            self.assertEqual(1, index.orphan_count())
+            with mock.patch('exetera.core.operations.hash_join', side_effect=AssertionError):
+                for (f, a, k), e in zip(calls, expected):
+                    actual = f(*a, **k)
+                    self.assertEqual(str(e), str(actual))
+
+            max_temps = s.aggregate_by_foreign_key(fk, pk, assessments['temp'], 'max')
+            self.assertTrue(np.array_equal([39.0, 38.5, np.nan, 36.0, np.nan], max_temps,
+                                           equal_nan=True))
+            counts = s.aggregate_by_foreign_key(fk, pk, assessments['temp'], 'count')
+            self.assertListEqual([2, 3, 0, 1, 0], counts.tolist())
+
+            # a changed primary key invalidates the index
+            pk_ = s.get(pk).writeable()
+            pk_.data.clear()
+            pk_.data.write(pids[:4])
+            self.assertIsNone(s._stored_foreign_key_index(fk, pk))
+
+    def test_rewritten_primary_key_invalidates_index(self):
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            p, c = ds.create_group('p'), ds.create_group('c')
+            s.create_numeric(p, 'id', 'int32').data.write(np.asarray([1, 2, 3], dtype=np.int32))
+            s.create_numeric(p, 'v', 'int32').data.write(np.asarray([10, 20, 30], dtype=np.int32))
+            s.create_numeric(c, 'pid', 'int32').data.write(
+                np.asarray([1, 1, 3, 2], dtype=np.int32))
+            s.create_foreign_key_index(c['pid'], p['id'])
+
+            # rewritten with the same length and (session) timestamp
+            for name, values in (('id', [3, 2, 1]), ('v', [30, 20, 10])):
+                f = s.get(p[name]).writeable()
+                f.data.clear()
+                f.data.write(np.asarray(values, dtype=np.int32))
+            self.assertIsNone(s._stored_foreign_key_index(c['pid'], p['id']))
+            result = s.merge_left(c['pid'], p['id'], right_fields=(p['v'],))
+            self.assertListEqual([10, 10, 30, 20], result[0].tolist())
+
+    def test_indexed_string_foreign_key(self):
+        bio = BytesIO()
+        with session.Session(2) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pk = s.create_indexed_string(ds, 'id')
+            pk.data.write(['p1', 'p2'])
+            fk = s.create_indexed_string(ds, 'parent_id')
+            fk.data.write(['p1', 'p2', 'p1xx', 'p2yy', 'p1'])
+            index = s.create_foreign_key_index(fk, pk)
+            ivld = ops.INVALID_INDEX
+            self.assertListEqual([0, 1, ivld, ivld, 0], index.parent_rows[:].tolist())
+            self.assertEqual(2, index.orphan_count())
+            merged = s.merge_left(fk, pk, right_fields=(np.asarray([10, 20]),))
+            self.assertListEqual([10, 20, 0, 0, 10], merged[0].tolist())
+
+    def test_get_index_indexed_string(self):
+        bio = BytesIO()
+        with session.Session(2) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pk = s.create_indexed_string(ds, 'id')
+            pk.data.write(['a', 'bb'])
+            fk = s.create_indexed_string(ds, 'parent_id')
+            fk.data.write(['a', 'bb', 'cxx', 'd', 'a'])
+            ivld = ops.INVALID_INDEX
+            self.assertListEqual([0, 1, ivld, ivld + 1, 0], s.get_index(pk, fk).tolist())
+            # streamed a chunk at a time to the destination
+            dest = s.create_numeric(ds, 'index', 'int64')
+            s.get_index(pk, fk, destination=dest)
+            self.assertListEqual([0, 1, ivld, ivld + 1, 0], dest.data[:].tolist())
+
+    def test_get_index_uses_foreign_key_index(self):
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pk = s.create_numeric(ds, 'id', 'int64')
+            pk.data.write(np.asarray([50, 10, 40, 20, 30]))
+            fk = s.create_numeric(ds, 'parent_id', 'int32')
+            fk.data.write(np.asarray([10, 10, 30, 50, 40, 30], dtype=np.int32))
+            expected = s.get_index(pk, fk)
+            s.create_foreign_key_index(fk, pk)
+            self.assertListEqual(expected.tolist(), s.get_index(pk, fk).tolist())
+            self.assertListEqual([1, 1, 4, 0, 2, 4], s.get_index(pk, fk).tolist())
+
+    def test_propagate_filter(self):
+        bio = BytesIO()
+        with session.Session(7) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            rng = np.random.RandomState(12345678)
+            patient_ids = rng.permutation(30).astype(np.int64)
+            p_id = s.create_numeric(ds, 'p_id', 'int64')
+            p_id.data.write(patient_ids)
+            ages = rng.randint(0, 90, size=30)
+            a_pid = s.create_numeric(ds, 'a_pid', 'int32')
+            a_pid.data.write(rng.randint(0, 35, size=100).astype(np.int32))
+            a_id = s.create_fixed_string(ds, 'a_id', 3)
+            a_id.data.write([b'a%02d' % i for i in range(100)])
+            t_aid = s.create_fixed_string(ds, 't_aid', 3)
+            t_aid.data.write([b'a%02d' % i for i in rng.randint(0, 100, size=250)])
+
+            older = ages > 60
+            a_filter = s.propagate_filter(older, p_id, a_pid)
+            expected_a = np.isin(a_pid.data[:], patient_ids[older])
+            self.assertListEqual(expected_a.tolist(), a_filter.tolist())
+            # chained to a table that references the assessments
+            t_filter = s.propagate_filter(a_filter, a_id, t_aid,
+                                          dest=s.create_numeric(ds, 't_filter', 'bool'))
+            expected_t = np.isin(t_aid.data[:], a_id.data[:][expected_a])
+            self.assertListEqual(expected_t.tolist(), t_filter.data[:].tolist())
+
+            # sorted parent keys and a stored foreign key index give the same results
+            self.assertListEqual(expected_a.tolist(),
+                                 s.propagate_filter(older[np.argsort(patient_ids)],
+                                                    np.sort(patient_ids), a_pid).tolist())
+            s.create_foreign_key_index(a_pid, p_id)
+            self.assertListEqual(expected_a.tolist(),
+                                 s.propagate_filter(older, p_id, a_pid).tolist())
+            with self.assertRaises(ValueError):
+                s.propagate_filter(older[:-1], p_id, a_pid)
+
+    def test_propagate_filter_indexed_string(self):
+        bio = BytesIO()
+        with session.Session(2) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            p_id = s.create_fixed_string(ds, 'p_id', 2)
+            p_id.data.write(np.asarray([b'p1', b'p2']))
+            c_pid = s.create_indexed_string(ds, 'c_pid')
+            c_pid.data.write(['p1', 'p2', 'p1xx', 'p2yy', 'p1'])
+            # keys in later chunks are wider than the first chunk and the parent keys
+            self.assertListEqual([True, False, False, False, True],
+                                 s.propagate_filter(np.asarray([True, False]), p_id,
+                                                    c_pid).tolist())
+
+
+class TestSessionDistinct(unittest.TestCase):
+
+    def test_distinct_fields(self):
+        bio = BytesIO()
+        with session.Session(4) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            a = np.asarray([3, 1, 2, 1, 3, 1, 2, 3, 1, 1], dtype=np.int32)
+            b = ['x', 'yy', 'x', 'yy', 'x', '', 'x', 'zzz', 'yy', '']
+            c = np.asarray([b'p', b'q', b'p', b'q', b'q', b'p', b'p', b'p', b'q', b'p'])
+            s.create_numeric(ds, 'a', 'int32').data.write(a)
+            s.create_indexed_string(ds, 'b').data.write(b)
+            s.create_fixed_string(ds, 'c', 1).data.write(c)
+            filt = np.asarray([1, 1, 1, 0, 1, 1, 1, 1, 1, 1], dtype=bool)
+
+            results, index, counts = s.distinct(fields=(ds['a'], ds['b'], ds['c']), filter=filt,
+                                                return_index=True, return_counts=True)
+            rows = [(a[i], b[i], c[i]) for i in range(len(a)) if filt[i]]
+            expected = sorted(set(rows))
+            self.assertListEqual(expected, list(zip(*[r.tolist() for r in results])))
+            self.assertListEqual([rows.count(e) for e in expected], counts.tolist())
+            self.assertListEqual([next(i for i in range(len(a)) if filt[i] and
+                                       (a[i], b[i], c[i]) == e) for e in expected],
+                                 index.tolist())
+
+            self.assertListEqual(['', 'x', 'yy', 'zzz'], s.distinct(ds['b']).tolist())
+            self.assertListEqual([1, 2, 3], s.distinct(a).tolist())
+            self.assertListEqual([0.0, 1.5],
+                                 s.distinct(np.asarray([0.0, -0.0, 1.5, -0.0])).tolist())
+            with self.assertRaises(ValueError):
+                s.distinct()
+
+            # columns without rows keep their dtypes
+            s.create_numeric(ds, 'e_a', 'int16')
+            s.create_indexed_string(ds, 'e_b')
+            s.create_fixed_string(ds, 'e_c', 2)
+            results = s.distinct(fields=(ds['e_a'], ds['e_b'], ds['e_c']))
+            self.assertListEqual([np.dtype(np.int16), np.dtype(object), np.dtype('S2')],
+                                 [r.dtype for r in results])
+            self.assertEqual(np.float32, s.distinct(np.zeros(0, dtype=np.float32)).dtype)
+
 
 class TestSessionGetSpans(unittest.TestCase):
 
@@ -446,6 +1022,208 @@ class TestSessionGetSpans(unittest.TestCase):
             self.assertListEqual([0, 2, 3, 5, 6, 8, 12], s.get_spans(fields=(vals_1, vals_2)).tolist())
 
 
+class TestSessionValueCounts(unittest.TestCase):
+
+    def test_value_counts(self):
+        import pandas as pd
+        bio = BytesIO()
+        with session.Session(100) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            rng = np.random.RandomState(12345678)
+            colours = rng.randint(0, 4, size=1000).astype(np.int8)
+            cat = s.create_categorical(ds, 'colour', 'int8',
+                                       {'na': 0, 'red': 1, 'green': 2, 'blue': 3})
+            cat.data.write(colours)
+            counts = rng.randint(-5, 3000, size=1000).astype(np.int32)
+            s.create_numeric(ds, 'count', 'int32').data.write(counts)
+            names = np.asarray(['n{}'.format(i) * (i % 4) for i in rng.randint(0, 30, size=1000)])
+            s.create_indexed_string(ds, 'name').data.write(names.tolist())
+            flt = rng.uniform(size=1000) < 0.7
+
+            for field, values in ((cat, colours), (ds['count'], counts), (ds['name'], names)):
+                expected = pd.Series(values[flt]).value_counts().sort_index()
+                actual_values, actual_counts = s.value_counts(field, filter=flt)
+                self.assertListEqual(expected.index.tolist(), actual_values.tolist())
+                self.assertListEqual(expected.tolist(), actual_counts.tolist())
+
+            expected = pd.crosstab(names, colours)
+            values, by_values, crosstab = s.value_counts(ds['name'], by=cat)
+            self.assertListEqual(expected.index.tolist(), values.tolist())
+            self.assertListEqual(expected.columns.tolist(), by_values.tolist())
+            self.assertListEqual(expected.values.tolist(), crosstab.tolist())
+
+            # uint64 values that don't fit in an int64
+            values, value_counts = s.value_counts(
+                np.asarray([2**63 + 5, 2**63 + 1, 2**63 + 5], dtype=np.uint64))
+            self.assertListEqual([2**63 + 1, 2**63 + 5], values.tolist())
+            self.assertListEqual([1, 2], value_counts.tolist())
+
+    def test_histogram(self):
+        bio = BytesIO()
+        with session.Session(100) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            rng = np.random.RandomState(12345678)
+            values = rng.normal(25, 5, size=1000).astype(np.float32)
+            values[::50] = np.nan
+            bmi = s.create_numeric(ds, 'bmi', 'float32')
+            bmi.data.write(values)
+            sexes = rng.randint(0, 2, size=1000).astype(np.int8)
+            sex = s.create_categorical(ds, 'sex', 'int8', {'female': 0, 'male': 1})
+            sex.data.write(sexes)
+            flt = rng.uniform(size=1000) < 0.8
+
+            valid = ~np.isnan(values)
+            expected, expected_edges = np.histogram(values[valid & flt], bins=12)
+            counts, edges = s.histogram(bmi, bins=12, filter=flt)
+            self.assertListEqual(expected.tolist(), counts.tolist())
+            self.assertTrue(np.allclose(expected_edges, edges))
+
+            bins = [10, 20, 25, 30, 35]
+            counts, edges, by_values = s.histogram(bmi, bins=bins, by=sex)
+            self.assertListEqual([0, 1], by_values.tolist())
+            for i in (0, 1):
+                expected, _ = np.histogram(values[valid & (sexes == i)], bins=bins)
+                self.assertListEqual(expected.tolist(), counts[:, i].tolist())
+
+            with self.assertRaises(ValueError):
+                s.histogram(s.create_indexed_string(ds, 'names'))
+            with self.assertRaises(ValueError):
+                s.histogram(bmi, bins=[1, 1])
+
+
+class TestSessionDescribe(unittest.TestCase):
+
+    def test_describe(self):
+        import pandas as pd
+        bio = BytesIO()
+        with session.Session(100) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            rng = np.random.RandomState(12345678)
+            ages = rng.randint(0, 100, size=1000).astype(np.int32)
+            age_valid = rng.uniform(size=1000) < 0.9
+            s.create_numeric(ds, 'age', 'int32').data.write(ages)
+            s.create_numeric(ds, 'age_valid', 'bool').data.write(age_valid)
+            bmis = rng.normal(25, 5, size=1000)
+            bmis[::7] = np.nan
+            bmi = s.create_numeric(ds, 'bmi', 'float64')
+            bmi.data.write(bmis)
+            s.create_indexed_string(ds, 'name').data.write(['a'] * 1000)
+
+            results = s.describe(ds, workers=2)
+            self.assertListEqual(['age', 'bmi'], sorted(results.keys()))
+            for name, values in (('age', ages[age_valid]), ('bmi', bmis)):
+                expected = pd.Series(values).describe()
+                actual = results[name]
+                self.assertEqual(1000, actual['count'])
+                self.assertEqual(expected['count'], actual['count_valid'])
+                for k in ('mean', 'std', 'min', '25%', '50%', '75%', 'max'):
+                    self.assertAlmostEqual(expected[k], actual[k])
+
+            # results are cached until the field is rewritten
+            ds['bmi']['values'][:] = 0
+            self.assertEqual(results['bmi'], s.describe(ds, fields=['bmi'])['bmi'])
+            bmi = bmi.writeable()
+            bmi.data.clear()
+            bmi.data.write(np.arange(10, dtype=np.float64))
+            self.assertEqual(4.5, s.describe(ds, fields=['bmi'])['bmi']['mean'])
+            s.get(ds['age_valid']).writeable().data[:] = False
+            self.assertEqual(0, s.describe(ds, fields=['age'])['age']['count_valid'])
+
+            with self.assertRaises(ValueError):
+                s.describe(ds, fields=['name'])
+
+    def test_describe_sampled_quantiles(self):
+        values = np.random.RandomState(12345678).uniform(size=100000)
+        results = ops.describe(values, quantiles=(0.1, 0.5), chunksize=10000,
+                               sample_size=5000)
+        self.assertAlmostEqual(values.mean(), results['mean'])
+        self.assertAlmostEqual(values.std(ddof=1), results['std'])
+        self.assertAlmostEqual(0.1, results['10%'], delta=0.02)
+        self.assertAlmostEqual(0.5, results['50%'], delta=0.02)
+
+
+class TestSessionWindowFunctions(unittest.TestCase):
+
+    def _assessments(self, s, ds):
+        rng = np.random.RandomState(12345678)
+        pids = np.sort(rng.randint(0, 40, size=300)).astype(np.int32)
+        times = np.zeros(len(pids), dtype=np.float64)
+        for p in np.unique(pids):
+            rows = pids == p
+            times[rows] = np.sort(rng.randint(0, 60, size=rows.sum())) * 86400.0
+        temperatures = rng.normal(37, 1, size=len(pids))
+        temperatures[::9] = np.nan
+        s.create_numeric(ds, 'patient_id', 'int32').data.write(pids)
+        s.create_timestamp(ds, 'created_at').data.write(times)
+        s.create_numeric(ds, 'temperature', 'float64').data.write(temperatures)
+        s.create_numeric(ds, 'fever', 'bool').data.write(temperatures > 37.5)
+        return pids, times, temperatures
+
+    def test_cumulative_and_shift(self):
+        import pandas as pd
+        bio = BytesIO()
+        with session.Session(7) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pids, times, temperatures = self._assessments(s, ds)
+            spans = s.get_spans(ds['patient_id'])
+            df = pd.DataFrame({'pid': pids, 'time': times, 'temperature': temperatures,
+                               'fever': temperatures > 37.5})
+            g = df.groupby('pid', sort=False)
+
+            dest = s.create_numeric(ds, 'fever_days', 'int64')
+            s.apply_spans_cumsum(spans, ds['fever'], dest=dest)
+            self.assertListEqual(g.fever.cumsum().tolist(), dest.data[:].tolist())
+            # pandas gives NaN rows a NaN sum, where the sum of the earlier rows is kept
+            actual = s.apply_spans_cumsum(spans, ds['temperature'])
+            expected = g.temperature.cumsum()
+            self.assertTrue(np.allclose(expected[df.temperature.notna()],
+                                        actual[df.temperature.notna()]))
+            self.assertListEqual(g.cumcount().tolist(), s.apply_spans_cumcount(spans).tolist())
+
+            expected = g.time.diff() / 86400
+            actual = s.apply_spans_diff(spans, ds['created_at']) / 86400
+            self.assertTrue(np.array_equal(expected.values, actual, equal_nan=True))
+            for k in (1, 3):
+                expected = g.temperature.shift(k).values
+                actual = s.apply_spans_lag(spans, ds['temperature'], k=k)
+                self.assertTrue(np.array_equal(expected, actual, equal_nan=True))
+                expected = g.pid.shift(-k).fillna(-1).values
+                actual = s.apply_spans_lead(spans, ds['patient_id'], k=k, fill=-1)
+                self.assertListEqual(expected.tolist(), actual.tolist())
+
+    def test_rolling(self):
+        import pandas as pd
+        bio = BytesIO()
+        with session.Session(7) as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            pids, times, temperatures = self._assessments(s, ds)
+            spans = s.get_spans(ds['patient_id'])
+            df = pd.DataFrame({'pid': pids, 'temperature': temperatures},
+                              index=pd.to_datetime(times, unit='s'))
+            g = df.groupby('pid', sort=False).temperature
+
+            for aggregation in ('count', 'sum', 'mean', 'min', 'max'):
+                expected = getattr(g.rolling(3, min_periods=1), aggregation)().values
+                actual = s.apply_spans_rolling(spans, ds['temperature'], aggregation, window=3)
+                self.assertTrue(np.allclose(expected, actual, equal_nan=True))
+
+                expected = getattr(g.rolling('7D', min_periods=2), aggregation)().values
+                if aggregation == 'count':
+                    expected = getattr(g.rolling('7D'), aggregation)().values
+                dest = s.create_numeric(ds, 'rolling_{}'.format(aggregation), 'float64')
+                s.apply_spans_rolling(spans, ds['temperature'], aggregation,
+                                      timestamps=ds['created_at'], duration=timedelta(days=7),
+                                      min_periods=2, dest=dest)
+                self.assertTrue(np.allclose(expected, dest.data[:], equal_nan=True))
+
+            with self.assertRaises(ValueError):
+                s.apply_spans_rolling(spans, ds['temperature'], 'max', window=3,
+                                      timestamps=ds['created_at'], duration=86400)
+            with self.assertRaises(ValueError):
+                s.apply_spans_rolling(spans, ds['temperature'], 'max',
+                                      timestamps=-s.get(ds['created_at']).data[:], duration=86400)
+
+
 class TestSessionAggregate(unittest.TestCase):
 
     def test_apply_spans_count(self):
@@ -620,6 +1398,154 @@ class TestSessionAggregate(unittest.TestCase):
             self.assertListEqual(expected_indices, s.get(ds['result2']).indices[:].tolist())
             self.assertListEqual(expected_data, s.get(ds['result2']).data[:])
 
+    def test_apply_spans_concat_streamed(self):
+        idx = np.asarray([0, 0, 1, 1, 1, 1, 1, 1, 1, 2, 3, 3, 4, 4, 4], dtype=np.int32)
+        vals = ['a', 'b,c', 'd', '', 'e"f', 'g', 'hij', 'k', 'l,m', 'nop',
+                '', '', 'q', 'rs', 't,u']
+        bio = BytesIO()
+        with session.Session() as s:
+            spans = s.get_spans(idx)
+            ds = s.open_dataset(bio, "w", "ds")
+            s.create_indexed_string(ds, 'vals').data.write(vals)
+            s.apply_spans_concat(spans, s.get(ds['vals']), dest=s.create_indexed_string(ds, 'r'))
+            expected_indices = s.get(ds['r']).indices[:].tolist()
+            expected_data = s.get(ds['r']).data[:]
+            self.assertListEqual(['a,"b,c"', 'd,"e""f",g,hij,k,"l,m"', 'nop', '', 'q,rs,"t,u"'],
+                                 expected_data)
+
+            # spans larger than the chunk sizes form blocks of their own
+            for i, (src_chunksize, dest_chunksize) in enumerate(((1, 1), (3, 2), (4, 64))):
+                name = 'r{}'.format(i)
+                s.apply_spans_concat(spans, s.get(ds['vals']), dest=s.create_indexed_string(ds, name),
+                                     src_chunksize=src_chunksize, dest_chunksize=dest_chunksize,
+                                     chunksize_mult=1)
+                self.assertListEqual(expected_indices, s.get(ds[name]).indices[:].tolist())
+                self.assertListEqual(expected_data, s.get(ds[name]).data[:])
+
+
+    def test_apply_spans_multi(self):
+
+        idx = np.asarray([0, 1, 1, 2, 2, 2, 3, 3, 3, 3], dtype=np.int32)
+        vals = np.asarray([5, 3, 3, 4, 1, 4, 2, 8, 6, 2], dtype=np.int32)
+        fvals = np.asarray([1.0, 2.0, np.nan, 1.0, 2.0, 3.0, 4.0, 4.0, np.nan, np.nan])
+        valid = np.asarray([1, 1, 0, 1, 1, 1, 1, 1, 1, 0], dtype=bool)
+        bio = BytesIO()
+        with session.Session() as s:
+            results = s.apply_spans_multi(((vals, 'count'), (vals, 'first'), (vals, 'last'),
+                                           (vals, 'min'), (vals, 'max'), (vals, 'sum'),
+                                           (vals, 'count_distinct'), (vals, 'sum', valid),
+                                           (fvals, 'count_valid'), (fvals, 'mean'),
+                                           (fvals, 'var')),
+                                          keys=idx)
+            self.assertListEqual([1, 2, 3, 4], results[0].tolist())
+            self.assertListEqual([5, 3, 4, 2], results[1].tolist())
+            self.assertListEqual([5, 3, 4, 2], results[2].tolist())
+            self.assertListEqual([5, 3, 1, 2], results[3].tolist())
+            self.assertListEqual([5, 3, 4, 8], results[4].tolist())
+            self.assertListEqual([5, 6, 9, 18], results[5].tolist())
+            self.assertListEqual([1, 1, 2, 3], results[6].tolist())
+            self.assertListEqual([5, 3, 9, 16], results[7].tolist())
+            self.assertListEqual([1, 1, 3, 2], results[8].tolist())
+            self.assertListEqual([1.0, 2.0, 2.0, 4.0], results[9].tolist())
+            self.assertTrue(np.isnan(results[10][0]))
+            self.assertListEqual([1.0, 0.0], results[10][2:].tolist())
+
+            ds = s.open_dataset(bio, "w", "ds")
+            s.apply_spans_multi(((vals, 'max'), (vals, 'mean')), spans=s.get_spans(idx),
+                                destinations=(s.create_numeric(ds, 'max', 'int32'),
+                                              s.create_numeric(ds, 'mean', 'float32')))
+            self.assertListEqual([5, 3, 4, 8], s.get(ds['max']).data[:].tolist())
+            self.assertListEqual([5.0, 3.0, 3.0, 4.5], s.get(ds['mean']).data[:].tolist())
+
+    def test_apply_spans_multi_fixed_string(self):
+        spans = np.asarray([0, 2, 5], dtype=np.int64)
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            fs = s.create_fixed_string(ds, 'fs', 2)
+            fs.data.write(np.asarray([b'ab', b'c', b'de', b'de', b'f'], dtype='S2'))
+            results = s.apply_spans_multi(((fs, 'first'), (fs, 'last'), (fs, 'count'),
+                                           (fs, 'count_distinct')),
+                                          spans=spans)
+            self.assertListEqual([b'ab', b'de'], results[0].tolist())
+            self.assertListEqual([b'c', b'f'], results[1].tolist())
+            self.assertListEqual([2, 3], results[2].tolist())
+            self.assertListEqual([2, 2], results[3].tolist())
+            with self.assertRaises(ValueError):
+                s.apply_spans_multi(((fs, 'sum'),), spans=spans)
+
+    def test_apply_spans_multi_no_valid_values(self):
+        spans = np.asarray([0, 2, 5], dtype=np.int64)
+        fvals = np.asarray([1.0, 2.0, 3.0, 4.0, 5.0])
+        vals = np.asarray([1, 2, 3, 4, 5], dtype=np.int32)
+        valid = np.asarray([0, 0, 1, 1, 1], dtype=bool)
+        with session.Session() as s:
+            results = s.apply_spans_multi(((fvals, 'min', valid), (fvals, 'max', valid),
+                                           (vals, 'min', valid), (vals, 'count_valid', valid)),
+                                          spans=spans)
+            self.assertTrue(np.isnan(results[0][0]))
+            self.assertEqual(3.0, results[0][1])
+            self.assertTrue(np.isnan(results[1][0]))
+            self.assertEqual(5.0, results[1][1])
+            # integer results can't be NaN, so 'count_valid' distinguishes empty spans
+            self.assertListEqual([0, 3], results[2].tolist())
+            self.assertListEqual([0, 3], results[3].tolist())
+
+    def test_aggregate_sum(self):
+        idx = np.asarray([0, 1, 1, 2, 2, 2, 3, 3, 3, 3], dtype=np.int32)
+        vals = np.asarray([5, 3, 3, 4, 1, 4, 2, 8, 6, 2], dtype=np.int32)
+        with session.Session() as s:
+            self.assertListEqual([5, 6, 9, 18], s.aggregate_sum(idx, vals).tolist())
+            self.assertListEqual([1, 1, 2, 3], s.aggregate_count_distinct(idx, vals).tolist())
+
+    def test_apply_hash_group_by(self):
+        keys = np.asarray([b'gb', b'us', b'gb', b'se', b'us', b'gb', b'se'], dtype='S2')
+        vals = np.asarray([3, 1, 5, 2, 1, 4, 7], dtype=np.int32)
+        fvals = np.asarray([1.0, np.nan, 2.0, 3.0, 4.0, 6.0, np.nan])
+
+        with session.Session(chunksize=3) as s:
+            group_keys, results = \
+                s.apply_hash_group_by(keys, ((vals, 'count'), (vals, 'first'), (vals, 'last'),
+                                             (vals, 'min'), (vals, 'max'), (vals, 'sum'),
+                                             (vals, 'count_distinct'), (fvals, 'mean'),
+                                             (fvals, 'count_valid')))
+            self.assertListEqual([b'gb', b'us', b'se'], group_keys.tolist())
+            self.assertListEqual([3, 2, 2], results[0].tolist())
+            self.assertListEqual([3, 1, 2], results[1].tolist())
+            self.assertListEqual([4, 1, 7], results[2].tolist())
+            self.assertListEqual([3, 1, 2], results[3].tolist())
+            self.assertListEqual([5, 1, 7], results[4].tolist())
+            self.assertListEqual([12, 2, 9], results[5].tolist())
+            self.assertListEqual([3, 1, 2], results[6].tolist())
+            self.assertListEqual([3.0, 4.0, 3.0], results[7].tolist())
+            self.assertListEqual([3, 1, 1], results[8].tolist())
+
+            fvals[keys == b'us'] = np.nan
+            _, results = s.apply_hash_group_by(keys, ((keys, 'first'), (keys, 'last'),
+                                                      (fvals, 'min'), (fvals, 'max')))
+            self.assertListEqual([b'gb', b'us', b'se'], results[0].tolist())
+            self.assertListEqual([b'gb', b'us', b'se'], results[1].tolist())
+            self.assertListEqual([1.0, 3.0], results[2][[0, 2]].tolist())
+            self.assertListEqual([6.0, 3.0], results[3][[0, 2]].tolist())
+            self.assertTrue(np.isnan(results[2][1]) and np.isnan(results[3][1]))
+
+    def test_apply_spans_indexed_string(self):
+        idx = np.asarray([0, 0, 1, 2, 2, 2, 3, 3], dtype=np.int32)
+        vals = ['bb', 'abc', '', 'b', 'aaaa', 'ba', 'x', 'xy']
+        bio = BytesIO()
+        with session.Session() as s:
+            ds = s.open_dataset(bio, "w", "ds")
+            src = s.create_indexed_string(ds, 'src')
+            src.data.write(vals)
+            spans = s.get_spans(idx)
+            for name, expected in (('first', ['bb', '', 'b', 'x']),
+                                   ('last', ['abc', '', 'ba', 'xy']),
+                                   ('min', ['abc', '', 'aaaa', 'x']),
+                                   ('max', ['bb', '', 'ba', 'xy']),
+                                   ('longest', ['abc', '', 'aaaa', 'xy'])):
+                dest = s.create_indexed_string(ds, name)
+                getattr(s, 'apply_spans_{}'.format(name))(spans, src, dest)
+                self.assertListEqual(expected, s.get(ds[name]).data[:])
 
     def test_aggregate_count(self):
         idx = np.asarray([0, 1, 1, 2, 2, 2, 3, 3, 3, 3], dtype=np.int32)
@@ -0,0 +1,108 @@
+# Copyright 2020 KCL-BMEIS - King's College London
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from io import BytesIO
+
+import numpy as np
+
+from exetera.core import session
+from exetera.core.sketches import HyperLogLog, KLLSketch
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def test_estimate_and_merge(self):
+        rng = np.random.RandomState(12345678)
+        values = rng.randint(0, 200000, size=400000)
+        first, second = HyperLogLog(), HyperLogLog()
+        first.add(values[:250000])
+        second.add(values[250000:])
+        expected = len(np.unique(values))
+        self.assertAlmostEqual(1.0, first.merge(second).estimate() / expected, delta=0.03)
+
+        small = HyperLogLog()
+        small.add(np.asarray([0.0, -0.0, np.nan, 1.5, 1.5]))
+        small.add(['a', 'b', 'a'])
+        self.assertEqual(4, small.estimate())
+        with self.assertRaises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(12))
+
+
+class TestKLLSketch(unittest.TestCase):
+
+    def test_quantiles_and_merge(self):
+        rng = np.random.RandomState(12345678)
+        values = rng.normal(size=300000)
+        sketches = [KLLSketch() for _ in range(3)]
+        for i, s in enumerate(sketches):
+            for chunk in np.array_split(values[i::3], 7):
+                s.add(chunk)
+        merged = sketches[0].merge(sketches[1]).merge(sketches[2])
+        self.assertEqual(len(values), len(merged))
+        quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+        estimates = merged.quantiles([0] + quantiles + [1])
+        self.assertEqual(values.min(), estimates[0])
+        self.assertEqual(values.max(), estimates[-1])
+        ranks = [np.mean(values <= e) for e in estimates[1:-1]]
+        for q, r in zip(quantiles, ranks):
+            self.assertAlmostEqual(q, r, delta=0.02)
+
+        # small sketches are exact
+        exact = KLLSketch()
+        exact.add(values[:100], valid=values[:100] > -1)
+        expected = np.quantile(values[:100][values[:100] > -1], quantiles,
+                               method='inverted_cdf')
+        self.assertListEqual(expected.tolist(), exact.quantiles(quantiles).tolist())
+        self.assertTrue(np.isnan(KLLSketch().quantiles([0.5])[0]))
+
+
+class TestSessionSketches(unittest.TestCase):
+
+    def test_approx_aggregations(self):
+        bio = BytesIO()
+        with session.Session(1000) as s:
+            ds = s.open_dataset(bio, 'w', 'ds')
+            rng = np.random.RandomState(12345678)
+            # a few long spans that cross chunks among many short ones
+            lengths = np.where(rng.uniform(size=300) < 0.05, rng.randint(1500, 3000, size=300),
+                               rng.randint(0, 20, size=300))
+            spans = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=spans[1:])
+            temperatures = rng.normal(37, 1, size=spans[-1])
+            temperatures[::11] = np.nan
+            s.create_numeric(ds, 'temperature', 'float64').data.write(temperatures)
+            symptoms = ['s{}'.format(v) for v in rng.randint(0, 40, size=spans[-1])]
+            s.create_indexed_string(ds, 'symptom').data.write(symptoms)
+
+            self.assertAlmostEqual(
+                np.nanmedian(temperatures), s.approx_quantiles(ds['temperature'], workers=3)[0],
+                delta=0.05)
+            self.assertEqual(40, s.approx_count_distinct(ds['symptom'], workers=2))
+
+            dest = s.create_numeric(ds, 'median', 'float64')
+            medians = s.apply_spans_approx_quantiles(spans, ds['temperature'], dest=dest)
+            distinct = s.apply_spans_approx_count_distinct(spans, ds['symptom'])
+            self.assertTrue(np.array_equal(medians, dest.data[:], equal_nan=True))
+            for i in range(len(lengths)):
+                t = temperatures[spans[i]:spans[i + 1]]
+                t = t[~np.isnan(t)]
+                if len(t) == 0:
+                    self.assertTrue(np.isnan(medians[i]))
+                elif len(t) < 600:
+                    self.assertEqual(np.quantile(t, 0.5, method='inverted_cdf'), medians[i])
+                else:
+                    self.assertAlmostEqual(0.5, np.mean(t <= medians[i]), delta=0.03)
+                expected = len(set(symptoms[spans[i]:spans[i + 1]]))
+                self.assertEqual(expected, distinct[i])
+
+            with self.assertRaises(ValueError):
+                s.apply_spans_approx_quantiles(spans, ds['temperature'], quantiles=[0.5, 1.5])